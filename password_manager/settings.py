@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'passwords.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -135,9 +136,53 @@ LOGOUT_REDIRECT_URL = '/login/'
 SESSION_COOKIE_AGE = 600  # 10 minutes in seconds
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 SESSION_SAVE_EVERY_REQUEST = True  # Reset timeout on each request
+# Sessions are read from and written to a cache; cached_db also writes them through to the database
+SESSION_ENGINE = os.environ.get('DJANGO_SESSION_ENGINE', 'django.contrib.sessions.backends.cache')
+SESSION_CACHE_ALIAS = 'sessions'
+
+# Caches that need no extra service: local memory for per-process data, and
+# files for sessions so that all worker processes on the host share them
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'password-manager',
+    },
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('DJANGO_SESSION_CACHE_DIR', str(BASE_DIR / '.cache' / 'sessions')),
+        'OPTIONS': {'MAX_ENTRIES': 10000},  # Beyond this, a third of the sessions are dropped
+    },
+}
 SECURE_SSL_REDIRECT=False
 # CSRF_COOKIE_SECURE=True
 
 
 # Password Manager settings
 PASSWORD_MANAGER_REQUEST_LIMIT = 5  # Maximum number of password fetch requests per session
+PASSWORD_MANAGER_BATCH_LIMIT = 20  # Maximum number of entries in one fetch_batch request
+PASSWORD_MANAGER_REQUEST_COUNTER = 'db'  # Where fetches are counted: db (shared by all workers), cache or session
+PASSWORD_MANAGER_REQUEST_COUNTER_CACHE = 'default'  # Cache of the cache counter; must be shared (Redis, Memcached) with several workers
+# Rate limits per user and per client IP; see passwords/ratelimit.py
+PASSWORD_MANAGER_RATE_LIMITS = {
+    'check_login': {'algorithm': 'sliding_window', 'limit': 10, 'window': 60, 'keys': ['user', 'ip']},
+    'fetch_data': {'algorithm': 'token_bucket', 'rate': 0.5, 'burst': 10, 'keys': ['user', 'ip']},
+}
+PASSWORD_MANAGER_RATE_LIMIT_BACKEND = 'local'  # local (per process), cache (sliding windows only) or db
+PASSWORD_MANAGER_RATE_LIMIT_MAX_KEYS = 100000  # Keys kept by the local backend before evicting the oldest
+# Backoff after failed logins, per username and client IP: free failures, then 1s, 2s, 4s... up to max_delay
+PASSWORD_MANAGER_LOGIN_THROTTLE = {'free_failures': 3, 'base_delay': 1, 'max_delay': 300, 'max_keys': 10000}
+# Key derivation for new profiles; pick parameters with `manage.py calibrate_kdf`
+PASSWORD_MANAGER_KDF = {'algorithm': 'pbkdf2_sha256', 'params': {'iterations': 100000}}
+PASSWORD_MANAGER_KDF_UPGRADE_ON_LOGIN = True  # Move existing vaults to PASSWORD_MANAGER_KDF when their user logs in
+PASSWORD_MANAGER_KEY_CACHE_SIZE = 1024  # Maximum number of derived keys kept in memory
+PASSWORD_MANAGER_KEY_CACHE_TTL = SESSION_COOKIE_AGE  # Seconds a derived key stays cached without use
+PASSWORD_MANAGER_KEY_AGENT_SOCKET = os.environ.get("PASSWORD_MANAGER_KEY_AGENT_SOCKET")  # Unix socket of `manage.py key_agent` (None: keys stay in each process)
+PASSWORD_MANAGER_KEY_AGENT_TTL = SESSION_COOKIE_AGE  # Seconds the key agent keeps a key without use
+PASSWORD_MANAGER_SERVICE_INDEX_TTL = 3600  # Seconds a user's cached service list is kept
+PASSWORD_MANAGER_SEARCH_INDEX_USERS = 256  # Maximum number of per-user search indexes kept in memory
+PASSWORD_MANAGER_SEARCH_INDEX_TERMS = 500000  # Total indexed terms before least recently used indexes are evicted
+PASSWORD_MANAGER_ADMIN_COUNT_LIMIT = 10000  # Rows counted on the entry changelist before showing an estimate
+PASSWORD_MANAGER_ASYNC_VIEWS = (os.environ.get("PASSWORD_MANAGER_ASYNC_VIEWS", 'False').lower() == 'true')  # Serve async views at the main URLs (ASGI)
+PASSWORD_MANAGER_CRYPTO_THREADS = 4  # Threads used by async views for key derivation and decryption
+PASSWORD_MANAGER_METRICS = (os.environ.get("PASSWORD_MANAGER_METRICS", 'False').lower() == 'true')  # Measure crypto, queries and views for /metrics/
+PASSWORD_MANAGER_SERVER_TIMING = False  # Add a Server-Timing header to each response (needs PASSWORD_MANAGER_METRICS)
@@ -0,0 +1,48 @@
+"""
+Production database settings for password_manager.
+
+Use with DJANGO_SETTINGS_MODULE=password_manager.settings_prod. Everything
+else comes from settings.py.
+"""
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR
+import os
+
+# SQLite tuned for a web server: readers do not block the writer (WAL), commits
+# do not wait for fsync of every page, and writes take the lock up front so
+# concurrent transactions queue on `timeout` instead of failing to upgrade
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get("DJANGO_SQLITE_PATH", BASE_DIR / 'db.sqlite3'),
+        'OPTIONS': {
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA cache_size=-20000;'
+                'PRAGMA temp_store=MEMORY'
+            ),
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+    }
+}
+
+# PostgreSQL when POSTGRES_DB is set, with persistent connections by default,
+# or a psycopg connection pool with POSTGRES_POOL=true (needs psycopg[pool])
+if os.environ.get("POSTGRES_DB"):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ["POSTGRES_DB"],
+        'USER': os.environ.get("POSTGRES_USER", ''),
+        'PASSWORD': os.environ.get("POSTGRES_PASSWORD", ''),
+        'HOST': os.environ.get("POSTGRES_HOST", ''),
+        'PORT': os.environ.get("POSTGRES_PORT", ''),
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+    }
+    if os.environ.get("POSTGRES_POOL", 'False').lower() == 'true':
+        # Pooled connections are returned after each request
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS'] = {'pool': True}
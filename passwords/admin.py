@@ -1,9 +1,18 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ORDER_VAR, PAGE_VAR, ChangeList
 from django.utils.html import format_html
 from django import forms
-from django.contrib.auth.hashers import check_password
-from django.contrib.auth import authenticate
-from .models import PasswordCategory, PasswordEntry, UserEncryptionProfile
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.http import HttpResponseNotAllowed, JsonResponse
+from django.urls import path, reverse
+from . import fulltext
+from .counters import consume_requests
+from .keycache import get_session_key
+from .models import KeyRotationInProgress, PasswordCategory, PasswordEntry, UserEncryptionProfile
+from .pagination import CURSOR_VAR, Page, count_upto, estimate_count, keyset_fields, keyset_page
+from .ratelimit import rate_limited
 
 
 class PasswordEntryForm(forms.ModelForm):
@@ -17,27 +26,35 @@ class PasswordEntryForm(forms.ModelForm):
         model = PasswordEntry
         fields = ['category', 'service_name', 'service_url', 'username', 'password', 'comments']
 
+    class Media:
+        js = ('passwords/js/admin_reveal.js',)
+
     def __init__(self, *args, **kwargs):
         self.request = kwargs.pop('request', None)
+        self.key = None
         super().__init__(*args, **kwargs)
 
-        # Show decrypted password for existing entries
-        if self.instance.pk and self.request:
-            user_password = self.request.session.get('user_password')
-            if user_password:
-                try:
-                    decrypted_password = self.instance.decrypt_password(user_password)
-                    self.fields['password'].widget.attrs['placeholder'] = f"Current: {decrypted_password[:3]}***"
-                except:
-                    self.fields['password'].widget.attrs['placeholder'] = "Unable to decrypt current password"
+        # The current password is decrypted only when the page asks for it
+        if self.instance.pk:
+            self.fields['password'].widget.attrs.update({
+                'placeholder': "Current password hidden",
+                'data-reveal-url': reverse('admin:passwords_passwordentry_reveal', args=[self.instance.pk]),
+            })
 
     def clean(self):
         cleaned_data = super().clean()
         password = cleaned_data.get('password')
 
         if password and self.request:
-            user_password = self.request.session.get('user_password')
-            if not user_password:
+            # The admin saves the entry in this same transaction, so the
+            # profile stays locked and the key current until it is written
+            try:
+                with transaction.atomic():
+                    UserEncryptionProfile.lock_for_writes(self.request.user.pk)
+                    self.key = get_session_key(self.request)
+            except KeyRotationInProgress:
+                raise forms.ValidationError("The vault key is being rotated. Please try again once it is done.")
+            if not self.key:
                 raise forms.ValidationError("Session expired. Please log in again to encrypt passwords.")
 
         return cleaned_data
@@ -45,11 +62,11 @@ class PasswordEntryForm(forms.ModelForm):
     def save(self, commit=True):
         instance = super().save(commit=False)
         password = self.cleaned_data.get('password')
+        # Edited here, so the next upsert import should not consider it unchanged
+        instance.fingerprint = ''
 
-        if password and self.request:
-            user_password = self.request.session.get('user_password')
-            if user_password:
-                instance.encrypt_password(password, user_password)
+        if password and self.key:
+            instance.encrypt_password(password, self.key)
 
         if commit:
             instance.save()
@@ -62,23 +79,113 @@ class PasswordEntryInline(admin.TabularInline):
     fields = ('service_name', 'service_url', 'username', 'comments', 'created_at')
     readonly_fields = ('created_at',)
 
+    def get_queryset(self, request):
+        # Each inline row renders str(entry), which reaches through category
+        return super().get_queryset(request).select_related('category')
+
+
+class CategoryListFilter(admin.SimpleListFilter):
+    """Category filter that lists only the user's categories in one query"""
+    title = 'category'
+    parameter_name = 'category__id__exact'
+
+    def lookups(self, request, model_admin):
+        categories = PasswordCategory.objects.select_related('user')
+        if not request.user.is_superuser:
+            categories = categories.filter(user=request.user)
+        return [(category.pk, str(category)) for category in categories]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(category_id=self.value())
+        return queryset
+
+
+class EntryChangeList(ChangeList):
+    """Changelist paged by sort key rather than offset, counting at most a limit of rows
+
+    Full-text search results are ordered best match first, unless a column
+    was clicked. Orderings that can't be keyset paged (the search rank) fall
+    back to offset pages, still with a bounded count.
+    """
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_queryset(self, request, exclude_parameters=None):
+        queryset = super().get_queryset(request, exclude_parameters)
+        # The search runs after the ordering is set, so the rank goes in front of it here
+        if ORDER_VAR not in self.params and 'search_rank' in queryset.query.annotations:
+            queryset = queryset.order_by('search_rank', *queryset.query.order_by)
+        return queryset
+
+    def get_results(self, request):
+        # Like the page number, the cursor is not carried over to sorting and filtering links
+        cursor = self.params.pop(CURSOR_VAR, None)
+        limit = getattr(settings, 'PASSWORD_MANAGER_ADMIN_COUNT_LIMIT', 10000)
+        result_count = count_upto(self.queryset, limit)
+        self.result_count_exact = result_count <= limit
+        self.result_count_estimated = False
+        if not self.result_count_exact:
+            estimate = estimate_count(self.queryset)
+            self.result_count_estimated = estimate is not None
+            result_count = max(estimate or 0, limit)
+
+        self.result_count = result_count
+        self.show_full_result_count = False
+        self.full_result_count = None
+        self.show_admin_actions = True
+        self.can_show_all = self.result_count_exact and result_count <= self.list_max_show_all
+        self.multi_page = result_count > self.list_per_page
+
+        if (self.show_all and self.can_show_all) or not self.multi_page:
+            self.result_list = self.queryset._clone()
+            self.paginator = Page(self.result_list)
+            return
+
+        fields = keyset_fields(self.queryset)
+        if fields:
+            rows, next_cursor, previous_cursor = keyset_page(self.queryset, fields, self.list_per_page, cursor)
+            self.paginator = Page(
+                rows,
+                next_url=next_cursor and self.get_query_string({CURSOR_VAR: next_cursor}),
+                previous_url=previous_cursor and self.get_query_string({CURSOR_VAR: previous_cursor}),
+                first_url=previous_cursor and self.get_query_string(),
+            )
+        else:
+            start = (self.page_num - 1) * self.list_per_page
+            rows = list(self.queryset[start:start + self.list_per_page + 1])
+            has_next = len(rows) > self.list_per_page
+            rows = rows[:self.list_per_page]
+            self.paginator = Page(
+                rows,
+                next_url=has_next and self.get_query_string({PAGE_VAR: self.page_num + 1}),
+                previous_url=self.page_num > 1 and self.get_query_string({PAGE_VAR: self.page_num - 1}),
+                first_url=self.page_num > 1 and self.get_query_string(),
+            )
+        self.result_list = rows
+
 
 @admin.register(PasswordCategory)
 class PasswordCategoryAdmin(admin.ModelAdmin):
     list_display = ('name', 'user', 'entry_count', 'created_at')
     list_filter = ('created_at', 'user')
     search_fields = ('name', 'user__username')
+    list_select_related = ('user',)
     inlines = [PasswordEntryInline]
 
     def get_queryset(self, request):
-        qs = super().get_queryset(request)
+        qs = super().get_queryset(request).annotate(entry_count=Count('entries'))
         if request.user.is_superuser:
             return qs
         return qs.filter(user=request.user)
 
     def entry_count(self, obj):
-        return obj.entries.count()
+        return obj.entry_count
     entry_count.short_description = 'Entries'
+    entry_count.admin_order_field = 'entry_count'
 
     def save_model(self, request, obj, form, change):
         if not change:  # Only set user for new objects
@@ -90,8 +197,13 @@ class PasswordCategoryAdmin(admin.ModelAdmin):
 class PasswordEntryAdmin(admin.ModelAdmin):
     form = PasswordEntryForm
     list_display = ('service_name', 'username', 'category', 'service_url_link', 'created_at', 'updated_at')
-    list_filter = ('category', 'created_at', 'updated_at')
-    search_fields = ('service_name', 'username', 'category__name')
+    list_filter = (CategoryListFilter, 'created_at', 'updated_at')
+    list_select_related = ('category__user',)
+    # Counting rows per filter choice would scan the table for every choice
+    show_facets = admin.ShowFacets.NEVER
+    show_full_result_count = False
+    # Used only where the full-text index is unavailable, see get_search_results()
+    search_fields = ('service_name', 'username', 'service_url', 'comments', 'category__name')
     fields = ('category', 'service_name', 'service_url', 'username', 'password', 'comments', 'created_at', 'updated_at')
     readonly_fields = ('created_at', 'updated_at')
 
@@ -101,6 +213,63 @@ class PasswordEntryAdmin(admin.ModelAdmin):
             return qs
         return qs.filter(user=request.user)
 
+    def get_search_results(self, request, queryset, search_term):
+        results = fulltext.search(queryset, search_term)
+        if results is None:
+            return super().get_search_results(request, queryset, search_term)
+        return results, False
+
+    def get_changelist(self, request, **kwargs):
+        return EntryChangeList
+
+    def get_urls(self):
+        urls = [
+            path(
+                '<path:object_id>/reveal/',
+                # Masked previews load with every change form, so only reveals are charged
+                self.admin_site.admin_view(
+                    rate_limited('fetch_data', cost=lambda request: 1 if request.POST.get('reveal') else 0)(
+                        self.reveal_view
+                    )
+                ),
+                name='passwords_passwordentry_reveal',
+            ),
+        ]
+        return urls + super().get_urls()
+
+    def reveal_view(self, request, object_id):
+        """The masked current password of an entry, or all of it with reveal=1
+
+        A reveal counts against the session's request limit, as fetch_data does.
+        """
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        entry = self.get_object(request, object_id)
+        if entry is None or not self.has_change_permission(request, entry):
+            return JsonResponse({'error': 'Entry not found'}, status=404)
+        reveal = request.POST.get('reveal')
+        if not entry.stored_password:
+            return JsonResponse({'password': ''} if reveal else {'masked': ''})
+
+        try:
+            key = get_session_key(request)
+        except KeyRotationInProgress:
+            return JsonResponse(
+                {'error': 'The vault key is being rotated - please try again once it is done'}, status=409
+            )
+        if not key:
+            return JsonResponse({'error': 'Session expired - please log in again'}, status=401)
+        request_limit = getattr(settings, 'PASSWORD_MANAGER_REQUEST_LIMIT', 5)
+        if reveal and not consume_requests(request, 1, request_limit):
+            return JsonResponse({'error': 'You have exceeded the allowed number of requests'}, status=429)
+        password = entry.decrypt_password(key)
+        if not password:
+            return JsonResponse({'error': 'Unable to decrypt current password'}, status=500)
+
+        if reveal:
+            return JsonResponse({'password': password})
+        return JsonResponse({'masked': f"{password[:3]}***"})
+
     def get_form(self, request, obj=None, **kwargs):
         kwargs['form'] = PasswordEntryForm
         form_class = super().get_form(request, obj, **kwargs)
@@ -110,8 +279,10 @@ class PasswordEntryAdmin(admin.ModelAdmin):
                 kwargs['request'] = request
                 return form_class(*args, **kwargs)
 
+        categories = PasswordCategory.objects.select_related('user')
         if not request.user.is_superuser:
-            RequestForm.base_fields['category'].queryset = PasswordCategory.objects.filter(user=request.user)
+            categories = categories.filter(user=request.user)
+        form_class.base_fields['category'].queryset = categories
 
         return RequestForm
 
@@ -128,8 +299,9 @@ class PasswordEntryAdmin(admin.ModelAdmin):
 
 @admin.register(UserEncryptionProfile)
 class UserEncryptionProfileAdmin(admin.ModelAdmin):
-    list_display = ('user', 'created_at')
-    readonly_fields = ('salt', 'created_at')
+    list_display = ('user', 'kdf_algorithm', 'created_at')
+    list_select_related = ('user',)
+    readonly_fields = ('salt', 'kdf_algorithm', 'kdf_params', 'wrapped_key', 'key_generation', 'created_at')
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
@@ -0,0 +1,356 @@
+"""Local key agent holding unlocked vault keys for every worker and command
+
+Like ssh-agent, ``manage.py key_agent`` listens on a Unix socket
+(PASSWORD_MANAGER_KEY_AGENT_SOCKET) and keeps the data keys it has unlocked
+in memory, each forgotten after PASSWORD_MANAGER_KEY_AGENT_TTL seconds
+without use. Keys never leave the agent: clients send values to encrypt or
+decrypt. A user's key is derived once, at their first login, then shared
+by all gunicorn workers and management commands. The agent remembers which
+sessions unlocked it, so logging out of one session leaves the others
+working; the key is forgotten once the last of them logs out.
+
+Anyone who can connect to the socket can use the keys it holds, so it is
+created readable by its owner only, and connections from other users are
+refused.
+
+The protocol is one JSON object per line each way: a request
+``{"op": ..., "user": <id>, ...}`` and a response that is either
+``{"ok": true, ...}`` or ``{"ok": false, "error": ...}``. Encryption,
+decryption and fingerprinting take lists, so that a batch of values costs
+one round trip.
+"""
+from collections import OrderedDict
+import base64
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+from django.conf import settings
+
+from .crypto import fingerprints, unwrap_key
+from .kdf import configured_kdf, derive_key
+
+
+class AgentError(Exception):
+    """The agent refused a request, or could not be reached"""
+
+
+class KeyAgent:
+    """The agent's state: data keys by user id, least recently used first out
+
+    Each key also maps the sessions it was unlocked for to their expiry,
+    which slides like the key's own when a session uses it.
+    """
+
+    def __init__(self, ttl=3600, max_keys=1024):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._keys = OrderedDict()  # user_id -> (key, generation, expires_at, {session: expires_at})
+        self._lock = threading.Lock()
+
+    def _get(self, user_id, session=None):
+        """Return (key, generation) held for a user, or None
+
+        With a session, None unless the key was unlocked for that session.
+        """
+        with self._lock:
+            item = self._keys.get(user_id)
+            if item is None:
+                return None
+            key, generation, expires_at, sessions = item
+            now = time.monotonic()
+            if expires_at <= now:
+                del self._keys[user_id]
+                return None
+            if session is not None:
+                if sessions.get(session, 0) <= now:
+                    sessions.pop(session, None)
+                    return None
+                sessions[session] = now + self.ttl
+            self._keys[user_id] = (key, generation, now + self.ttl, sessions)
+            self._keys.move_to_end(user_id)
+            return key, generation
+
+    def _store(self, user_id, key, generation, session):
+        with self._lock:
+            now = time.monotonic()
+            item = self._keys.get(user_id)
+            # Sessions of a replaced generation must unlock again
+            sessions = item[3] if item is not None and item[1] == generation else {}
+            if session is not None:
+                sessions[session] = now + self.ttl
+            self._keys[user_id] = (key, generation, now + self.ttl, sessions)
+            self._keys.move_to_end(user_id)
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+
+    def _require(self, user_id):
+        held = self._get(user_id)
+        if held is None:
+            raise AgentError('locked')
+        return held[0]
+
+    def unlock(self, user_id, session, password, salt, kdf_algorithm, kdf_params, wrapped_key, generation):
+        """Unwrap a user's data key with their password for a session, unless that generation of it is already held
+
+        The caller sends the profile's KDF settings and wrapped key, so the
+        agent needs no database. The password is only checked when the key
+        is not held yet: being able to connect is what grants its use.
+        """
+        held = self._get(user_id)
+        if held is not None and held[1] == generation:
+            key = held[0]
+        else:
+            try:
+                key = unwrap_key(derive_key(password, salt, kdf_algorithm, kdf_params), wrapped_key)
+            except InvalidToken:
+                raise AgentError('cannot unlock the vault with this password')
+        self._store(user_id, key, generation, session)
+        return {}
+
+    def status(self, user_id, session):
+        held = self._get(user_id, session)
+        return {'unlocked': held is not None, 'generation': held and held[1]}
+
+    def lock(self, user_id, session):
+        """Forget a session, and the key once no live session is left; without a session, forget the key"""
+        with self._lock:
+            item = self._keys.get(user_id)
+            if item is None:
+                return {}
+            if session is not None:
+                sessions = item[3]
+                sessions.pop(session, None)
+                now = time.monotonic()
+                for expired in [s for s, expires_at in sessions.items() if expires_at <= now]:
+                    del sessions[expired]
+                if sessions:
+                    return {}
+            del self._keys[user_id]
+        return {}
+
+    def encrypt(self, user_id, values):
+        cipher = Fernet(self._require(user_id))
+        return {'values': [cipher.encrypt(base64.b64decode(value)).decode() for value in values]}
+
+    def decrypt(self, user_id, values):
+        """Decrypt each token, with null for tokens this key cannot decrypt"""
+        cipher = Fernet(self._require(user_id))
+        decrypted = []
+        for value in values:
+            try:
+                decrypted.append(base64.b64encode(cipher.decrypt(value.encode())).decode())
+            except InvalidToken:
+                decrypted.append(None)
+        return {'values': decrypted}
+
+    def fingerprint(self, user_id, value_lists):
+        return {'fingerprints': fingerprints(self._require(user_id), value_lists)}
+
+    OPERATIONS = {
+        'unlock': ('session', 'password', 'salt', 'kdf_algorithm', 'kdf_params', 'wrapped_key', 'generation'),
+        'status': ('session',),
+        'lock': ('session',),
+        'encrypt': ('values',),
+        'decrypt': ('values',),
+        'fingerprint': ('value_lists',),
+    }
+
+    def handle(self, request):
+        """Run one decoded request and return the response to send"""
+        try:
+            op = request['op']
+            args = [request[name] for name in self.OPERATIONS[op]]
+            return {'ok': True, **getattr(self, op)(request['user'], *args)}
+        except (KeyError, TypeError, ValueError):
+            return {'ok': False, 'error': 'bad request'}
+        except AgentError as e:
+            return {'ok': False, 'error': str(e)}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        if not self.server.peer_allowed(self.request):
+            return
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {'ok': False, 'error': 'bad request'}
+            else:
+                response = self.server.agent.handle(request)
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, agent):
+        self.agent = agent
+        if os.path.exists(path):
+            os.unlink(path)  # Left behind by an agent that did not shut down cleanly
+        # Owner-only from the start, not chmod()ed after bind()
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def peer_allowed(self, connection):
+        """Only the agent's own OS user may connect, where the platform says who is calling"""
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', credentials)
+        return uid == os.getuid()
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class AgentClient:
+    """Connection to the agent, one socket per thread"""
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        return sock, sock.makefile('rb')
+
+    def call(self, op, user_id, **params):
+        request = json.dumps({'op': op, 'user': user_id, **params}).encode() + b'\n'
+        # Retry once on a fresh connection, in case the agent was restarted
+        for attempt in range(2):
+            if getattr(self._local, 'connection', None) is None:
+                try:
+                    self._local.connection = self._connect()
+                except OSError as e:
+                    raise AgentError(f'cannot reach the key agent: {e}')
+            sock, reader = self._local.connection
+            try:
+                sock.sendall(request)
+                line = reader.readline()
+                if not line:
+                    raise ConnectionError('connection closed')
+                break
+            except OSError as e:
+                self.close()
+                if attempt:
+                    raise AgentError(f'cannot reach the key agent: {e}')
+        response = json.loads(line)
+        if not response.pop('ok'):
+            raise AgentError(response['error'])
+        return response
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection[0].close()
+            self._local.connection = None
+
+    def unlock(self, profile, password, session=None):
+        """Make the agent hold the key of a profile with a wrapped key for a session
+
+        Raises AgentError if the password is wrong.
+        """
+        algorithm, params = profile.kdf_algorithm, profile.kdf_params
+        if not algorithm:
+            algorithm, params = configured_kdf()
+        self.call(
+            'unlock', profile.user_id, session=_session_id(session), password=password, salt=profile.salt,
+            kdf_algorithm=algorithm, kdf_params=params, wrapped_key=profile.wrapped_key,
+            generation=profile.key_generation,
+        )
+        return AgentKey(self, profile.user_id)
+
+    def key_for(self, user_id, generation, session=None):
+        """An AgentKey for the user if the agent holds that generation of their key, else None
+
+        With a session, only if the key was unlocked for that session.
+        """
+        if user_id is None:
+            return None
+        status = self.call('status', user_id, session=_session_id(session))
+        if not status['unlocked'] or status['generation'] != generation:
+            return None
+        return AgentKey(self, user_id)
+
+    def lock(self, user_id, session=None):
+        """Forget a session's hold on the user's key, or the key itself without a session"""
+        self.call('lock', user_id, session=_session_id(session))
+
+
+def _session_id(session_key):
+    """What the agent knows a session by: not the session key, which would let it log in"""
+    if session_key is None:
+        return None
+    return hashlib.sha256(session_key.encode()).hexdigest()
+
+
+class AgentKey:
+    """Stands in for a Fernet key held by the agent: crypto.py calls its Fernet-like methods"""
+
+    def __init__(self, client, user_id):
+        self.client = client
+        self.user_id = user_id
+
+    def encrypt(self, data):
+        return self.encrypt_many([data])[0]
+
+    def encrypt_many(self, data):
+        """Encrypt a list of bytes in one call"""
+        values = [base64.b64encode(item).decode() for item in data]
+        return [token.encode() for token in self.client.call('encrypt', self.user_id, values=values)['values']]
+
+    def decrypt(self, token):
+        data = self.decrypt_many([token])[0]
+        if data is None:
+            raise InvalidToken
+        return data
+
+    def decrypt_many(self, tokens):
+        """Decrypt a list of tokens in one call, with None for those this key cannot decrypt"""
+        tokens = [token.decode() if isinstance(token, bytes) else token for token in tokens]
+        values = self.client.call('decrypt', self.user_id, values=tokens)['values']
+        return [base64.b64decode(value) if value is not None else None for value in values]
+
+    def fingerprints(self, value_lists):
+        return self.client.call('fingerprint', self.user_id, value_lists=value_lists)['fingerprints']
+
+    def __reduce__(self):
+        # Process pool workers open their own connection
+        return _agent_key, (self.client.path, self.user_id)
+
+
+def _agent_key(path, user_id):
+    return AgentKey(AgentClient(path), user_id)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_agent():
+    """The client for PASSWORD_MANAGER_KEY_AGENT_SOCKET, or None if no agent is configured"""
+    global _client
+    path = getattr(settings, 'PASSWORD_MANAGER_KEY_AGENT_SOCKET', None)
+    if not path:
+        return None
+    with _client_lock:
+        if _client is None or _client.path != str(path):
+            _client = AgentClient(str(path))
+        return _client
@@ -0,0 +1,229 @@
+"""Chunked vault archives for export_vault and restore_vault
+
+An archive is a magic line followed by chunks. Each chunk is a header
+holding the payload length and the SHA-256 of the payload, then the
+payload itself: zlib-compressed JSON with the records of one kind. A
+zero-length chunk ends the archive. Entries are exported still
+encrypted, so restoring needs no user password, only the same users.
+"""
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+import base64
+import hashlib
+import json
+import struct
+import time
+import zlib
+
+from .crypto import to_binary
+from .models import PasswordCategory, PasswordEntry, UserEncryptionProfile, VaultKeyRotation
+
+MAGIC = b'PMVAULT1\n'
+PROFILE, CATEGORY, ENTRY = 'profile', 'category', 'entry'
+
+_CHUNK_HEADER = struct.Struct('>I32s')
+
+ENTRY_FIELDS = ('category_id', 'service_name', 'service_url', 'username', 'comments', 'fingerprint')
+
+
+class ArchiveError(Exception):
+    """Raised for a corrupt archive or one that cannot be restored"""
+
+
+class Throughput:
+    """Counts records and bytes, calling ``report`` at most once per ``interval`` seconds"""
+
+    def __init__(self, report=None, interval=1.0):
+        self.report = report
+        self.interval = interval
+        self.records = 0
+        self.bytes = 0
+        self.started = self.reported = time.perf_counter()
+
+    def add(self, records, size):
+        self.records += records
+        self.bytes += size
+        now = time.perf_counter()
+        if self.report and now - self.reported >= self.interval:
+            self.reported = now
+            self.report(self)
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def rates(self):
+        """Return (records/s, MB/s) so far"""
+        elapsed = self.elapsed or 1e-9
+        return self.records / elapsed, self.bytes / elapsed / 1e6
+
+
+class ArchiveWriter:
+    """Buffer records of one kind at a time and write them out in chunks"""
+
+    def __init__(self, f, chunk_size=1000, throughput=None):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.throughput = throughput or Throughput()
+        self._kind = None
+        self._records = []
+        f.write(MAGIC)
+
+    def write(self, kind, record):
+        if kind != self._kind:
+            self.flush()
+            self._kind = kind
+        self._records.append(record)
+        if len(self._records) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._records:
+            return
+        payload = zlib.compress(json.dumps({'kind': self._kind, 'records': self._records}).encode())
+        self.f.write(_CHUNK_HEADER.pack(len(payload), hashlib.sha256(payload).digest()))
+        self.f.write(payload)
+        self.throughput.add(len(self._records), _CHUNK_HEADER.size + len(payload))
+        self._records = []
+
+    def close(self):
+        self.flush()
+        self.f.write(_CHUNK_HEADER.pack(0, b'\0' * 32))
+
+
+def read_chunks(f, throughput=None):
+    """Yield (kind, records) for each chunk, verifying its checksum"""
+    throughput = throughput or Throughput()
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ArchiveError("Not a vault archive")
+
+    index = 0
+    while True:
+        header = f.read(_CHUNK_HEADER.size)
+        if len(header) < _CHUNK_HEADER.size:
+            raise ArchiveError("Archive is truncated")
+        length, checksum = _CHUNK_HEADER.unpack(header)
+        if length == 0:
+            return
+
+        payload = f.read(length)
+        if len(payload) < length:
+            raise ArchiveError("Archive is truncated")
+        if hashlib.sha256(payload).digest() != checksum:
+            raise ArchiveError(f"Checksum mismatch in chunk {index}")
+
+        chunk = json.loads(zlib.decompress(payload))
+        throughput.add(len(chunk['records']), _CHUNK_HEADER.size + length)
+        yield chunk['kind'], chunk['records']
+        index += 1
+
+
+def export_vaults(users, writer, chunk_size=1000):
+    """Stream the profiles, categories and entries of ``users`` to an ArchiveWriter"""
+    for user in users.order_by('pk').iterator():
+        profile = UserEncryptionProfile.objects.filter(user=user).first()
+        if profile is not None:
+            writer.write(PROFILE, {
+                'user': user.username,
+                'salt': profile.salt,
+                'kdf_algorithm': profile.kdf_algorithm,
+                'kdf_params': profile.kdf_params,
+                'wrapped_key': profile.wrapped_key,
+            })
+
+        categories = PasswordCategory.objects.filter(user=user).order_by('pk').values_list('pk', 'name')
+        for category_id, name in categories.iterator(chunk_size=chunk_size):
+            writer.write(CATEGORY, {'user': user.username, 'id': category_id, 'name': name})
+
+        entries = (
+            PasswordEntry.objects.filter(user=user).order_by('pk')
+            .values_list(*ENTRY_FIELDS, 'ciphertext', 'encrypted_password')
+        )
+        for *values, ciphertext, legacy in entries.iterator(chunk_size=chunk_size):
+            record = dict(zip(ENTRY_FIELDS, values), user=user.username)
+            stored = ciphertext or legacy
+            record['ciphertext'] = base64.b64encode(to_binary(stored)).decode() if stored else ''
+            writer.write(ENTRY, record)
+
+    writer.close()
+
+
+class _Restore:
+    """State kept while restoring: users seen so far and category id mapping"""
+
+    def __init__(self, replace, batch_size):
+        self.replace = replace
+        self.batch_size = batch_size
+        self.users = {}
+        self.categories = {}  # Archived category id -> restored category id
+
+    def user(self, username):
+        user = self.users.get(username)
+        if user is not None:
+            return user
+
+        try:
+            user = User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise ArchiveError(f"User not found: {username}. Please create the user first.")
+
+        if PasswordCategory.objects.filter(user=user).exists():
+            if not self.replace:
+                raise ArchiveError(f"{username} already has a vault; use --replace to overwrite it")
+            PasswordCategory.objects.filter(user=user).delete()  # Cascades to entries
+        VaultKeyRotation.objects.filter(user=user).delete()
+
+        self.users[username] = user
+        return user
+
+    def restore_profiles(self, records):
+        for record in records:
+            user = self.user(record.pop('user'))
+            # The archived data key may differ, so keys unlocked before are retired
+            profiles = UserEncryptionProfile.objects.filter(user=user)
+            if not profiles.update(**record, key_generation=F('key_generation') + 1):
+                UserEncryptionProfile.objects.create(user=user, **record)
+
+    def restore_categories(self, records):
+        categories = [
+            PasswordCategory(user=self.user(record['user']), name=record['name'])
+            for record in records
+        ]
+        PasswordCategory.objects.bulk_create(categories, batch_size=self.batch_size)
+        for record, category in zip(records, categories):
+            self.categories[record['id']] = category.pk
+
+    def restore_entries(self, records):
+        entries = []
+        for record in records:
+            user = self.user(record.pop('user'))
+            try:
+                record['category_id'] = self.categories[record['category_id']]
+            except KeyError:
+                raise ArchiveError(f"Entry {record['service_name']} refers to a missing category")
+            record['ciphertext'] = base64.b64decode(record['ciphertext'])
+            entries.append(PasswordEntry(user=user, **record))
+        PasswordEntry.objects.bulk_create(entries, batch_size=self.batch_size)
+
+
+def restore_vaults(f, replace=False, batch_size=500, throughput=None):
+    """Restore an archive in one transaction; returns the restored usernames
+
+    Existing vaults are refused unless ``replace`` is set, in which case
+    they are deleted first.
+    """
+    restore = _Restore(replace, batch_size)
+    handlers = {
+        PROFILE: restore.restore_profiles,
+        CATEGORY: restore.restore_categories,
+        ENTRY: restore.restore_entries,
+    }
+
+    with transaction.atomic():
+        for kind, records in read_chunks(f, throughput):
+            if kind not in handlers:
+                raise ArchiveError(f"Unknown record kind: {kind}")
+            handlers[kind](records)
+
+    return list(restore.users)
@@ -0,0 +1,350 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+import asyncio
+import os
+import tempfile
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import AsyncClient, Client
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from .agent import AgentServer, KeyAgent
+from .models import PasswordCategory, PasswordEntry, UserEncryptionProfile
+
+BENCH_USERNAME = 'bench'
+BENCH_PASSWORD = 'bench-password'
+
+
+@contextmanager
+def temporary_database():
+    """Run inside a throwaway on-disk SQLite test database
+
+    A file (rather than the in-memory default) lets several threads use
+    the database concurrently.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for alias in connections:
+            test_settings = connections[alias].settings_dict.setdefault('TEST', {})
+            test_settings['NAME'] = os.path.join(tmpdir, f'bench-{alias}.sqlite3')
+
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            yield
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+
+
+@contextmanager
+def temporary_agent():
+    """Run a key agent in a thread on a temporary socket, and use it"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'agent.sock')
+        server = AgentServer(path, KeyAgent())
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            with override_settings(PASSWORD_MANAGER_KEY_AGENT_SOCKET=path):
+                yield server
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def create_vault(entries, username=BENCH_USERNAME, password=BENCH_PASSWORD):
+    """Create a user with ``entries`` encrypted entries; return the user"""
+    user = User.objects.create_user(username, password=password)
+    category = PasswordCategory.objects.create(user=user, name='personal')
+    key = UserEncryptionProfile.get_or_create_for_user(user).unlock(password)
+
+    batch = []
+    for i in range(entries):
+        entry = PasswordEntry(
+            category=category,
+            user=user,
+            service_name=f'service-{i:06d}',
+            service_url=f'https://service-{i}.example.com',
+            username=f'user-{i}',
+        )
+        entry.encrypt_password(f'password-{i}', key)
+        batch.append(entry)
+    PasswordEntry.objects.bulk_create(batch, batch_size=1000)
+    return user
+
+
+def _summary(results):
+    """Aggregate (durations, started, finished) tuples from each client"""
+    durations = sorted(d for client_durations, _, _ in results for d in client_durations)
+    elapsed = max(r[2] for r in results) - min(r[1] for r in results)
+    return {
+        'requests': len(durations),
+        'elapsed_s': round(elapsed, 4),
+        'throughput_rps': round(len(durations) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(durations[len(durations) // 2] * 1000, 2),
+        'p95_ms': round(durations[int(len(durations) * 0.95) - 1] * 1000, 2),
+        'max_ms': round(durations[-1] * 1000, 2),
+    }
+
+
+def _wsgi_worker(requests, service_names):
+    client = Client()
+    client.post('/check_login/', {'login': BENCH_USERNAME, 'password': BENCH_PASSWORD})
+    durations = []
+    started_all = time.perf_counter()
+    for i in range(requests):
+        started = time.perf_counter()
+        response = client.post('/fetch_data/', {'item': service_names[i % len(service_names)]})
+        durations.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.content
+    return durations, started_all, time.perf_counter()
+
+
+def load_test_wsgi(requests, concurrency, service_names):
+    """Fetch entries through the sync views with one thread per client"""
+    per_client = max(1, requests // concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(_wsgi_worker, [per_client] * concurrency, [service_names] * concurrency))
+    return _summary(results)
+
+
+async def _asgi_worker(requests, service_names):
+    client = AsyncClient()
+    await client.post('/check_login/', {'login': BENCH_USERNAME, 'password': BENCH_PASSWORD})
+    durations = []
+    started_all = time.perf_counter()
+    for i in range(requests):
+        started = time.perf_counter()
+        response = await client.post('/async/fetch_data/', {'item': service_names[i % len(service_names)]})
+        durations.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.content
+    return durations, started_all, time.perf_counter()
+
+
+def load_test_asgi(requests, concurrency, service_names):
+    """Fetch entries through the async views with concurrent tasks on one event loop"""
+    per_client = max(1, requests // concurrency)
+
+    async def run():
+        return await asyncio.gather(*(_asgi_worker(per_client, service_names) for _ in range(concurrency)))
+
+    return _summary(asyncio.run(run()))
+
+
+def compare_fetch_throughput(requests=200, concurrency=8, entries=100, key_agent=False):
+    """Compare fetch_data throughput between the WSGI and ASGI paths
+
+    With ``key_agent`` keys are held by a key agent, so every decryption is
+    a round trip to it, as with several worker processes.
+    """
+    create_vault(entries)
+    service_names = list(PasswordEntry.objects.values_list('service_name', flat=True))
+    with temporary_agent() if key_agent else nullcontext():
+        with override_settings(PASSWORD_MANAGER_REQUEST_LIMIT=0, PASSWORD_MANAGER_RATE_LIMITS={}):
+            return {
+                'wsgi': load_test_wsgi(requests, concurrency, service_names),
+                'asgi': load_test_asgi(requests, concurrency, service_names),
+            }
+
+
+SESSION_CONFIGS = {
+    # The previous setup: database sessions holding the fetch counter
+    'db+session_counter': {
+        'SESSION_ENGINE': 'django.contrib.sessions.backends.db',
+        'PASSWORD_MANAGER_REQUEST_COUNTER': 'session',
+    },
+    'db': {'SESSION_ENGINE': 'django.contrib.sessions.backends.db'},
+    'cached_db': {'SESSION_ENGINE': 'django.contrib.sessions.backends.cached_db'},
+    'cache': {'SESSION_ENGINE': 'django.contrib.sessions.backends.cache'},
+    # Counting in a local memory cache: per process, so only for a single worker
+    'cache+cache_counter': {
+        'SESSION_ENGINE': 'django.contrib.sessions.backends.cache',
+        'PASSWORD_MANAGER_REQUEST_COUNTER': 'cache',
+    },
+}
+
+
+def compare_session_engines(requests=200, concurrency=8, entries=100, configs=None):
+    """Compare fetch_data throughput across session engines and counter stores
+
+    Sessions use a file cache in a temporary directory, as configured in
+    settings.py; counters are kept in the database unless overridden.
+    """
+    from django.conf import settings
+
+    create_vault(entries)
+    service_names = list(PasswordEntry.objects.values_list('service_name', flat=True))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        caches_setting = {
+            **settings.CACHES,
+            'sessions': {**settings.CACHES['sessions'], 'LOCATION': tmpdir},
+        }
+        for name, overrides in (configs or SESSION_CONFIGS).items():
+            with override_settings(
+                CACHES=caches_setting, PASSWORD_MANAGER_REQUEST_LIMIT=0, PASSWORD_MANAGER_RATE_LIMITS={}, **overrides
+            ):
+                results[name] = load_test_wsgi(requests, concurrency, service_names)
+    return results
+
+
+def _timed(func, repeat):
+    """Return per-call durations of func() over ``repeat`` calls"""
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def _latency(durations):
+    durations = sorted(durations)
+    return {
+        'calls': len(durations),
+        'mean_ms': round(sum(durations) / len(durations) * 1000, 3),
+        'p50_ms': round(durations[len(durations) // 2] * 1000, 3),
+        'p95_ms': round(durations[max(0, int(len(durations) * 0.95) - 1)] * 1000, 3),
+    }
+
+
+def bench_key_derivation(iteration_counts=(10000, 100000, 600000), repeat=3):
+    """Key derivation time: PBKDF2-SHA256 at several iteration counts, scrypt
+    and Argon2id at their default parameters, and the configured profile KDF"""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+    results = {}
+    for iterations in iteration_counts:
+        def derive():
+            PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=b'0' * 44, iterations=iterations).derive(b'password')
+        results[str(iterations)] = _latency(_timed(derive, repeat))
+
+    from .kdf import ARGON2ID, DEFAULT_PARAMS, SCRYPT, derive_key, is_available
+    salt = UserEncryptionProfile.generate_salt()  # Argon2id needs at least 8 bytes
+    for algorithm in (SCRYPT, ARGON2ID):
+        if is_available(algorithm):
+            params = DEFAULT_PARAMS[algorithm]
+            results[algorithm] = _latency(_timed(lambda: derive_key('password', salt, algorithm, params), repeat))
+
+    profile = UserEncryptionProfile(salt=UserEncryptionProfile.generate_salt())
+    results['profile'] = _latency(_timed(lambda: profile.derive_key_from_password('password'), repeat))
+    return results
+
+
+def bench_entry_crypto(count=2000):
+    """encrypt_password/decrypt_password throughput with a ready key"""
+    profile = UserEncryptionProfile(salt=UserEncryptionProfile.generate_salt())
+    key = profile.derive_key_from_password('password')
+    entries = [PasswordEntry() for _ in range(count)]
+
+    started = time.perf_counter()
+    for i, entry in enumerate(entries):
+        entry.encrypt_password(f'password-{i}', key)
+    encrypt_elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for entry in entries:
+        entry.decrypt_password(key)
+    decrypt_elapsed = time.perf_counter() - started
+
+    return {
+        'count': count,
+        'encrypt_ops_per_s': round(count / encrypt_elapsed, 1),
+        'decrypt_ops_per_s': round(count / decrypt_elapsed, 1),
+    }
+
+
+def write_import_file(path, entries):
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(entries):
+            f.write(f'Service{i}:\nwww.service{i}.example.com\nlogin{i}\npassword{i}\n\n')
+
+
+def bench_import(sizes=(1000, 10000, 100000), workers=1):
+    """Run import_passwords on generated files of each size"""
+    from io import StringIO
+    from django.core.management import call_command
+
+    user = User.objects.create_user('bench-import', password=BENCH_PASSWORD)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in sizes:
+            path = os.path.join(tmpdir, f'import-{size}.txt')
+            write_import_file(path, size)
+
+            started = time.perf_counter()
+            call_command(
+                'import_passwords', file=path, username=user.username, password=BENCH_PASSWORD,
+                workers=workers, stdout=StringIO(),
+            )
+            elapsed = time.perf_counter() - started
+
+            imported = PasswordEntry.objects.filter(user=user).count()
+            results[str(size)] = {
+                'imported': imported,
+                'elapsed_s': round(elapsed, 3),
+                'entries_per_s': round(imported / elapsed, 1),
+            }
+            PasswordEntry.objects.filter(user=user).delete()
+    return results
+
+
+def _request_stats(client, method, path, data=None, repeat=20):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    durations = []
+    queries = 0
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            response = getattr(client, method)(path, data or {})
+            durations.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.content
+        queries = len(context)
+    stats = _latency(durations)
+    stats['queries'] = queries
+    return stats
+
+
+def bench_requests(entries=1000, repeat=20):
+    """Latency and query counts of the legacy UI endpoints through the test client"""
+    create_vault(entries)
+    client = Client()
+    client.post('/check_login/', {'login': BENCH_USERNAME, 'password': BENCH_PASSWORD})
+
+    with override_settings(PASSWORD_MANAGER_REQUEST_LIMIT=0, PASSWORD_MANAGER_RATE_LIMITS={}):
+        return {
+            'entries': entries,
+            'index_view': _request_stats(client, 'get', '/', repeat=repeat),
+            'service_names': _request_stats(client, 'get', '/services/', repeat=repeat),
+            'fetch_data': _request_stats(client, 'post', '/fetch_data/', {'item': 'service-000001'}, repeat=repeat),
+        }
+
+
+def run_benchmarks(import_sizes=(1000, 10000, 100000), request_entries=1000, kdf_iterations=(10000, 100000, 600000)):
+    """Run the whole suite and return a JSON-serialisable report"""
+    import platform
+    import django
+    import cryptography
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'cryptography': cryptography.__version__,
+            'machine': platform.machine(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'key_derivation': bench_key_derivation(kdf_iterations),
+        'entry_crypto': bench_entry_crypto(),
+        'import': bench_import(import_sizes),
+        'requests': bench_requests(request_entries),
+        'sessions': compare_session_engines(),
+    }
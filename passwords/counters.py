@@ -0,0 +1,152 @@
+"""Per-session fetch counters kept outside the session
+
+Counting fetches in the session made every fetch rewrite the whole
+session. PASSWORD_MANAGER_REQUEST_COUNTER picks where they are counted:
+
+- ``db``: a RateLimitCounter row per session, checked and incremented in
+  a single UPDATE, so the limit holds across all worker processes
+- ``cache``: the PASSWORD_MANAGER_REQUEST_COUNTER_CACHE cache, whose incr()
+  is atomic on Redis and Memcached. A local memory cache counts per
+  process, letting N workers allow N times the limit.
+- ``session``: in the session, as before
+"""
+from datetime import timedelta
+import random
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import RateLimitCounter
+
+CACHE_KEY = 'passwords:requests:{}'
+
+DB, CACHE, SESSION = 'db', 'cache', 'session'
+
+
+def _store():
+    store = getattr(settings, 'PASSWORD_MANAGER_REQUEST_COUNTER', DB)
+    if store not in (DB, CACHE, SESSION):
+        raise ImproperlyConfigured(f"Unknown request counter store: {store}")
+    return store
+
+
+def _counter_cache():
+    return caches[getattr(settings, 'PASSWORD_MANAGER_REQUEST_COUNTER_CACHE', 'default')]
+
+
+def _cache_key(request):
+    return CACHE_KEY.format(request.session.session_key)
+
+
+def _consume_in_db(key, cost, limit):
+    now = timezone.now()
+    # The counter lives as long as the session, which slides on each request
+    expires_at = now + timedelta(seconds=settings.SESSION_COOKIE_AGE)
+    live = RateLimitCounter.objects.filter(key=key, expires_at__gt=now)
+    within_limit = live.filter(count__lte=limit - cost) if limit else live
+    for _ in range(2):
+        # Checked and charged in one statement, so concurrent fetches cannot both take the last one
+        if within_limit.update(count=F('count') + cost, expires_at=expires_at):
+            return True
+        if live.exists() or (limit and cost > limit):
+            return False
+        try:
+            with transaction.atomic():
+                if random.random() < 0.01:
+                    RateLimitCounter.objects.filter(expires_at__lte=now).delete()
+                RateLimitCounter.objects.filter(key=key).delete()  # Expired
+                RateLimitCounter.objects.create(key=key, count=cost, expires_at=expires_at)
+            return True
+        except IntegrityError:  # Created concurrently: charge that one
+            continue
+    return False
+
+
+def _consume_in_cache(cache, key, cost, limit):
+    timeout = settings.SESSION_COOKIE_AGE
+    cache.add(key, 0, timeout)
+    try:
+        count = cache.incr(key, cost)
+    except ValueError:  # Expired between add() and incr()
+        cache.add(key, 0, timeout)
+        count = cache.incr(key, cost)
+
+    if limit and count > limit:
+        cache.decr(key, cost)
+        return False
+    # The counter lives as long as the session, which slides on each request
+    cache.touch(key, timeout)
+    return True
+
+
+def consume_requests(request, cost, limit):
+    """Charge ``cost`` fetches to the session; False if that would exceed ``limit``
+
+    A limit of 0 means unlimited.
+    """
+    store = _store()
+    if store == SESSION:
+        nb_req = request.session.get('nb_req', 0)
+        if limit and nb_req + cost > limit:
+            return False
+        request.session['nb_req'] = nb_req + cost
+        return True
+    if store == DB:
+        return _consume_in_db(_cache_key(request), cost, limit)
+    return _consume_in_cache(_counter_cache(), _cache_key(request), cost, limit)
+
+
+async def aconsume_requests(request, cost, limit):
+    """Async consume_requests()"""
+    store = _store()
+    if store == SESSION:
+        nb_req = await request.session.aget('nb_req', 0)
+        if limit and nb_req + cost > limit:
+            return False
+        await request.session.aset('nb_req', nb_req + cost)
+        return True
+    if store == DB:
+        return await sync_to_async(_consume_in_db)(_cache_key(request), cost, limit)
+
+    cache = _counter_cache()
+    key = _cache_key(request)
+    timeout = settings.SESSION_COOKIE_AGE
+    await cache.aadd(key, 0, timeout)
+    try:
+        count = await cache.aincr(key, cost)
+    except ValueError:
+        await cache.aadd(key, 0, timeout)
+        count = await cache.aincr(key, cost)
+
+    if limit and count > limit:
+        await cache.adecr(key, cost)
+        return False
+    await cache.atouch(key, timeout)
+    return True
+
+
+def reset_requests(request):
+    """Start counting from zero, e.g. on login"""
+    store = _store()
+    if store == SESSION:
+        request.session['nb_req'] = 0
+    elif store == DB:
+        RateLimitCounter.objects.filter(key=_cache_key(request)).delete()
+    else:
+        _counter_cache().set(_cache_key(request), 0, settings.SESSION_COOKIE_AGE)
+
+
+def clear_requests(request):
+    """Forget the session's counter, e.g. on logout"""
+    store = _store()
+    if store == SESSION or not request.session.session_key:
+        return
+    if store == DB:
+        RateLimitCounter.objects.filter(key=_cache_key(request)).delete()
+    else:
+        _counter_cache().delete(_cache_key(request))
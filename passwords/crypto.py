@@ -0,0 +1,119 @@
+from cryptography.fernet import Fernet, InvalidToken
+import base64
+import hashlib
+import hmac
+import json
+
+# Stored ciphertext is a version byte followed by the raw (not base64) Fernet
+# token. The legacy format, still read during rollout, is the base64 text of
+# the base64 Fernet token.
+STORAGE_V1 = 1
+
+
+def _is_raw(key):
+    return isinstance(key, (bytes, str))
+
+
+def _cipher(key):
+    """A Fernet for a raw key; keys held by the key agent already behave like one"""
+    return Fernet(key) if _is_raw(key) else key
+
+
+def _to_stored(token):
+    return bytes([STORAGE_V1]) + base64.urlsafe_b64decode(token)
+
+
+def encrypt_value(key, plaintext):
+    """Encrypt a string with a Fernet key and return the stored binary form"""
+    return _to_stored(_cipher(key).encrypt(plaintext.encode()))
+
+
+def encrypt_values(key, plaintexts):
+    """encrypt_value() for a list of strings, in one call for a key held by the key agent"""
+    if _is_raw(key):
+        cipher = Fernet(key)
+        return [_to_stored(cipher.encrypt(plaintext.encode())) for plaintext in plaintexts]
+    return [_to_stored(token) for token in key.encrypt_many([plaintext.encode() for plaintext in plaintexts])]
+
+
+def decrypt_value(key, stored):
+    """Decrypt a value produced by encrypt_value, or a legacy text value
+
+    Raises cryptography.fernet.InvalidToken if the key does not match.
+    """
+    return _cipher(key).decrypt(_fernet_token(stored)).decode()
+
+
+def decrypt_values(key, stored_values):
+    """decrypt_value() for a list, with None for values that cannot be decrypted
+
+    Takes one call for a key held by the key agent.
+    """
+    tokens = []
+    for stored in stored_values:
+        try:
+            tokens.append(_fernet_token(stored))
+        except ValueError:
+            tokens.append(None)
+
+    if _is_raw(key):
+        cipher = Fernet(key)
+        plaintexts = []
+        for token in tokens:
+            try:
+                plaintexts.append(cipher.decrypt(token) if token is not None else None)
+            except InvalidToken:
+                plaintexts.append(None)
+    else:
+        decrypted = iter(key.decrypt_many([token for token in tokens if token is not None]))
+        plaintexts = [next(decrypted) if token is not None else None for token in tokens]
+    return [plaintext.decode() if plaintext is not None else None for plaintext in plaintexts]
+
+
+def to_binary(stored):
+    """Convert a legacy text value to the binary form; needs no key"""
+    if isinstance(stored, str):
+        return bytes([STORAGE_V1]) + base64.urlsafe_b64decode(base64.b64decode(stored))
+    return bytes(stored)
+
+
+def to_legacy_text(stored):
+    """Convert a binary value back to the legacy text form"""
+    return base64.b64encode(_fernet_token(stored)).decode()
+
+
+def _fernet_token(stored):
+    if isinstance(stored, str):
+        return base64.b64decode(stored)
+    stored = bytes(stored)  # Some database drivers return memoryview
+    if not stored or stored[0] != STORAGE_V1:
+        raise ValueError("Unknown encrypted value format")
+    return base64.urlsafe_b64encode(stored[1:])
+
+
+def fingerprint(key, values):
+    """Keyed hash of a list of strings, to detect changes without decrypting"""
+    return fingerprints(key, [values])[0]
+
+
+def fingerprints(key, value_lists):
+    """fingerprint() for several lists, in one call for a key held by the key agent"""
+    if not isinstance(key, bytes):
+        return key.fingerprints(value_lists)
+    subkey = hmac.new(key, b'passwords:fingerprint', hashlib.sha256).digest()
+    return [hmac.new(subkey, json.dumps(values).encode(), hashlib.sha256).hexdigest() for values in value_lists]
+
+
+def generate_data_key():
+    """Return a new random Fernet key"""
+    return Fernet.generate_key()
+
+
+def wrap_key(key_encryption_key, data_key):
+    """Encrypt a data key with a password-derived key"""
+    return Fernet(key_encryption_key).encrypt(data_key).decode()
+
+
+def unwrap_key(key_encryption_key, wrapped_key):
+    """Decrypt a wrapped data key; raises InvalidToken for a wrong key"""
+    return Fernet(key_encryption_key).decrypt(wrapped_key.encode())
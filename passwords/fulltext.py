@@ -0,0 +1,80 @@
+"""Ranked full-text search over entries, for the admin changelist
+
+Migration 0012 creates ``passwords_entry_search``: an FTS5 table on SQLite
+or a tsvector table with a GIN index on PostgreSQL, over the service name,
+username, URL, comments and category name of every entry. Database
+triggers keep it in sync. Both index diacritics-free text (with unaccent
+on PostgreSQL), matching terms(). Other databases, and SQLite builds without FTS5,
+have no such table; search() then returns None so callers can fall back
+to LIKE lookups.
+"""
+import re
+
+from django.db import connections
+from django.db.models.expressions import RawSQL
+
+from .search import normalize
+
+TABLE = 'passwords_entry_search'
+
+_WORD = re.compile(r'\w+')
+
+# Lower is better, so that results can be ordered by rank ascending
+_SQLITE_RANK = (
+    'SELECT bm25(passwords_entry_search, 10.0, 5.0, 2.0, 1.0, 5.0) FROM passwords_entry_search '
+    'WHERE passwords_entry_search MATCH %s AND rowid = passwords_passwordentry.id'
+)
+_SQLITE_MATCHES = 'SELECT rowid FROM passwords_entry_search WHERE passwords_entry_search MATCH %s'
+
+_POSTGRESQL_RANK = (
+    "SELECT -ts_rank(document, to_tsquery('simple', %s)) FROM passwords_entry_search "
+    "WHERE entry_id = passwords_passwordentry.id"
+)
+_POSTGRESQL_MATCHES = "SELECT entry_id FROM passwords_entry_search WHERE document @@ to_tsquery('simple', %s)"
+
+_available = {}
+
+
+def is_available(using='default'):
+    """Whether the database has the search table (checked once per database)"""
+    connection = connections[using]
+    cache_key = (using, connection.settings_dict['NAME'])
+    if cache_key not in _available:
+        _available[cache_key] = (
+            connection.vendor in ('sqlite', 'postgresql')
+            and TABLE in connection.introspection.table_names()
+        )
+    return _available[cache_key]
+
+
+def terms(search_term):
+    """The words of a search, lowercased and without diacritics"""
+    return _WORD.findall(normalize(search_term))
+
+
+def build_query(words, vendor):
+    """A query matching entries that contain every word, as a prefix"""
+    if vendor == 'sqlite':
+        return ' '.join(f'"{word}"*' for word in words)
+    return ' & '.join(f'{word}:*' for word in words)
+
+
+def search(queryset, search_term):
+    """Filter an entry queryset to matches of search_term, annotated with search_rank
+
+    Returns None if full-text search is unavailable or the term has no words.
+    """
+    words = terms(search_term)
+    if not words or not is_available(queryset.db):
+        return None
+    vendor = connections[queryset.db].vendor
+    query = build_query(words, vendor)
+    if vendor == 'sqlite':
+        rank, matches = _SQLITE_RANK, _SQLITE_MATCHES
+    else:
+        rank, matches = _POSTGRESQL_RANK, _POSTGRESQL_MATCHES
+    return (
+        queryset
+        .filter(pk__in=RawSQL(matches, [query]))
+        .annotate(search_rank=RawSQL(rank, [query]))
+    )
@@ -0,0 +1,71 @@
+from cryptography.exceptions import UnsupportedAlgorithm
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+import base64
+
+try:
+    from cryptography.hazmat.primitives.kdf.argon2 import Argon2id
+except ImportError:  # cryptography < 44
+    Argon2id = None
+
+PBKDF2_SHA256 = 'pbkdf2_sha256'
+SCRYPT = 'scrypt'
+ARGON2ID = 'argon2id'
+
+KDF_CHOICES = [
+    (PBKDF2_SHA256, 'PBKDF2-SHA256'),
+    (SCRYPT, 'scrypt'),
+    (ARGON2ID, 'Argon2id'),
+]
+
+DEFAULT_PARAMS = {
+    PBKDF2_SHA256: {'iterations': 100000},
+    SCRYPT: {'n': 2 ** 15, 'r': 8, 'p': 1},
+    ARGON2ID: {'iterations': 3, 'lanes': 4, 'memory_cost': 65536},  # memory_cost in KiB
+}
+
+
+def _build(algorithm, params, salt):
+    if algorithm == PBKDF2_SHA256:
+        return PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=params['iterations'])
+    if algorithm == SCRYPT:
+        return Scrypt(salt=salt, length=32, n=params['n'], r=params['r'], p=params['p'])
+    if algorithm == ARGON2ID:
+        if Argon2id is None:
+            raise UnsupportedAlgorithm("Argon2id requires cryptography 44 or later")
+        return Argon2id(
+            salt=salt, length=32,
+            iterations=params['iterations'], lanes=params['lanes'], memory_cost=params['memory_cost'],
+        )
+    raise ValueError(f"Unknown KDF algorithm: {algorithm}")
+
+
+def derive_key(password, salt, algorithm, params):
+    """Derive a urlsafe-base64 Fernet key from a password and a text salt"""
+    kdf = _build(algorithm, params, salt.encode())
+    return base64.urlsafe_b64encode(kdf.derive(password.encode()))
+
+
+def is_available(algorithm):
+    """Whether this host's cryptography/OpenSSL build supports the algorithm"""
+    cheap = {
+        PBKDF2_SHA256: {'iterations': 1},
+        SCRYPT: {'n': 2, 'r': 1, 'p': 1},
+        ARGON2ID: {'iterations': 1, 'lanes': 1, 'memory_cost': 8},
+    }
+    try:
+        derive_key('', 'availability-check', algorithm, cheap[algorithm])
+    except (UnsupportedAlgorithm, KeyError, ValueError):
+        return False
+    return True
+
+
+def configured_kdf():
+    """Return the (algorithm, params) new profiles should use, from settings"""
+    from django.conf import settings
+
+    config = getattr(settings, 'PASSWORD_MANAGER_KDF', {})
+    algorithm = config.get('algorithm', PBKDF2_SHA256)
+    params = {**DEFAULT_PARAMS[algorithm], **config.get('params', {})}
+    return algorithm, params
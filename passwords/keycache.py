@@ -0,0 +1,216 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.fernet import Fernet, InvalidToken
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+
+from .agent import AgentError, get_agent
+from .crypto import unwrap_key, wrap_key
+from .models import KeyRotationInProgress, UserEncryptionProfile, VaultKeyRotation
+from .workers import run_crypto
+
+logger = logging.getLogger(__name__)
+
+
+class KeyCache:
+    """Bounded, TTL-evicted in-memory cache of derived encryption keys.
+
+    Entries are keyed by session key so that a key never outlives the
+    session it was derived for, and remember the generation of the data
+    key so that a key replaced by a rotation is not used any more.
+    """
+
+    def __init__(self, max_size=1024, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_key, user_id, generation):
+        """Return the cached key for a session, or None if missing, expired or of another generation"""
+        if not session_key:
+            return None
+        with self._lock:
+            item = self._entries.get(session_key)
+            if item is None:
+                return None
+            cached_user_id, key, cached_generation, expires_at = item
+            if expires_at <= time.monotonic() or cached_user_id != user_id or cached_generation != generation:
+                del self._entries[session_key]
+                return None
+            # Sliding expiry, mirroring SESSION_SAVE_EVERY_REQUEST
+            self._entries[session_key] = (cached_user_id, key, generation, time.monotonic() + self.ttl)
+            self._entries.move_to_end(session_key)
+            return key
+
+    def set(self, session_key, user_id, key, generation):
+        """Store a key for a session, evicting the least recently used entries"""
+        with self._lock:
+            self._entries[session_key] = (user_id, key, generation, time.monotonic() + self.ttl)
+            self._entries.move_to_end(session_key)
+            self._evict()
+
+    def invalidate(self, session_key):
+        """Drop the key cached for a session"""
+        with self._lock:
+            self._entries.pop(session_key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        now = time.monotonic()
+        expired = [k for k, (_, _, _, expires_at) in self._entries.items() if expires_at <= now]
+        for session_key in expired:
+            del self._entries[session_key]
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+key_cache = KeyCache(
+    max_size=getattr(settings, 'PASSWORD_MANAGER_KEY_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'PASSWORD_MANAGER_KEY_CACHE_TTL', settings.SESSION_COOKIE_AGE),
+)
+
+
+# Without an agent the data key is also kept in the session, wrapped with a
+# secret that only the browser holds, so that any worker can unwrap it while
+# the session store alone cannot
+SESSION_FIELD = 'wrapped_vault_key'
+COOKIE_NAME = 'vault_key'
+
+
+def _session_key(request):
+    """Return the session key, creating the session row if needed"""
+    if not request.session.session_key:
+        request.session.save()
+    return request.session.session_key
+
+
+def unlock_session(request, user, password):
+    """Unwrap the user's data key once and bind it to the session
+
+    With a key agent configured the agent unwraps and keeps the key, unless
+    it holds it already, and the session gets a handle to it. Otherwise the
+    key is cached in this process and wrapped into the session for the
+    others; set_key_cookie() must then give the response its secret.
+    Returns None if the password cannot unlock the vault.
+    """
+    profile = UserEncryptionProfile.get_or_create_for_user(user)
+    agent = get_agent()
+    if agent is not None:
+        try:
+            if not profile.wrapped_key:
+                profile.unlock(password)  # Wraps the data key of a profile from before envelope encryption
+            return agent.unlock(profile, password, _session_key(request))
+        except InvalidToken:
+            return None
+        except AgentError as e:
+            logger.warning('Key agent could not unlock the vault of %s: %s', user.username, e)
+            return None
+
+    try:
+        key = profile.unlock(password)
+    except InvalidToken:
+        logger.warning('The login password of %s cannot unlock their vault', user.username)
+        return None
+    key_cache.set(_session_key(request), user.pk, key, profile.key_generation)
+    secret = Fernet.generate_key()
+    request.session[SESSION_FIELD] = [wrap_key(secret, key), profile.key_generation]
+    request.vault_key_cookie = secret.decode()
+    return key
+
+
+def set_key_cookie(request, response):
+    """Send the secret of a key wrapped into the session by unlock_session(), if any"""
+    secret = getattr(request, 'vault_key_cookie', None)
+    if secret is None:
+        return response
+    response.set_cookie(
+        COOKIE_NAME, secret, path=settings.SESSION_COOKIE_PATH, domain=settings.SESSION_COOKIE_DOMAIN,
+        secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite=settings.SESSION_COOKIE_SAMESITE,
+    )
+    return response
+
+
+def _unwrap_session_key(request, stored, user_id, generation):
+    """The data key wrapped into the session, cached for the next requests; None if unusable"""
+    secret = request.COOKIES.get(COOKIE_NAME)
+    if not stored or not secret or stored[1] != generation:
+        return None
+    try:
+        key = unwrap_key(secret.encode(), stored[0])
+    except (InvalidToken, ValueError):
+        return None
+    key_cache.set(request.session.session_key, user_id, key, generation)
+    return key
+
+
+def key_generation(user_id):
+    """The generation of a user's current data key, or None without a profile"""
+    return UserEncryptionProfile.objects.filter(user_id=user_id).values_list('key_generation', flat=True).first()
+
+
+def _key_state(user_id):
+    """(key_generation, rotating) of a user's profile, in one query"""
+    return (
+        UserEncryptionProfile.objects.filter(user_id=user_id)
+        .annotate(rotating=Exists(VaultKeyRotation.objects.filter(user_id=OuterRef('user_id'))))
+        .values_list('key_generation', 'rotating')
+    )
+
+
+def _current_generation(state):
+    generation, rotating = state or (None, False)
+    if rotating:
+        # Part of the vault is under the new data key, which sessions do not hold
+        raise KeyRotationInProgress
+    return generation
+
+
+def _agent_key(agent, user_id, generation, session_key):
+    try:
+        return agent.key_for(user_id, generation, session_key)
+    except AgentError as e:
+        logger.warning('Key agent unavailable: %s', e)
+        return None
+
+
+def get_session_key(request):
+    """Return the encryption key bound to the current session
+
+    The password is not kept, so this is None once the key has expired
+    from the agent, once the data key was rotated, or once the session
+    ended or lost its key cookie.
+
+    Raises KeyRotationInProgress while the data key is being rotated,
+    since entries may be encrypted under either key until it is done.
+    """
+    generation = _current_generation(_key_state(request.user.pk).first())
+    agent = get_agent()
+    if agent is not None:
+        return _agent_key(agent, request.user.pk, generation, request.session.session_key)
+    key = key_cache.get(request.session.session_key, request.user.pk, generation)
+    if key is None:
+        key = _unwrap_session_key(request, request.session.get(SESSION_FIELD), request.user.pk, generation)
+    return key
+
+
+async def aget_session_key(request):
+    """Async get_session_key(), asking the agent from the crypto executor"""
+    user = await request.auser()
+    generation = _current_generation(await _key_state(user.pk).afirst())
+    agent = get_agent()
+    if agent is not None:
+        return await run_crypto(_agent_key, agent, user.pk, generation, request.session.session_key)
+    key = key_cache.get(request.session.session_key, user.pk, generation)
+    if key is None:
+        key = _unwrap_session_key(request, await request.session.aget(SESSION_FIELD), user.pk, generation)
+    return key
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from passwords.benchmarks import run_benchmarks, temporary_database
+import json
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the crypto, import and request hot paths and print the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--import-sizes',
+            type=int_list,
+            help='Comma-separated numbers of entries for the import benchmark',
+            default=[1000, 10000, 100000]
+        )
+        parser.add_argument(
+            '--kdf-iterations',
+            type=int_list,
+            help='Comma-separated PBKDF2 iteration counts to time',
+            default=[10000, 100000, 600000]
+        )
+        parser.add_argument(
+            '--request-entries',
+            type=int,
+            help='Number of entries in the vault used for request benchmarks',
+            default=1000
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='Write the JSON report to this file instead of stdout',
+        )
+
+    def handle(self, *args, **options):
+        with temporary_database():
+            report = run_benchmarks(
+                import_sizes=options['import_sizes'],
+                request_entries=options['request_entries'],
+                kdf_iterations=options['kdf_iterations'],
+            )
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(output + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Benchmark report written to {options['output']}"))
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,98 @@
+from django.core.management.base import BaseCommand, CommandError
+from passwords.kdf import ARGON2ID, KDF_CHOICES, PBKDF2_SHA256, SCRYPT, configured_kdf, derive_key, is_available
+from passwords.models import UserEncryptionProfile
+import json
+import time
+
+
+def measure(algorithm, params, repeat=3):
+    """Best-of-N derivation time in milliseconds"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        derive_key('calibration-password', 'calibration-salt', algorithm, params)
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class Command(BaseCommand):
+    help = (
+        'Pick KDF parameters that hit a target key derivation time on this host. Existing vaults are not '
+        'migrated in the background: each is rewrapped with the new parameters when its user next logs in.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--algorithm',
+            choices=[choice for choice, _ in KDF_CHOICES],
+            help='KDF algorithm to calibrate',
+            default=PBKDF2_SHA256
+        )
+        parser.add_argument(
+            '--target-ms',
+            type=float,
+            help='Target derivation time in milliseconds',
+            default=250
+        )
+        parser.add_argument(
+            '--memory-kib',
+            type=int,
+            help='Memory cost for Argon2id, in KiB',
+            default=65536
+        )
+        parser.add_argument(
+            '--lanes',
+            type=int,
+            help='Parallelism (lanes) for Argon2id',
+            default=4
+        )
+
+    def handle(self, *args, **options):
+        algorithm = options['algorithm']
+        target = options['target_ms']
+
+        if not is_available(algorithm):
+            raise CommandError(f'{algorithm} is not supported by this cryptography/OpenSSL build')
+
+        if algorithm == PBKDF2_SHA256:
+            params = self.calibrate_pbkdf2(target)
+        elif algorithm == SCRYPT:
+            params = self.calibrate_scrypt(target)
+        else:
+            params = self.calibrate_argon2id(target, options['memory_kib'], options['lanes'])
+
+        elapsed = measure(algorithm, params)
+        self.stdout.write(f'{algorithm} {json.dumps(params)}: {elapsed:.0f} ms per derivation')
+        self.stdout.write('Add to settings.py:')
+        self.stdout.write(f"PASSWORD_MANAGER_KDF = {{'algorithm': '{algorithm}', 'params': {json.dumps(params)}}}")
+
+        current = configured_kdf()
+        outdated = UserEncryptionProfile.objects.exclude(
+            kdf_algorithm=current[0], kdf_params=current[1]
+        ).count()
+        self.stdout.write(
+            f'{outdated} profile(s) do not use the currently configured KDF; '
+            'they are upgraded when their user next logs in.'
+        )
+
+    def calibrate_pbkdf2(self, target):
+        # PBKDF2 cost is linear in the iteration count
+        sample = 50000
+        per_iteration = measure(PBKDF2_SHA256, {'iterations': sample}) / sample
+        iterations = max(100000, int(target / per_iteration) // 1000 * 1000)
+        return {'iterations': iterations}
+
+    def calibrate_scrypt(self, target):
+        # Double N (memory and time) until the target is reached
+        params = {'n': 2 ** 14, 'r': 8, 'p': 1}
+        while measure(SCRYPT, params) < target and params['n'] < 2 ** 20:
+            params['n'] *= 2
+        return params
+
+    def calibrate_argon2id(self, target, memory_kib, lanes):
+        # Keep the memory cost fixed and raise the number of passes
+        params = {'iterations': 1, 'lanes': lanes, 'memory_cost': memory_kib}
+        while measure(ARGON2ID, params) < target and params['iterations'] < 64:
+            params['iterations'] += 1
+        return params
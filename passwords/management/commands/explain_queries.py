@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import connection
+from passwords.benchmarks import create_vault, temporary_database
+from passwords.queryplans import hot_queries, plan_problems
+
+
+class Command(BaseCommand):
+    help = "Print the query plans of the app's hot queries and flag full scans and sorts"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--username',
+            type=str,
+            help='Explain against this user in the configured database (default: a generated vault in a temporary database)',
+        )
+        parser.add_argument(
+            '--entries',
+            type=int,
+            help='Number of entries in the generated vault',
+            default=1000
+        )
+
+    def handle(self, *args, **options):
+        if options['username']:
+            try:
+                user = User.objects.get(username=options['username'])
+            except User.DoesNotExist:
+                self.stdout.write(
+                    self.style.ERROR(f"User not found: {options['username']}")
+                )
+                return
+            self.explain(user)
+            return
+
+        with temporary_database():
+            self.explain(create_vault(options['entries']))
+
+    def explain(self, user):
+        for name, queryset in hot_queries(user).items():
+            plan = queryset.explain()
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(plan)
+            # Only SQLite plans are checked; read PostgreSQL ones by eye
+            problems = plan_problems(plan) if connection.vendor == 'sqlite' else []
+            for problem in problems:
+                self.stdout.write(self.style.WARNING(f'  {problem}'))
+            self.stdout.write('')
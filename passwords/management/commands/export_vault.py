@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from passwords.backup import ArchiveWriter, Throughput, export_vaults
+from passwords.models import VaultKeyRotation
+import os
+
+
+class Command(BaseCommand):
+    help = "Export users' vaults, still encrypted, to a compressed chunked archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='Path of the archive to write',
+            required=True
+        )
+        parser.add_argument(
+            '--username',
+            type=str,
+            help='Only export this user (default: all users)',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            help='Number of records per archive chunk',
+            default=1000
+        )
+
+    def handle(self, *args, **options):
+        output = options['output']
+        chunk_size = max(1, options['chunk_size'])
+
+        users = User.objects.all()
+        if options['username']:
+            users = users.filter(username=options['username'])
+            if not users.exists():
+                self.stdout.write(
+                    self.style.ERROR(f"User not found: {options['username']}")
+                )
+                return
+
+        # Entries would be split across two data keys
+        rotating = VaultKeyRotation.objects.filter(user__in=users).values_list('user__username', flat=True)
+        if rotating:
+            self.stdout.write(
+                self.style.ERROR(f"Finish the interrupted key rotation of {', '.join(rotating)} first")
+            )
+            return
+
+        throughput = Throughput(report=self.report_progress)
+        try:
+            with open(output, 'wb') as f:
+                export_vaults(users, ArchiveWriter(f, chunk_size, throughput), chunk_size)
+        except Exception as e:
+            if os.path.exists(output):
+                os.remove(output)
+            self.stdout.write(
+                self.style.ERROR(f'Error exporting data: {e}')
+            )
+            return
+
+        self.report_progress(throughput)
+        self.stdout.write(
+            self.style.SUCCESS(f'Exported {throughput.records} records to {output}')
+        )
+
+    def report_progress(self, throughput):
+        records_per_second, megabytes_per_second = throughput.rates()
+        self.stdout.write(
+            f'Exported {throughput.records} records, {throughput.bytes / 1e6:.1f} MB '
+            f'({records_per_second:.0f} records/s, {megabytes_per_second:.1f} MB/s)'
+        )
@@ -1,21 +1,34 @@
+from cryptography.fernet import InvalidToken
 from django.core.management.base import BaseCommand
 from django.contrib.auth.models import User
-from passwords.models import PasswordCategory, PasswordEntry
+from django.db import transaction
+from passwords.agent import AgentError, get_agent
+from passwords.crypto import fingerprints
+from passwords.keycache import key_generation
+from passwords.models import KeyRotationInProgress, PasswordCategory, PasswordEntry, UserEncryptionProfile
+from passwords.parsers import PARSERS, guess_format
+from passwords.workers import BACKENDS, CryptoPool
+from itertools import islice
 import os
-import re
+import time
 import getpass
 
 
 class Command(BaseCommand):
-    help = 'Import passwords from a text file'
+    help = 'Import passwords from a text, CSV or JSON export file'
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--file',
             type=str,
-            help='Path to the text file to import',
+            help='Path to the file to import',
             default='import/passwords.txt'
         )
+        parser.add_argument(
+            '--format',
+            choices=sorted(PARSERS),
+            help='Format of the import file (default: guessed from its extension)',
+        )
         parser.add_argument(
             '--username',
             type=str,
@@ -27,15 +40,49 @@ class Command(BaseCommand):
             type=str,
             help='User password for encryption (will be prompted if not provided)',
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Number of entries written per INSERT batch',
+            default=500
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            help='Number of parallel encryption workers',
+            default=1
+        )
+        parser.add_argument(
+            '--backend',
+            choices=BACKENDS,
+            help='Worker pool backend used when --workers is greater than 1',
+            default='process'
+        )
+        parser.add_argument(
+            '--upsert',
+            action='store_true',
+            help='Update existing entries whose content changed and skip unchanged ones',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Run the whole import, then roll it back',
+        )
+        parser.add_argument(
+            '--profile',
+            action='store_true',
+            help='Report the time spent parsing, encrypting and writing',
+        )
 
     def handle(self, *args, **options):
-        ini_file = options['ini_file']
+        import_file = options['file']
         username = options['username']
         password = options['password']
-
-        # Get password if not provided
-        if not password:
-            password = getpass.getpass('Enter user password for encryption: ')
+        batch_size = max(1, options['batch_size'])
+        self.verbosity = options['verbosity']
+        self.upsert = options['upsert']
+        dry_run = options['dry_run']
+        pool = CryptoPool(workers=options['workers'], backend=options['backend'])
 
         # Get or create user
         try:
@@ -47,104 +94,216 @@ class Command(BaseCommand):
             )
             return
 
+        # A key agent already holding the user's key saves both the prompt and the derivation
+        agent = None if password else get_agent()
+        if agent is not None:
+            try:
+                if agent.key_for(user.pk, key_generation(user.pk)) is None:
+                    agent = None
+            except AgentError as e:
+                self.warn(f'Key agent unavailable: {e}')
+                agent = None
+
+        # Get password if not provided
+        if agent is None and not password:
+            password = getpass.getpass('Enter user password for encryption: ')
+
         # Construct absolute path
-        if not os.path.isabs(ini_file):
-            base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-            ini_file = os.path.join(base_dir, ini_file)
+        if not os.path.isabs(import_file):
+            base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+            import_file = os.path.join(base_dir, import_file)
 
-        if not os.path.exists(ini_file):
+        if not os.path.exists(import_file):
             self.stdout.write(
-                self.style.ERROR(f'INI file not found: {ini_file}')
+                self.style.ERROR(f'Import file not found: {import_file}')
             )
             return
 
-        self.stdout.write(f'Importing from: {ini_file} for user: {username}')
+        file_format = options['format'] or guess_format(import_file)
+        parse = PARSERS[file_format]
+        self.stdout.write(f'Importing from: {import_file} ({file_format}) for user: {username}')
+        self.timings = {'parse': 0.0, 'encrypt': 0.0, 'write': 0.0}
 
         try:
-            with open(ini_file, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
+            # utf-8-sig: CSV exports often start with a byte order mark
+            with open(import_file, 'r', encoding='utf-8-sig', newline='') as f, pool, transaction.atomic():
+                # Create or get the "personal" category for all entries
+                personal_category, created = PasswordCategory.objects.get_or_create(
+                    user=user,
+                    name='personal'
+                )
+                if created:
+                    self.stdout.write('Created "personal" category')
 
-            # Create or get the "personal" category for all entries
-            personal_category, created = PasswordCategory.objects.get_or_create(
-                user=user,
-                name='personal'
-            )
-            if created:
-                self.stdout.write('Created "personal" category')
+                # Entries are written with a current key, and no rotation starts before they are
+                generation = UserEncryptionProfile.lock_for_writes(user.pk)
 
-            current_service_name = None
-            current_data = []
+                # Unlock the encryption key once for the whole import
+                if agent is not None:
+                    key = agent.key_for(user.pk, generation)
+                    if key is None:
+                        raise AgentError('the key agent no longer holds the current key; pass --password')
+                else:
+                    key = UserEncryptionProfile.get_or_create_for_user(user).unlock(password)
 
-            for line in lines:
-                line = line.strip()
+                # Service name -> content fingerprint of what is already stored
+                existing = None
+                if self.upsert:
+                    existing = dict(PasswordEntry.objects.filter(user=user).values_list('service_name', 'fingerprint'))
 
-                # Check if this is a service line (ends with :)
-                if re.match(r'.+:$', line):
-                    # Save previous service if exists
-                    if current_service_name and current_data:
-                        self.save_service_data(current_service_name, current_data, user, password)
+                self.updated = self.unchanged = 0
+                records = parse(f, warn=self.warn)
+                batches = self.timed(
+                    self.iter_batches(records, personal_category, user, batch_size, key, existing), 'parse'
+                )
+                imported = self.import_entries(pool, batches, key, batch_size)
 
-                    # Start new service
-                    current_service_name = line[:-1]  # Remove the ':'
-                    current_data = []
+                if dry_run:
+                    transaction.set_rollback(True)
 
-                elif line and current_service_name:
-                    # Add data line to current service
-                    current_data.append(line)
+            if options['profile']:
+                self.report_timings()
+            if dry_run:
+                self.stdout.write(self.style.WARNING(f'Dry run: {imported} entries rolled back'))
+                return
 
-            # Save the last service
-            if current_service_name and current_data:
-                self.save_service_data(current_service_name, current_data, user, password)
+            if self.upsert:
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f'Successfully imported {imported - self.updated} new and {self.updated} changed entries '
+                        f'({self.unchanged} unchanged) with user-specific encryption'
+                    )
+                )
+            else:
+                self.stdout.write(
+                    self.style.SUCCESS(f'Successfully imported {imported} entries with user-specific encryption')
+                )
 
+        except InvalidToken:
             self.stdout.write(
-                self.style.SUCCESS('Successfully imported password data with user-specific encryption')
+                self.style.ERROR(f'Password cannot unlock the vault of {username}')
+            )
+        except KeyRotationInProgress:
+            self.stdout.write(
+                self.style.ERROR(f'The data key of {username} is being rotated; finish the rotation first')
             )
-
         except Exception as e:
             self.stdout.write(
                 self.style.ERROR(f'Error importing data: {e}')
             )
 
-    def save_service_data(self, service_name, data_lines, user, password):
-        """Save encrypted password data for a service"""
-        # Parse data_lines into structured format
-        # New format: [service_url (optional)], username, password, [comments]
-
-        if len(data_lines) >= 2:
-            # Check if first line looks like a URL
-            service_url = ""
-            username_index = 0
-
-            if len(data_lines) >= 3 and ('.' in data_lines[0] or 'http' in data_lines[0].lower()):
-                # First line is likely a URL
-                service_url = data_lines[0]
-                username_index = 1
-
-            username = data_lines[username_index]
-            password_value = data_lines[username_index + 1]
-            comments = '\n'.join(data_lines[username_index + 2:]) if len(data_lines) > username_index + 2 else ""
-
-            # Get the "personal" category
-            personal_category = PasswordCategory.objects.get(user=user, name='personal')
-
-            # Create new structured entry
-            entry = PasswordEntry(
-                category=personal_category,
-                user=user,
-                service_name=service_name,
-                service_url=service_url,
-                username=username,
-                comments=comments
-            )
+    def warn(self, message):
+        self.stdout.write(self.style.WARNING(message))
+
+    def timed(self, iterable, stage):
+        """Yield from iterable, adding the time spent producing items to self.timings"""
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.timings[stage] += time.perf_counter() - started
+                return
+            self.timings[stage] += time.perf_counter() - started
+            yield item
+
+    def iter_batches(self, records, category, user, batch_size, key, existing=None):
+        """Group parsed records into lists of (entry, plaintext password)
+
+        Records are fingerprinted a batch at a time, in one call for a key held
+        by the key agent. For upserts, ``existing`` maps stored service names to
+        their content fingerprint, and entries whose fingerprint did not change
+        are skipped, so batches can be shorter than batch_size.
+        """
+        records = iter(records)
+        seen = set()
+        while chunk := list(islice(records, batch_size)):
+            parsed = [self.build_entry(record, category, user) for record in chunk]
+            values = [entry.content_values(password_value) for entry, password_value in parsed]
+            for (entry, _), entry_fingerprint in zip(parsed, fingerprints(key, values)):
+                entry.fingerprint = entry_fingerprint
+            if existing is None:
+                yield parsed
+                continue
+
+            batch = []
+            for entry, password_value in parsed:
+                service_name = entry.service_name
+                # One statement cannot upsert the same row twice
+                if service_name in seen:
+                    self.warn(f'Skipping {service_name} - duplicate service name')
+                    continue
+                seen.add(service_name)
+
+                if service_name in existing:
+                    if existing[service_name] == entry.fingerprint:
+                        self.unchanged += 1
+                        continue
+                    self.updated += 1
+                batch.append((entry, password_value))
+            if batch:
+                yield batch
 
-            # Encrypt the password
-            if password_value:
-                entry.encrypt_password(password_value, password)
+    def import_entries(self, pool, batches, key, batch_size):
+        """Encrypt batches in the worker pool and write them in input order"""
+        imported = 0
+        started = time.perf_counter()
 
-            entry.save()
-            url_info = f" ({service_url})" if service_url else ""
-            self.stdout.write(f'Created entry: {service_name}{url_info} - {username}')
+        # Time spent waiting on encryption includes parsing the next batches
+        for entries, ciphertexts in self.timed(pool.encrypt_batches(key, batches), 'encrypt'):
+            for entry, ciphertext in zip(entries, ciphertexts):
+                entry.ciphertext = ciphertext
+            write_started = time.perf_counter()
+            imported += self.write_batch(entries, batch_size)
+            self.timings['write'] += time.perf_counter() - write_started
+            self.report_progress(imported, started)
+
+        self.timings['encrypt'] -= self.timings['parse']
+
+        return imported
+
+    def write_batch(self, batch, batch_size):
+        if self.upsert:
+            # Entries keep the category they were moved to
+            PasswordEntry.objects.bulk_create(
+                batch,
+                batch_size=batch_size,
+                update_conflicts=True,
+                unique_fields=['user', 'service_name'],
+                update_fields=[
+                    'service_url', 'username', 'ciphertext', 'encrypted_password',
+                    'comments', 'fingerprint', 'updated_at',
+                ],
+            )
         else:
-            self.stdout.write(
-                self.style.WARNING(f'Skipping {service_name} - insufficient data (need at least username and password)')
-            )
\ No newline at end of file
+            PasswordEntry.objects.bulk_create(batch, batch_size=batch_size)
+        if self.verbosity >= 2:
+            for entry in batch:
+                url_info = f" ({entry.service_url})" if entry.service_url else ""
+                self.stdout.write(f'Imported entry: {entry.service_name}{url_info} - {entry.username}')
+        return len(batch)
+
+    def report_progress(self, imported, started):
+        elapsed = time.perf_counter() - started
+        rate = imported / elapsed if elapsed > 0 else 0
+        self.stdout.write(f'Imported {imported} entries ({rate:.0f} entries/s)')
+
+    def report_timings(self):
+        total = sum(self.timings.values())
+        for stage, elapsed in self.timings.items():
+            share = elapsed / total * 100 if total else 0
+            self.stdout.write(f'{stage:>8}: {elapsed:.3f}s ({share:.0f}%)')
+
+    def build_entry(self, record, category, user):
+        """Build an unsaved entry and its plaintext password from one parsed record"""
+        entry = PasswordEntry(
+            category=category,
+            user=user,
+            service_name=record.service_name,
+            service_url=record.service_url,
+            username=record.username,
+            comments=record.comments
+        )
+
+        return entry, record.password
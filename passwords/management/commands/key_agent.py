@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from passwords.agent import AgentServer, KeyAgent
+
+
+class Command(BaseCommand):
+    help = 'Run the key agent that holds unlocked vault keys for the web workers and commands'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--socket',
+            type=str,
+            help='Unix socket to listen on (default: PASSWORD_MANAGER_KEY_AGENT_SOCKET)',
+        )
+        parser.add_argument(
+            '--ttl',
+            type=int,
+            help='Seconds a key is kept without use (default: PASSWORD_MANAGER_KEY_AGENT_TTL)',
+        )
+
+    def handle(self, *args, **options):
+        path = options['socket'] or getattr(settings, 'PASSWORD_MANAGER_KEY_AGENT_SOCKET', None)
+        if not path:
+            raise CommandError('No socket: pass --socket or set PASSWORD_MANAGER_KEY_AGENT_SOCKET')
+        agent = KeyAgent(
+            ttl=options['ttl'] or getattr(settings, 'PASSWORD_MANAGER_KEY_AGENT_TTL', settings.SESSION_COOKIE_AGE),
+            max_keys=getattr(settings, 'PASSWORD_MANAGER_KEY_CACHE_SIZE', 1024),
+        )
+
+        server = AgentServer(str(path), agent)
+        self.stdout.write(self.style.SUCCESS(f'Key agent listening on {path}'))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
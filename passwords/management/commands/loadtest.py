@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from passwords.benchmarks import compare_fetch_throughput, compare_session_engines, temporary_database
+import json
+
+
+class Command(BaseCommand):
+    help = 'Compare fetch_data throughput between the sync (WSGI) and async (ASGI) views, or between session engines'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--requests',
+            type=int,
+            help='Total number of fetch requests per path',
+            default=200
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            help='Number of concurrent clients',
+            default=8
+        )
+        parser.add_argument(
+            '--key-agent',
+            action='store_true',
+            help='Hold keys in a key agent, as with several worker processes'
+        )
+        parser.add_argument(
+            '--sessions',
+            action='store_true',
+            help='Compare session engines and fetch counter stores instead'
+        )
+
+    def handle(self, *args, **options):
+        with temporary_database():
+            if options['sessions']:
+                results = compare_session_engines(
+                    requests=options['requests'],
+                    concurrency=max(1, options['concurrency']),
+                )
+                self.stdout.write(json.dumps(results, indent=2))
+                return
+
+            results = compare_fetch_throughput(
+                requests=options['requests'],
+                concurrency=max(1, options['concurrency']),
+                key_agent=options['key_agent'],
+            )
+        self.stdout.write(json.dumps(results, indent=2))
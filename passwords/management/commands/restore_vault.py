@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from passwords.backup import ArchiveError, Throughput, restore_vaults
+import os
+
+
+class Command(BaseCommand):
+    help = 'Restore vaults from an archive written by export_vault'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--file',
+            type=str,
+            help='Path of the archive to restore',
+            required=True
+        )
+        parser.add_argument(
+            '--replace',
+            action='store_true',
+            help='Delete the existing vault of each restored user first',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Number of rows written per INSERT batch',
+            default=500
+        )
+
+    def handle(self, *args, **options):
+        archive = options['file']
+        batch_size = max(1, options['batch_size'])
+
+        if not os.path.exists(archive):
+            self.stdout.write(
+                self.style.ERROR(f'Archive not found: {archive}')
+            )
+            return
+
+        throughput = Throughput(report=self.report_progress)
+        try:
+            with open(archive, 'rb') as f:
+                usernames = restore_vaults(f, replace=options['replace'], batch_size=batch_size, throughput=throughput)
+        except ArchiveError as e:
+            self.stdout.write(
+                self.style.ERROR(f'Restore aborted, nothing was changed: {e}')
+            )
+            return
+        except Exception as e:
+            self.stdout.write(
+                self.style.ERROR(f'Error restoring data: {e}')
+            )
+            return
+
+        self.report_progress(throughput)
+        self.stdout.write(
+            self.style.SUCCESS(f"Restored {throughput.records} records for {', '.join(usernames) or 'no users'}")
+        )
+
+    def report_progress(self, throughput):
+        records_per_second, megabytes_per_second = throughput.rates()
+        self.stdout.write(
+            f'Restored {throughput.records} records, {throughput.bytes / 1e6:.1f} MB '
+            f'({records_per_second:.0f} records/s, {megabytes_per_second:.1f} MB/s)'
+        )
@@ -0,0 +1,81 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from passwords.models import VaultKeyRotation
+from passwords.rotation import RotationError, change_password, rotate_data_key
+import getpass
+
+
+class Command(BaseCommand):
+    help = "Change a user's vault password, or re-encrypt the vault under a new data key (resumable)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--username',
+            type=str,
+            help='Username whose vault should be rekeyed',
+            required=True
+        )
+        parser.add_argument(
+            '--old-password',
+            type=str,
+            help='Current user password (will be prompted if not provided)',
+        )
+        parser.add_argument(
+            '--new-password',
+            type=str,
+            help='New user password (will be prompted if not provided, unless --rotate-data-key is given)',
+        )
+        parser.add_argument(
+            '--rotate-data-key',
+            action='store_true',
+            help='Re-encrypt every entry under a new random data key',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            help='Number of entries re-encrypted per transaction',
+            default=500
+        )
+
+    def handle(self, *args, **options):
+        username = options['username']
+        chunk_size = max(1, options['chunk_size'])
+        rotate = options['rotate_data_key']
+
+        try:
+            user = User.objects.get(username=username)
+        except User.DoesNotExist:
+            self.stdout.write(
+                self.style.ERROR(f'User not found: {username}')
+            )
+            return
+
+        old_password = options['old_password'] or getpass.getpass('Enter current user password: ')
+        new_password = options['new_password']
+        if not new_password and not rotate:
+            new_password = getpass.getpass('Enter new user password: ')
+            if new_password != getpass.getpass('Confirm new user password: '):
+                self.stdout.write(self.style.ERROR('Passwords do not match'))
+                return
+
+        def progress(rotated, last_entry_id):
+            self.stdout.write(f'Re-encrypted {rotated} entries (checkpoint: entry {last_entry_id})')
+
+        try:
+            if rotate:
+                if VaultKeyRotation.objects.filter(user=user).exists():
+                    self.stdout.write('Resuming interrupted rotation')
+                rotated = rotate_data_key(user, old_password, chunk_size=chunk_size, progress=progress)
+                self.stdout.write(
+                    self.style.SUCCESS(f'Rotated data key for {username} ({rotated} entries re-encrypted)')
+                )
+
+            if new_password:
+                change_password(user, old_password, new_password)
+                self.stdout.write(
+                    self.style.SUCCESS(f'Changed vault password for {username}')
+                )
+        except RotationError as e:
+            self.stdout.write(
+                self.style.ERROR(f'Rotation aborted: {e}')
+            )
@@ -0,0 +1,37 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import metrics
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else 'unmatched'
+
+
+class MetricsMiddleware:
+    """Time each request and count its queries, when PASSWORD_MANAGER_METRICS is on"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not metrics.registry.enabled:
+            return self.get_response(request)
+        token = metrics.start_request()
+        response = self.get_response(request)
+        metrics.finish_request(token, _view_name(request), response)
+        return response
+
+    async def __acall__(self, request):
+        if not metrics.registry.enabled:
+            return await self.get_response(request)
+        token = metrics.start_request()
+        response = await self.get_response(request)
+        metrics.finish_request(token, _view_name(request), response)
+        return response
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:30
+
+from django.db import migrations, models
+
+
+def set_legacy_kdf(apps, schema_editor):
+    """Existing profiles were derived with PBKDF2-SHA256 at 100,000 iterations"""
+    UserEncryptionProfile = apps.get_model('passwords', 'UserEncryptionProfile')
+    UserEncryptionProfile.objects.filter(kdf_algorithm='').update(
+        kdf_algorithm='pbkdf2_sha256',
+        kdf_params={'iterations': 100000},
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('passwords', '0005_vaultkeyrotation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userencryptionprofile',
+            name='kdf_algorithm',
+            field=models.CharField(blank=True, choices=[('pbkdf2_sha256', 'PBKDF2-SHA256'), ('scrypt', 'scrypt'), ('argon2id', 'Argon2id')], max_length=32),
+        ),
+        migrations.AddField(
+            model_name='userencryptionprofile',
+            name='kdf_params',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.RunPython(set_legacy_kdf, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('passwords', '0006_userencryptionprofile_kdf'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userencryptionprofile',
+            name='wrapped_key',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='userencryptionprofile',
+            name='key_generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:37
+
+import base64
+
+from django.db import migrations, models
+
+CHUNK_SIZE = 1000
+
+# The storage format as of this migration, copied here so that later changes
+# to passwords.crypto cannot change what it does
+STORAGE_V1 = 1
+
+
+def to_binary(text):
+    """Base64 text of the base64 Fernet token -> version byte + raw Fernet token"""
+    return bytes([STORAGE_V1]) + base64.urlsafe_b64decode(base64.b64decode(text))
+
+
+def to_legacy_text(stored):
+    """Version byte + raw Fernet token -> base64 text of the base64 Fernet token"""
+    stored = bytes(stored)  # Some database drivers return memoryview
+    if stored[0] != STORAGE_V1:
+        raise ValueError("Unknown encrypted value format")
+    return base64.b64encode(base64.urlsafe_b64encode(stored[1:])).decode()
+
+
+def _convert(apps, source, target, convert):
+    """Move encrypted passwords from one column to the other in pk-ordered chunks"""
+    PasswordEntry = apps.get_model('passwords', 'PasswordEntry')
+    empty = {'ciphertext': b'', 'encrypted_password': ''}
+    rows = PasswordEntry.objects.exclude(**{source: empty[source]}).order_by('pk').only('pk', source)
+    last_pk = 0
+    while True:
+        chunk = list(rows.filter(pk__gt=last_pk)[:CHUNK_SIZE])
+        if not chunk:
+            break
+        for entry in chunk:
+            setattr(entry, target, convert(getattr(entry, source)))
+            setattr(entry, source, empty[source])
+        PasswordEntry.objects.bulk_update(chunk, [source, target])
+        last_pk = chunk[-1].pk
+
+
+def forwards(apps, schema_editor):
+    _convert(apps, 'encrypted_password', 'ciphertext', to_binary)
+
+
+def backwards(apps, schema_editor):
+    _convert(apps, 'ciphertext', 'encrypted_password', to_legacy_text)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('passwords', '0007_envelope_encryption'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='passwordentry',
+            name='ciphertext',
+            field=models.BinaryField(blank=True, default=b'', help_text='Encrypted password'),
+        ),
+        migrations.AlterField(
+            model_name='passwordentry',
+            name='encrypted_password',
+            field=models.TextField(blank=True, help_text='Encrypted password (legacy text format)'),
+        ),
+        # Rewrites the format only, so no user key is needed
+        migrations.RunPython(forwards, backwards),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:49
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('passwords', '0010_ratelimitcounter'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='passwordentry',
+            options={'ordering': ['service_name', 'username']},
+        ),
+        migrations.AddIndex(
+            model_name='passwordentry',
+            index=models.Index(fields=['user', 'category', 'service_name', 'username'], name='passwords_entry_user_cat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='passwordentry',
+            index=models.Index(fields=['user', 'updated_at'], name='passwords_entry_user_upd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='passwordentry',
+            index=models.Index(fields=['updated_at'], name='passwords_entry_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='passwordentry',
+            index=models.Index(fields=['service_name', 'username'], name='passwords_entry_order_idx'),
+        ),
+    ]
@@ -0,0 +1,157 @@
+from django.db import migrations
+from django.db.utils import OperationalError
+
+# The index is kept in sync by triggers, so bulk_create(), upserts and
+# raw SQL writes are covered as well as save(). Both databases index text
+# without diacritics, as fulltext.terms() strips them from searches.
+
+SQLITE_FORWARDS = [
+    """
+    CREATE VIRTUAL TABLE passwords_entry_search USING fts5(
+        service_name, username, service_url, comments, category_name,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    INSERT INTO passwords_entry_search (rowid, service_name, username, service_url, comments, category_name)
+    SELECT e.id, e.service_name, e.username, e.service_url, e.comments, c.name
+    FROM passwords_passwordentry e JOIN passwords_passwordcategory c ON c.id = e.category_id
+    """,
+    """
+    CREATE TRIGGER passwords_entry_search_insert AFTER INSERT ON passwords_passwordentry BEGIN
+        INSERT INTO passwords_entry_search (rowid, service_name, username, service_url, comments, category_name)
+        VALUES (new.id, new.service_name, new.username, new.service_url, new.comments,
+                (SELECT name FROM passwords_passwordcategory WHERE id = new.category_id));
+    END
+    """,
+    """
+    CREATE TRIGGER passwords_entry_search_update
+    AFTER UPDATE OF service_name, username, service_url, comments, category_id ON passwords_passwordentry BEGIN
+        DELETE FROM passwords_entry_search WHERE rowid = old.id;
+        INSERT INTO passwords_entry_search (rowid, service_name, username, service_url, comments, category_name)
+        VALUES (new.id, new.service_name, new.username, new.service_url, new.comments,
+                (SELECT name FROM passwords_passwordcategory WHERE id = new.category_id));
+    END
+    """,
+    """
+    CREATE TRIGGER passwords_entry_search_delete AFTER DELETE ON passwords_passwordentry BEGIN
+        DELETE FROM passwords_entry_search WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER passwords_entry_search_category AFTER UPDATE OF name ON passwords_passwordcategory BEGIN
+        UPDATE passwords_entry_search SET category_name = new.name
+        WHERE rowid IN (SELECT id FROM passwords_passwordentry WHERE category_id = new.id);
+    END
+    """,
+]
+
+SQLITE_BACKWARDS = [
+    "DROP TRIGGER IF EXISTS passwords_entry_search_category",
+    "DROP TRIGGER IF EXISTS passwords_entry_search_delete",
+    "DROP TRIGGER IF EXISTS passwords_entry_search_update",
+    "DROP TRIGGER IF EXISTS passwords_entry_search_insert",
+    "DROP TABLE IF EXISTS passwords_entry_search",
+]
+
+POSTGRESQL_FORWARDS = [
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    # unaccent() depends on its dictionary, so the function is STABLE rather than IMMUTABLE
+    """
+    CREATE FUNCTION passwords_entry_document(service_name text, username text, service_url text,
+                                             comments text, category_name text)
+    RETURNS tsvector LANGUAGE sql STABLE AS $$
+        SELECT setweight(to_tsvector('simple', unaccent(coalesce(service_name, ''))), 'A')
+            || setweight(to_tsvector('simple', unaccent(coalesce(username, ''))), 'B')
+            || setweight(to_tsvector('simple', unaccent(coalesce(category_name, ''))), 'B')
+            || setweight(to_tsvector('simple', unaccent(coalesce(service_url, ''))), 'C')
+            || setweight(to_tsvector('simple', unaccent(coalesce(comments, ''))), 'D')
+    $$
+    """,
+    """
+    CREATE TABLE passwords_entry_search (
+        entry_id bigint PRIMARY KEY REFERENCES passwords_passwordentry (id) ON DELETE CASCADE,
+        document tsvector NOT NULL
+    )
+    """,
+    "CREATE INDEX passwords_entry_search_gin ON passwords_entry_search USING gin (document)",
+    """
+    INSERT INTO passwords_entry_search (entry_id, document)
+    SELECT e.id, passwords_entry_document(e.service_name, e.username, e.service_url, e.comments, c.name)
+    FROM passwords_passwordentry e JOIN passwords_passwordcategory c ON c.id = e.category_id
+    """,
+    """
+    CREATE FUNCTION passwords_entry_search_update() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO passwords_entry_search (entry_id, document)
+        SELECT NEW.id, passwords_entry_document(NEW.service_name, NEW.username, NEW.service_url, NEW.comments, c.name)
+        FROM passwords_passwordcategory c WHERE c.id = NEW.category_id
+        ON CONFLICT (entry_id) DO UPDATE SET document = EXCLUDED.document;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE TRIGGER passwords_entry_search_update
+    AFTER INSERT OR UPDATE OF service_name, username, service_url, comments, category_id
+    ON passwords_passwordentry FOR EACH ROW EXECUTE FUNCTION passwords_entry_search_update()
+    """,
+    """
+    CREATE FUNCTION passwords_entry_search_category() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE passwords_entry_search s
+        SET document = passwords_entry_document(e.service_name, e.username, e.service_url, e.comments, NEW.name)
+        FROM passwords_passwordentry e
+        WHERE e.id = s.entry_id AND e.category_id = NEW.id;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE TRIGGER passwords_entry_search_category
+    AFTER UPDATE OF name ON passwords_passwordcategory
+    FOR EACH ROW EXECUTE FUNCTION passwords_entry_search_category()
+    """,
+]
+
+POSTGRESQL_BACKWARDS = [
+    "DROP TRIGGER IF EXISTS passwords_entry_search_category ON passwords_passwordcategory",
+    "DROP TRIGGER IF EXISTS passwords_entry_search_update ON passwords_passwordentry",
+    "DROP FUNCTION IF EXISTS passwords_entry_search_category()",
+    "DROP FUNCTION IF EXISTS passwords_entry_search_update()",
+    "DROP TABLE IF EXISTS passwords_entry_search",
+    "DROP FUNCTION IF EXISTS passwords_entry_document(text, text, text, text, text)",
+]
+
+
+def _create(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            schema_editor.execute(SQLITE_FORWARDS[0])
+        except OperationalError:
+            return  # SQLite built without FTS5: the admin keeps its LIKE search
+        statements = SQLITE_FORWARDS[1:]
+    elif vendor == 'postgresql':
+        statements = POSTGRESQL_FORWARDS
+    else:
+        return
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def _drop(apps, schema_editor):
+    statements = {'sqlite': SQLITE_BACKWARDS, 'postgresql': POSTGRESQL_BACKWARDS}
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('passwords', '0011_passwordentry_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(_create, _drop),
+    ]
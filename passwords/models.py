@@ -1,11 +1,12 @@
 from django.db import models
 from django.contrib.auth.models import User
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import base64
 import os
 
+from .crypto import decrypt_value, decrypt_values, encrypt_value, fingerprint, generate_data_key, unwrap_key, wrap_key
+from .kdf import KDF_CHOICES, configured_kdf, derive_key
+from . import metrics
+
 
 class PasswordCategory(models.Model):
     """Represents a password category"""
@@ -21,35 +22,143 @@ class PasswordCategory(models.Model):
         return f"{self.user.username} - {self.name}"
 
 
+class KeyRotationInProgress(Exception):
+    """Raised when entries would be written while their data key is being rotated"""
+
+
 class UserEncryptionProfile(models.Model):
-    """Stores user-specific encryption data"""
+    """Stores user-specific encryption data
+
+    Entries are encrypted with a random data key, stored here wrapped
+    (encrypted) by a key derived from the user's password, so that a
+    password change only rewraps this row.
+    """
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='encryption_profile')
     salt = models.CharField(max_length=64)  # Unique salt for each user
+    kdf_algorithm = models.CharField(max_length=32, choices=KDF_CHOICES, blank=True)
+    kdf_params = models.JSONField(default=dict, blank=True)  # Cost parameters of kdf_algorithm
+    wrapped_key = models.TextField(blank=True)  # Data key encrypted with the password-derived key
+    key_generation = models.PositiveIntegerField(default=0)  # Incremented whenever the data key is replaced
     created_at = models.DateTimeField(auto_now_add=True)
 
     def save(self, *args, **kwargs):
         if not self.salt:
             # Generate a unique salt for this user
-            self.salt = base64.b64encode(os.urandom(32)).decode()
+            self.salt = self.generate_salt()
+        if not self.kdf_algorithm:
+            self.kdf_algorithm, self.kdf_params = configured_kdf()
         super().save(*args, **kwargs)
 
+    @staticmethod
+    def generate_salt():
+        return base64.b64encode(os.urandom(32)).decode()
+
     @classmethod
     def get_or_create_for_user(cls, user):
         """Get or create encryption profile for a user"""
         profile, created = cls.objects.get_or_create(user=user)
         return profile
 
-    def derive_key_from_password(self, password):
-        """Derive encryption key from user password and salt"""
-        # Use PBKDF2 with the user's password and unique salt
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=self.salt.encode(),
-            iterations=100000,  # OWASP recommended minimum
+    @classmethod
+    def lock_for_writes(cls, user_id):
+        """Lock a user's profile until the end of the transaction; return its key generation
+
+        Raises KeyRotationInProgress while the data key is being rotated.
+        The rotation replaces the key with this row locked too, so a key of
+        the returned generation stays current until the transaction ends.
+        """
+        generation = (
+            cls.objects.select_for_update().filter(user_id=user_id)
+            .values_list('key_generation', flat=True).first()
         )
-        key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
-        return key
+        if VaultKeyRotation.objects.filter(user_id=user_id).exists():
+            raise KeyRotationInProgress("The data key of this vault is being rotated")
+        return generation
+
+    @metrics.timed(metrics.KDF_SECONDS, 'kdf')
+    def derive_key_from_password(self, password, salt=None, algorithm=None, params=None):
+        """Derive encryption key from user password and salt
+
+        Uses the profile's own salt and KDF parameters unless overridden.
+        """
+        if algorithm is None:
+            algorithm, params = self.kdf_algorithm, self.kdf_params
+            if not algorithm:
+                algorithm, params = configured_kdf()
+        return derive_key(password, salt or self.salt, algorithm, params)
+
+    def needs_kdf_upgrade(self):
+        """Whether the profile's KDF differs from the configured one"""
+        return not self.wrapped_key or (self.kdf_algorithm, self.kdf_params) != configured_kdf()
+
+    def unlock(self, password):
+        """Return the data key, unwrapping it with the password
+
+        Raises cryptography.fernet.InvalidToken if the password is wrong.
+        Profiles from before envelope encryption encrypted entries with the
+        derived key itself; on first unlock that key becomes the data key.
+        """
+        derived_key = self.derive_key_from_password(password)
+        if self.wrapped_key:
+            return unwrap_key(derived_key, self.wrapped_key)
+
+        sample = PasswordEntry.objects.filter(user_id=self.user_id).with_password().first()
+        if sample is None:
+            data_key = generate_data_key()
+        else:
+            decrypt_value(derived_key, sample.stored_password)  # Check the password first
+            data_key = derived_key
+
+        self.wrap_data_key(password, data_key)
+        self.save(update_fields=['salt', 'kdf_algorithm', 'kdf_params', 'wrapped_key'])
+        return data_key
+
+    def wrap_data_key(self, password, data_key):
+        """Wrap the data key for a password, with a fresh salt and the configured KDF"""
+        self.salt = self.generate_salt()
+        self.kdf_algorithm, self.kdf_params = configured_kdf()
+        self.wrapped_key = wrap_key(self.derive_key_from_password(password), data_key)
+
+
+class VaultKeyRotation(models.Model):
+    """Checkpoint of an in-progress data key rotation"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='key_rotation')
+    new_wrapped_key = models.TextField()  # New data key, wrapped like the profile's current one
+    last_entry_id = models.BigIntegerField(default=0)  # Entries up to this id use the new key
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user.username} - rotation at entry {self.last_entry_id}"
+
+
+class RateLimitCounter(models.Model):
+    """State of one rate limit key, for the database rate limit backend"""
+    key = models.CharField(max_length=255, unique=True)
+    count = models.FloatField(default=0)  # Hits in a window, or tokens left in a bucket
+    stamp = models.FloatField(default=0)  # Time of the last refill of a token bucket
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key}: {self.count}"
+
+
+class PasswordEntryQuerySet(models.QuerySet):
+
+    def with_password(self):
+        """Entries holding an encrypted password, in either storage format"""
+        return self.exclude(ciphertext=b'', encrypted_password='')
+
+    def version(self):
+        """A stamp that changes when entries are added, deleted or saved, by any process
+
+        For one user's entries it is read from the (user, updated_at) index
+        alone. Updates that bypass save() and leave updated_at as it was,
+        such as re-encryption, are not seen.
+        """
+        stats = self.order_by().aggregate(count=models.Count('pk'), updated=models.Max('updated_at'),
+                                          last=models.Max('pk'))
+        return stats['count'], stats['updated'] and stats['updated'].isoformat(), stats['last']
 
 
 class PasswordEntry(models.Model):
@@ -61,44 +170,67 @@ class PasswordEntry(models.Model):
     service_name = models.CharField(max_length=200, help_text="Name of the service/website")
     service_url = models.URLField(blank=True, help_text="Optional URL for the service/website")
     username = models.CharField(max_length=200, help_text="Username/email for the service")
-    encrypted_password = models.TextField(help_text="Encrypted password")
+    ciphertext = models.BinaryField(blank=True, default=b'', help_text="Encrypted password")
+    encrypted_password = models.TextField(blank=True, help_text="Encrypted password (legacy text format)")
     comments = models.TextField(blank=True, help_text="Optional additional notes or comments")
+    fingerprint = models.CharField(max_length=64, blank=True, editable=False)  # Of the last imported content
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = PasswordEntryQuerySet.as_manager()
+
     class Meta:
-        ordering = ['category__name', 'service_name', 'username']
-        unique_together = ['user', 'service_name']  # Each user can have unique service names
-
-    def encrypt_password(self, password, user_password):
-        """Encrypt a password using user-specific key"""
-        if not user_password:
-            raise ValueError("User password required for encryption")
-
-        key = self._get_user_encryption_key(user_password)
-        f = Fernet(key)
-        encrypted_data = f.encrypt(password.encode())
-        self.encrypted_password = base64.b64encode(encrypted_data).decode()
-
-    def decrypt_password(self, user_password):
-        """Decrypt password using user-specific key"""
-        if not self.encrypted_password:
+        # No join: the category name is not part of the order
+        ordering = ['service_name', 'username']
+        unique_together = ['user', 'service_name']  # Each user can have unique service names, also the lookup index
+        indexes = [
+            models.Index(fields=['user', 'category', 'service_name', 'username'], name='passwords_entry_user_cat_idx'),
+            models.Index(fields=['user', 'updated_at'], name='passwords_entry_user_upd_idx'),
+            models.Index(fields=['updated_at'], name='passwords_entry_updated_idx'),
+            models.Index(fields=['service_name', 'username'], name='passwords_entry_order_idx'),
+        ]
+
+    @metrics.timed(metrics.CRYPTO_SECONDS, 'crypto', operation='encrypt')
+    def encrypt_password(self, password, key):
+        """Encrypt a password using the user's derived key"""
+        if not key:
+            raise ValueError("Encryption key required for encryption")
+
+        self.ciphertext = encrypt_value(key, password)
+        self.encrypted_password = ''
+
+    def content_values(self, password):
+        """What content_fingerprint() hashes, for fingerprinting entries in bulk"""
+        return [self.service_url, self.username, password, self.comments]
+
+    def content_fingerprint(self, key, password):
+        """Fingerprint of the entry's content, keyed with the user's data key"""
+        return fingerprint(key, self.content_values(password))
+
+    @property
+    def stored_password(self):
+        """The encrypted password in whichever format the row holds"""
+        return self.ciphertext or self.encrypted_password
+
+    @metrics.timed(metrics.CRYPTO_SECONDS, 'crypto', operation='decrypt')
+    def decrypt_password(self, key):
+        """Decrypt password using the user's derived key"""
+        if not self.stored_password:
             return ""
 
         try:
-            key = self._get_user_encryption_key(user_password)
-            f = Fernet(key)
-            encrypted_data = base64.b64decode(self.encrypted_password.encode())
-            decrypted_data = f.decrypt(encrypted_data)
-            return decrypted_data.decode()
+            return decrypt_value(key, self.stored_password)
         except Exception:
             return ""
 
-    def _get_user_encryption_key(self, user_password):
-        """Generate user-specific encryption key"""
-        profile = UserEncryptionProfile.get_or_create_for_user(self.user)
-        return profile.derive_key_from_password(user_password)
+    @staticmethod
+    @metrics.timed(metrics.CRYPTO_SECONDS, 'crypto', items=lambda entries, key: len(entries), operation='decrypt')
+    def decrypt_passwords(entries, key):
+        """decrypt_password() for several entries, in one call for a key held by the key agent"""
+        stored = [entry.stored_password for entry in entries]
+        decrypted = iter(decrypt_values(key, [value for value in stored if value]))
+        return [(next(decrypted) or "") if value else "" for value in stored]
 
     def __str__(self):
         return f"{self.service_name} ({self.username}) - {self.category.name}"
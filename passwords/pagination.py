@@ -0,0 +1,134 @@
+"""Keyset pagination and bounded counts for large admin changelists
+
+OFFSET pagination reads and discards every row before the requested page,
+and the admin counts the whole result set on each page. Here a page starts
+after (or before) the sort key of a row of the previous page instead, so
+it is an index range read whatever its depth, and counting stops at a
+limit, above which PostgreSQL's planner estimate is shown instead.
+"""
+import base64
+import binascii
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connections
+from django.db.models import Q
+
+CURSOR_VAR = 'cursor'
+
+AFTER, BEFORE = '>', '<'
+
+
+def count_upto(queryset, limit):
+    """Count the rows of queryset, stopping after limit + 1"""
+    return queryset.order_by()[:limit + 1].count()
+
+
+def estimate_count(queryset):
+    """The planner's estimate of the rows of queryset on PostgreSQL, None elsewhere"""
+    if connections[queryset.db].vendor != 'postgresql':
+        return None
+    plan = json.loads(queryset.order_by().explain(format='json'))
+    if isinstance(plan, list):
+        plan = plan[0]
+    return int(plan['Plan']['Plan Rows'])
+
+
+def keyset_fields(queryset):
+    """The (field, descending) pairs queryset is ordered by, or None if it can't be keyset paged
+
+    Every ordering term must be a non-null column of the model, the last one unique.
+    """
+    opts = queryset.model._meta
+    fields = []
+    for term in queryset.query.order_by:
+        if not isinstance(term, str):
+            return None
+        name = term.lstrip('-')
+        try:
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if not field.concrete or field.is_relation or field.null:
+            return None
+        fields.append((field, term.startswith('-')))
+    if not fields or not fields[-1][0].unique:
+        return None
+    return fields
+
+
+def encode_cursor(direction, fields, obj):
+    values = [str(getattr(obj, field.attname)) for field, _ in fields]
+    ordering = [field.name for field, _ in fields]
+    data = json.dumps([direction, ordering, values]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def decode_cursor(cursor, fields):
+    """Return (direction, values) from a cursor, or None if it does not fit fields"""
+    try:
+        direction, ordering, values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if direction not in (AFTER, BEFORE) or ordering != [field.name for field, _ in fields]:
+            return None
+        return direction, [field.to_python(value) for (field, _), value in zip(fields, values, strict=True)]
+    except (binascii.Error, ValueError, TypeError, ValidationError):
+        return None
+
+
+def _beyond(fields, values):
+    """Rows strictly after values in the order of fields"""
+    first, first_descending = fields[0]
+    # The bound on the first column alone, so the index range scan can use it
+    bound = Q(**{f"{first.attname}__{'lte' if first_descending else 'gte'}": values[0]})
+    beyond = Q()
+    for i, (field, descending) in enumerate(fields):
+        lookups = {f.attname: value for (f, _), value in zip(fields[:i], values[:i])}
+        lookups[f"{field.attname}__{'lt' if descending else 'gt'}"] = values[i]
+        beyond |= Q(**lookups)
+    return bound & beyond
+
+
+class Page:
+    """One page of a changelist, with the query strings of its neighbours
+
+    Also stands in for the paginator of the admin's pagination tag, which
+    asks it for page numbers: there are none.
+    """
+
+    def __init__(self, object_list, next_url=None, previous_url=None, first_url=None):
+        self.object_list = object_list
+        self.next_url = next_url
+        self.previous_url = previous_url
+        self.first_url = first_url
+
+    def get_elided_page_range(self, number=None, **kwargs):
+        return []
+
+
+def keyset_page(queryset, fields, per_page, cursor=None):
+    """Return (rows, next cursor, previous cursor) for the page at cursor
+
+    Cursors are None where there is no next or previous page.
+    """
+    direction, values = (decode_cursor(cursor, fields) if cursor else None) or (AFTER, None)
+    if direction == BEFORE:
+        # Walk backwards from the cursor, then put the rows back in order
+        walk = [(field, not descending) for field, descending in fields]
+    else:
+        walk = fields
+    queryset = queryset.order_by(*[f"{'-' if descending else ''}{field.name}" for field, descending in walk])
+    if values is not None:
+        queryset = queryset.filter(_beyond(walk, values))
+
+    rows = list(queryset[:per_page + 1])
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == BEFORE:
+        rows.reverse()
+        has_next, has_previous = True, more
+    else:
+        has_next, has_previous = more, values is not None
+
+    next_cursor = encode_cursor(AFTER, fields, rows[-1]) if rows and has_next else None
+    previous_cursor = encode_cursor(BEFORE, fields, rows[0]) if rows and has_previous else None
+    return rows, next_cursor, previous_cursor
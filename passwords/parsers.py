@@ -0,0 +1,231 @@
+"""Streaming parsers for import_passwords
+
+Each parser takes a text file handle and lazily yields ImportRecord
+tuples, calling ``warn`` with a message for every record it skips.
+Parsers are registered by format name and file extensions.
+"""
+from collections import namedtuple
+from urllib.parse import urlsplit
+import csv
+import json
+import os
+
+ImportRecord = namedtuple('ImportRecord', 'service_name service_url username password comments')
+
+PARSERS = {}
+EXTENSIONS = {}
+
+# Column names used by common password manager exports (Chrome, Firefox,
+# Bitwarden, LastPass, 1Password, KeePass), lowercased
+FIELD_ALIASES = {
+    'service_name': ('name', 'title', 'account', 'service', 'service_name'),
+    'service_url': ('url', 'login_uri', 'website', 'web site', 'uri', 'service_url'),
+    'username': ('username', 'login_username', 'login name', 'login', 'email'),
+    'password': ('password', 'login_password'),
+    'comments': ('notes', 'note', 'extra', 'comments'),
+}
+
+
+def register(name, extensions=()):
+    """Register a parser function under a format name and file extensions"""
+    def decorator(parser):
+        PARSERS[name] = parser
+        for extension in extensions:
+            EXTENSIONS[extension] = name
+        return parser
+    return decorator
+
+
+def guess_format(path, default='legacy'):
+    """Pick a format from the file extension"""
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower(), default)
+
+
+def _ignore(message):
+    pass
+
+
+def record_from_mapping(row, warn=_ignore):
+    """Build an ImportRecord from a dict keyed by any of FIELD_ALIASES
+
+    Returns None (after warning) if the row has no password. Rows without
+    a name are named after their URL's host.
+    """
+    row = {str(key).strip().lower(): value for key, value in row.items() if key is not None}
+    values = {}
+    for field, aliases in FIELD_ALIASES.items():
+        values[field] = next((str(row[alias]).strip() for alias in aliases if row.get(alias)), '')
+
+    if not values['service_name'] and values['service_url']:
+        values['service_name'] = urlsplit(values['service_url']).hostname or values['service_url']
+
+    if not values['service_name'] or not values['password']:
+        warn(f"Skipping {values['service_name'] or 'unnamed record'} - no service name or password")
+        return None
+    return ImportRecord(**values)
+
+
+@register('legacy', extensions=('.txt', '.ini'))
+def parse_legacy(f, warn=_ignore):
+    """The original text format: a "Service:" line, then [url], username, password, [comments]"""
+    def build(service_name, data_lines):
+        if len(data_lines) < 2:
+            warn(f'Skipping {service_name} - insufficient data (need at least username and password)')
+            return None
+
+        # Check if first line looks like a URL
+        service_url = ""
+        username_index = 0
+        if len(data_lines) >= 3 and ('.' in data_lines[0] or 'http' in data_lines[0].lower()):
+            service_url = data_lines[0]
+            username_index = 1
+
+        return ImportRecord(
+            service_name=service_name,
+            service_url=service_url,
+            username=data_lines[username_index],
+            password=data_lines[username_index + 1],
+            comments='\n'.join(data_lines[username_index + 2:]),
+        )
+
+    current_service_name = None
+    current_data = []
+
+    for line in f:
+        line = line.strip()
+
+        # Check if this is a service line (ends with :)
+        if len(line) > 1 and line.endswith(':'):
+            if current_service_name and current_data:
+                record = build(current_service_name, current_data)
+                if record:
+                    yield record
+
+            current_service_name = line[:-1]
+            current_data = []
+
+        elif line and current_service_name:
+            current_data.append(line)
+
+    if current_service_name and current_data:
+        record = build(current_service_name, current_data)
+        if record:
+            yield record
+
+
+@register('csv', extensions=('.csv',))
+def parse_csv(f, warn=_ignore):
+    """CSV exports with a header row, e.g. from a browser or Bitwarden"""
+    for row in csv.DictReader(f):
+        record = record_from_mapping(row, warn)
+        if record:
+            yield record
+
+
+class _JSONStream:
+    """Incremental reader for the few JSON shapes password managers export
+
+    Only one top-level value is decoded at a time, so arrays of items are
+    read in constant memory whatever their length.
+    """
+
+    def __init__(self, f, chunk_size=65536):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return bool(chunk)
+
+    def peek(self):
+        """Return the next non-whitespace character, or '' at the end"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Invalid JSON: expected {char!r}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next read
+            if end == len(self.buffer) and not isinstance(value, (dict, list, str)) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            separator = self.peek()
+            self.pos += 1
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError("Invalid JSON: expected ',' or ']'")
+
+
+def _iter_json_items(stream):
+    """Yield the items of a top-level array, or of the "items" array of a top-level object"""
+    if stream.peek() == '[':
+        yield from stream.array()
+        return
+
+    stream.expect('{')
+    while stream.peek() != '}':
+        if not stream.peek():
+            raise ValueError("Invalid JSON: unexpected end of file")
+        key = stream.value()
+        stream.expect(':')
+        if key == 'items':
+            yield from stream.array()
+        else:
+            stream.value()
+        if stream.peek() == ',':
+            stream.pos += 1
+
+
+@register('json', extensions=('.json',))
+def parse_json(f, warn=_ignore):
+    """JSON exports: a Bitwarden-style {"items": [...]} document or a list of flat objects"""
+    for item in _iter_json_items(_JSONStream(f)):
+        if not isinstance(item, dict):
+            continue
+        login = item.get('login')
+        if isinstance(login, dict):
+            # Bitwarden: type 1 items hold the credentials under "login"
+            uris = login.get('uris') or []
+            item = {
+                'name': item.get('name'),
+                'notes': item.get('notes'),
+                'username': login.get('username'),
+                'password': login.get('password'),
+                'url': uris[0].get('uri') if uris else None,
+            }
+        elif 'type' in item and item.get('type') != 1:
+            continue  # Secure notes, cards and identities
+        record = record_from_mapping(item, warn)
+        if record:
+            yield record
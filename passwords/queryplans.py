@@ -0,0 +1,40 @@
+"""The app's hot queries, for checking their plans with explain_queries"""
+import datetime
+import re
+
+from django.utils import timezone
+
+from .models import PasswordCategory, PasswordEntry
+
+# Plan lines that mean a table is read in full, or results are sorted afterwards
+_SQLITE_FULL_SCAN = re.compile(r'\bSCAN (\w+)$')
+_SQLITE_SORT = 'USE TEMP B-TREE'
+
+
+def hot_queries(user):
+    """Return {name: queryset} for the queries run on every page or fetch"""
+    category = PasswordCategory.objects.filter(user=user).first()
+    entries = PasswordEntry.objects.filter(user=user)
+    since = timezone.now() - datetime.timedelta(days=7)
+    return {
+        'fetch_data': entries.filter(service_name='example'),
+        'service_names': entries.order_by('service_name').values_list('service_name', flat=True),
+        'admin_list': entries.select_related('category__user')[:100],
+        'admin_list_all_users': PasswordEntry.objects.select_related('category__user')[:100],
+        'admin_category_filter': entries.filter(category=category).select_related('category__user')[:100],
+        'admin_updated_filter': entries.filter(updated_at__gte=since).order_by('-updated_at')[:100],
+        'recently_updated': PasswordEntry.objects.filter(updated_at__gte=since).order_by('-updated_at')[:100],
+    }
+
+
+def plan_problems(plan):
+    """Full table scans and sorts in an SQLite query plan, as readable strings"""
+    problems = []
+    for line in plan.splitlines():
+        line = line.strip(' -|`')
+        match = _SQLITE_FULL_SCAN.search(line)
+        if match:
+            problems.append(f'full scan of {match.group(1)}')
+        elif _SQLITE_SORT in line:
+            problems.append(line.lower())
+    return problems
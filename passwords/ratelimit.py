@@ -0,0 +1,311 @@
+"""Rate limits keyed by user and by client IP
+
+Limits are configured by name in PASSWORD_MANAGER_RATE_LIMITS and applied
+to views with the @rate_limited decorator. Each check costs a constant
+number of backend operations, whatever the traffic:
+
+- sliding_window: at most ``limit`` hits per ``window`` seconds, estimated
+  from the counts of the current and previous fixed windows
+- token_bucket: ``burst`` hits at once, refilled at ``rate`` per second
+
+Backends hold the state: ``local`` (this process, bounded LRU), ``cache``
+(the Django cache, shared between processes; sliding windows only, since
+buckets need an atomic read-modify-write the cache API does not offer)
+and ``db`` (the RateLimitCounter table).
+"""
+from collections import OrderedDict
+from datetime import timedelta
+from functools import wraps
+import hashlib
+import math
+import random
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.http import JsonResponse
+from django.utils import timezone
+
+from .models import RateLimitCounter
+
+SLIDING_WINDOW = 'sliding_window'
+TOKEN_BUCKET = 'token_bucket'
+
+
+class LocalBackend:
+    """In-process state, evicting the least recently used keys beyond max_keys"""
+    blocking = False
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        item = self._entries.get(key)
+        if item is None or item[1] <= now:
+            return None
+        return item[0]
+
+    def _set(self, key, value, timeout, now):
+        self._entries[key] = (value, now + timeout)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key, time.time()) or 0
+
+    def incr(self, key, amount, timeout):
+        with self._lock:
+            now = time.time()
+            item = self._entries.get(key)
+            if item is None or item[1] <= now:
+                self._set(key, amount, timeout, now)
+                return amount
+            self._entries[key] = (item[0] + amount, item[1])
+            return item[0] + amount
+
+    def update(self, key, func, timeout):
+        """Atomically replace the state of key with func(state); return func's result"""
+        with self._lock:
+            now = time.time()
+            state, result = func(self._get(key, now))
+            self._set(key, state, timeout, now)
+            return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CacheBackend:
+    """State in a Django cache, relying on its atomic add() and incr()"""
+    blocking = True
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    def get(self, key):
+        return caches[self.alias].get(key, 0)
+
+    def incr(self, key, amount, timeout):
+        cache = caches[self.alias]
+        if cache.add(key, amount, timeout):
+            return amount
+        try:
+            return cache.incr(key, amount)
+        except ValueError:  # Expired between add() and incr()
+            cache.add(key, 0, timeout)
+            return cache.incr(key, amount)
+
+    def update(self, key, func, timeout):
+        raise ImproperlyConfigured("The cache rate limit backend only supports sliding windows")
+
+
+class DatabaseBackend:
+    """State in the RateLimitCounter table"""
+    blocking = True
+
+    def get(self, key):
+        counter = RateLimitCounter.objects.filter(key=key, expires_at__gt=timezone.now()).values_list('count', flat=True)
+        return counter.first() or 0
+
+    def _create(self, key, count, stamp, timeout):
+        now = timezone.now()
+        if random.random() < 0.01:
+            RateLimitCounter.objects.filter(expires_at__lte=now).delete()
+        RateLimitCounter.objects.update_or_create(
+            key=key,
+            defaults={'count': count, 'stamp': stamp, 'expires_at': now + timedelta(seconds=timeout)},
+        )
+
+    def incr(self, key, amount, timeout):
+        with transaction.atomic():
+            live = RateLimitCounter.objects.filter(key=key, expires_at__gt=timezone.now())
+            if live.update(count=F('count') + amount):
+                return live.values_list('count', flat=True).first()
+            try:
+                with transaction.atomic():
+                    self._create(key, amount, 0, timeout)
+            except IntegrityError:  # Created concurrently
+                live.update(count=F('count') + amount)
+                return live.values_list('count', flat=True).first()
+            return amount
+
+    def update(self, key, func, timeout):
+        with transaction.atomic():
+            counter = (
+                RateLimitCounter.objects.select_for_update()
+                .filter(key=key, expires_at__gt=timezone.now()).first()
+            )
+            state, result = func((counter.count, counter.stamp) if counter else None)
+            self._create(key, *state, timeout)
+            return result
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name):
+    """Return the shared backend instance for a name: local, cache or db"""
+    with _backends_lock:
+        if name not in _backends:
+            if name == 'local':
+                _backends[name] = LocalBackend(getattr(settings, 'PASSWORD_MANAGER_RATE_LIMIT_MAX_KEYS', 100000))
+            elif name == 'cache':
+                _backends[name] = CacheBackend(getattr(settings, 'PASSWORD_MANAGER_RATE_LIMIT_CACHE', 'default'))
+            elif name == 'db':
+                _backends[name] = DatabaseBackend()
+            else:
+                raise ImproperlyConfigured(f"Unknown rate limit backend: {name}")
+        return _backends[name]
+
+
+class SlidingWindow:
+    """At most ``limit`` hits per ``window`` seconds"""
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+
+    def hit(self, backend, key, cost=1):
+        """Record a hit; return (allowed, seconds to wait before retrying)"""
+        now = time.time()
+        current = math.floor(now / self.window)
+        elapsed = now / self.window - current
+        count = backend.incr(f'{key}:{current}', cost, self.window * 2)
+        previous = backend.get(f'{key}:{current - 1}')
+        # Weight the previous window by how much of it the sliding window still covers
+        if previous * (1 - elapsed) + count <= self.limit:
+            return True, 0
+        backend.incr(f'{key}:{current}', -cost, self.window * 2)
+        return False, max(1, math.ceil((1 - elapsed) * self.window))
+
+
+class TokenBucket:
+    """Up to ``burst`` hits at once, refilled at ``rate`` hits per second"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+    def hit(self, backend, key, cost=1):
+        """Take ``cost`` tokens; return (allowed, seconds to wait before retrying)"""
+        now = time.time()
+
+        def take(state):
+            tokens, stamp = state or (self.burst, now)
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            if tokens >= cost:
+                return (tokens - cost, now), (True, 0)
+            return (tokens, now), (False, max(1, math.ceil((cost - tokens) / self.rate)))
+
+        return backend.update(key, take, math.ceil(self.burst / self.rate) + 1)
+
+
+def _client_ip(request, user):
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def _user_key(request, user):
+    """The authenticated user, or the username being logged in as"""
+    if user is not None and user.is_authenticated:
+        return f'id:{user.pk}'
+    username = request.POST.get('login', '')
+    return f'name:{username}' if username else None
+
+
+KEY_FUNCTIONS = {
+    'user': _user_key,
+    'ip': _client_ip,
+}
+
+
+class RateLimit:
+    """One configured limit: an algorithm applied to each key of a request"""
+
+    def __init__(self, name, algorithm, keys=('user', 'ip'), backend='local'):
+        self.name = name
+        self.algorithm = algorithm
+        self.keys = keys
+        self.backend = get_backend(backend)
+
+    @classmethod
+    def from_settings(cls, name):
+        """Build the limit called name in PASSWORD_MANAGER_RATE_LIMITS, or None if unset"""
+        config = getattr(settings, 'PASSWORD_MANAGER_RATE_LIMITS', {}).get(name)
+        if not config:
+            return None
+        config = dict(config)
+        kind = config.pop('algorithm', SLIDING_WINDOW)
+        if kind == SLIDING_WINDOW:
+            algorithm = SlidingWindow(config.pop('limit'), config.pop('window'))
+        elif kind == TOKEN_BUCKET:
+            algorithm = TokenBucket(config.pop('rate'), config.pop('burst'))
+        else:
+            raise ImproperlyConfigured(f"Unknown rate limit algorithm: {kind}")
+        backend = config.pop('backend', getattr(settings, 'PASSWORD_MANAGER_RATE_LIMIT_BACKEND', 'local'))
+        return cls(name, algorithm, backend=backend, **config)
+
+    def hit(self, request, user, cost=1):
+        """Count a request against every key; return seconds to wait, or 0 if allowed"""
+        for key_name in self.keys:
+            value = KEY_FUNCTIONS[key_name](request, user)
+            if not value:
+                continue
+            # Hashed so that any username makes a short, cache-safe key
+            digest = hashlib.sha256(value.encode()).hexdigest()[:32]
+            allowed, retry_after = self.algorithm.hit(self.backend, f'ratelimit:{self.name}:{key_name}:{digest}', cost)
+            if not allowed:
+                return retry_after
+        return 0
+
+
+def too_many_requests(request, retry_after):
+    response = JsonResponse({'error': 'Too many requests - please try again later'}, status=429)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+def rate_limited(name, cost=None, limited_response=too_many_requests):
+    """Apply the PASSWORD_MANAGER_RATE_LIMITS entry ``name`` to a sync or async view
+
+    ``cost`` optionally computes the number of hits a request counts for;
+    a request that counts for none is let through without touching the limit.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                limit = RateLimit.from_settings(name)
+                hits = cost(request) if cost else 1
+                if limit is not None and hits:
+                    user = await request.auser()
+                    if limit.backend.blocking:
+                        retry_after = await sync_to_async(limit.hit)(request, user, hits)
+                    else:
+                        retry_after = limit.hit(request, user, hits)
+                    if retry_after:
+                        return limited_response(request, retry_after)
+                return await view(request, *args, **kwargs)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            limit = RateLimit.from_settings(name)
+            hits = cost(request) if cost else 1
+            if limit is not None and hits:
+                retry_after = limit.hit(request, request.user, hits)
+                if retry_after:
+                    return limited_response(request, retry_after)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,148 @@
+from cryptography.fernet import InvalidToken
+from django.db import transaction
+from django.db.models import F
+import logging
+
+from .agent import AgentError, get_agent
+from .crypto import decrypt_value, generate_data_key, unwrap_key, wrap_key
+from .models import KeyRotationInProgress, PasswordEntry, UserEncryptionProfile, VaultKeyRotation
+
+
+logger = logging.getLogger(__name__)
+
+
+class RotationError(Exception):
+    """Raised when a vault key rotation cannot proceed safely"""
+
+
+def _unlock(profile, password):
+    try:
+        return profile.unlock(password)
+    except InvalidToken:
+        raise RotationError("Password cannot unlock this vault")
+
+
+def change_password(user, old_password, new_password, update_login_password=True):
+    """Rewrap a user's data key for a new password
+
+    Only the encryption profile row changes; entries stay encrypted with
+    the same data key. The profile also moves to the configured KDF.
+    The user's login password is updated to match unless
+    ``update_login_password`` is False.
+    """
+    if VaultKeyRotation.objects.filter(user=user).exists():
+        raise RotationError("Finish the interrupted data key rotation first")
+
+    profile = UserEncryptionProfile.get_or_create_for_user(user)
+    data_key = _unlock(profile, old_password)
+
+    with transaction.atomic():
+        # A rotation may have replaced the data key since it was unwrapped
+        try:
+            generation = UserEncryptionProfile.lock_for_writes(user.pk)
+        except KeyRotationInProgress:
+            raise RotationError("Finish the interrupted data key rotation first")
+        if generation != profile.key_generation:
+            raise RotationError("The data key was rotated meanwhile; try again")
+        profile.wrap_data_key(new_password, data_key)
+        profile.save(update_fields=['salt', 'kdf_algorithm', 'kdf_params', 'wrapped_key'])
+        if update_login_password:
+            user.set_password(new_password)
+            user.save(update_fields=['password'])
+
+
+def upgrade_kdf(user, password):
+    """Rewrap a user's data key with the configured KDF if it uses an older one
+
+    Needs the plaintext password, so it runs when the user logs in.
+    Returns True if an upgrade was performed.
+    """
+    profile = UserEncryptionProfile.get_or_create_for_user(user)
+    if not profile.needs_kdf_upgrade() or VaultKeyRotation.objects.filter(user=user).exists():
+        return False
+    change_password(user, password, password, update_login_password=False)
+    return True
+
+
+def _reencrypt_chunk(entries, old_key, new_key):
+    for entry in entries:
+        try:
+            plaintext = decrypt_value(old_key, entry.stored_password)
+        except (InvalidToken, ValueError):
+            raise RotationError(f"Data key cannot decrypt entry {entry.pk} ({entry.service_name})")
+        entry.encrypt_password(plaintext, new_key)
+
+
+def rotate_data_key(user, password, chunk_size=500, progress=None):
+    """Re-encrypt a user's whole vault under a new random data key
+
+    Entries are processed in primary key order, one chunk per transaction,
+    and the last rotated id is checkpointed after each chunk so that an
+    interrupted run resumes where it stopped. Only one chunk is held in
+    memory at a time. The new data key is kept in the checkpoint, wrapped
+    like the current one, and replaces it once every entry is rotated.
+
+    ``progress`` is called with (rotated_count, last_entry_id) after each
+    chunk. Returns the number of entries rotated by this call.
+    """
+    profile = UserEncryptionProfile.get_or_create_for_user(user)
+    old_key = _unlock(profile, password)
+    key_encryption_key = profile.derive_key_from_password(password)
+
+    rotation = VaultKeyRotation.objects.filter(user=user).first()
+    if rotation is None:
+        new_key = generate_data_key()
+        with transaction.atomic():
+            # Wait for entries being written under the old key, see lock_for_writes()
+            UserEncryptionProfile.objects.select_for_update().filter(pk=profile.pk).first()
+            rotation = VaultKeyRotation.objects.create(
+                user=user,
+                new_wrapped_key=wrap_key(key_encryption_key, new_key),
+            )
+    else:
+        new_key = unwrap_key(key_encryption_key, rotation.new_wrapped_key)
+
+    entries = PasswordEntry.objects.filter(user=user).with_password().order_by('pk')
+    rotated = 0
+
+    try:
+        while True:
+            with transaction.atomic():
+                chunk = list(
+                    entries.filter(pk__gt=rotation.last_entry_id)
+                    .only('pk', 'service_name', 'ciphertext', 'encrypted_password')[:chunk_size]
+                )
+                if not chunk:
+                    break
+
+                _reencrypt_chunk(chunk, old_key, new_key)
+                PasswordEntry.objects.bulk_update(chunk, ['ciphertext', 'encrypted_password'])
+
+                rotation.last_entry_id = chunk[-1].pk
+                rotation.save(update_fields=['last_entry_id', 'updated_at'])
+
+            rotated += len(chunk)
+            if progress:
+                progress(rotated, rotation.last_entry_id)
+    except RotationError:
+        # Nothing was rotated yet, so drop the checkpoint altogether
+        if rotation.last_entry_id == 0:
+            rotation.delete()
+        raise
+
+    with transaction.atomic():
+        # Keys of the previous generation, cached by sessions or the agent, are no longer used
+        profile.wrapped_key = rotation.new_wrapped_key
+        profile.key_generation = F('key_generation') + 1
+        profile.save(update_fields=['wrapped_key', 'key_generation'])
+        rotation.delete()
+
+    # The key agent must not keep encrypting with the old data key
+    agent = get_agent()
+    if agent is not None:
+        try:
+            agent.lock(user.pk)
+        except AgentError as e:
+            logger.warning('Key agent did not forget the old data key of %s: %s', user.username, e)
+
+    return rotated
@@ -0,0 +1,259 @@
+from collections import OrderedDict
+import heapq
+import re
+import threading
+import unicodedata
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+from .models import PasswordEntry
+
+SEARCH_FIELDS = ('service_name', 'username', 'service_url')
+
+# Result tiers, best first
+EXACT, PREFIX, FUZZY = 0, 1, 2
+
+# Fuzzy matching costs O(len(query)) per trie node visited
+MAX_QUERY_LENGTH = 64
+
+_TOKEN_SPLIT = re.compile(r'[^0-9a-z]+')
+
+
+def normalize(text):
+    """Lowercase and strip diacritics, like normalizeString() in main.js"""
+    decomposed = unicodedata.normalize('NFD', text.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def url_host(value):
+    """The host of a URL without its scheme and ``www.``, or None if value is not a URL"""
+    if '://' not in value:
+        return None
+    try:
+        host = urlsplit(value).hostname
+    except ValueError:
+        return None
+    if host and host.startswith('www.'):
+        host = host[4:]
+    return host or None
+
+
+def index_terms(values):
+    """Terms indexed for an entry: each full value, the host of URLs, and their word tokens"""
+    terms = set()
+    for value in values:
+        value = normalize(value or '').strip()
+        if not value:
+            continue
+        terms.add(value)
+        host = url_host(value)
+        if host:
+            terms.add(host)
+        terms.update(token for token in _TOKEN_SPLIT.split(value) if token)
+    return terms
+
+
+class _Node:
+    __slots__ = ('children', 'entry_ids')
+
+    def __init__(self):
+        self.children = {}
+        self.entry_ids = None  # Entries with a term ending here
+
+
+class SearchIndex:
+    """Trie over one user's entries supporting prefix and fuzzy-prefix lookups"""
+
+    def __init__(self, version=None):
+        self.version = version  # Of the entries it was built from, see PasswordEntryQuerySet.version()
+        self.root = _Node()
+        self.entries = {}  # entry_id -> (service_name, terms)
+        self.term_count = 0
+
+    def add(self, entry_id, service_name, values):
+        self.remove(entry_id)
+        terms = index_terms([service_name, *values])
+        self.entries[entry_id] = (service_name, terms)
+        for term in terms:
+            node = self.root
+            for char in term:
+                node = node.children.setdefault(char, _Node())
+            if node.entry_ids is None:
+                node.entry_ids = set()
+            node.entry_ids.add(entry_id)
+        self.term_count += len(terms)
+
+    def remove(self, entry_id):
+        previous = self.entries.pop(entry_id, None)
+        if previous is None:
+            return
+        _, terms = previous
+        for term in terms:
+            self._remove_term(term, entry_id)
+        self.term_count -= len(terms)
+
+    def _remove_term(self, term, entry_id):
+        path = [self.root]
+        for char in term:
+            node = path[-1].children.get(char)
+            if node is None:
+                return
+            path.append(node)
+        leaf = path[-1]
+        if leaf.entry_ids:
+            leaf.entry_ids.discard(entry_id)
+            if not leaf.entry_ids:
+                leaf.entry_ids = None
+        # Prune branches that no longer lead to any term
+        for depth in range(len(term), 0, -1):
+            node = path[depth]
+            if node.children or node.entry_ids:
+                break
+            del path[depth - 1].children[term[depth - 1]]
+
+    def _collect(self, node, prefix, budget, found):
+        """Depth-first walk yielding (term, entry_id) under node, in term order"""
+        stack = [(node, prefix)]
+        while stack and budget > 0:
+            node, term = stack.pop()
+            if node.entry_ids:
+                for entry_id in node.entry_ids:
+                    if entry_id not in found:
+                        budget -= 1
+                    yield term, entry_id
+            for char in sorted(node.children, reverse=True):
+                stack.append((node.children[char], term + char))
+
+    def _prefix_matches(self, query, budget):
+        node = self.root
+        for char in query:
+            node = node.children.get(char)
+            if node is None:
+                return {}
+        found = {}
+        for term, entry_id in self._collect(node, query, budget, found):
+            tier = EXACT if term == query else PREFIX
+            found[entry_id] = min(found.get(entry_id, (tier, 0)), (tier, 0))
+        return found
+
+    def _fuzzy_matches(self, query, max_distance, budget):
+        """Entries with a term whose prefix is within max_distance edits of query"""
+        found = {}
+        first_row = list(range(len(query) + 1))
+        stack = [(self.root, '', first_row)]
+        while stack and len(found) < budget:
+            node, prefix, row = stack.pop()
+            if row[-1] <= max_distance and prefix:
+                for _, entry_id in self._collect(node, prefix, budget - len(found), found):
+                    found[entry_id] = min(found.get(entry_id, (FUZZY, row[-1])), (FUZZY, row[-1]))
+                continue
+            if min(row) > max_distance:
+                continue
+            for char, child in node.children.items():
+                next_row = [row[0] + 1]
+                for i, query_char in enumerate(query, 1):
+                    next_row.append(min(
+                        next_row[i - 1] + 1,
+                        row[i] + 1,
+                        row[i - 1] + (query_char != char),
+                    ))
+                stack.append((child, prefix + char, next_row))
+        return found
+
+    def search(self, query, limit=6, max_distance=None):
+        """Return up to ``limit`` service names, best matches first"""
+        query = normalize(query).strip()
+        if not query:
+            return []
+        budget = limit * 4
+
+        found = self._prefix_matches(query, budget)
+        if len(found) < limit:
+            if max_distance is None:
+                max_distance = 0 if len(query) < 3 else 1 if len(query) < 6 else 2
+            if max_distance:
+                for entry_id, score in self._fuzzy_matches(query, max_distance, budget).items():
+                    found.setdefault(entry_id, score)
+
+        ranked = heapq.nsmallest(
+            limit,
+            found.items(),
+            key=lambda item: (item[1], normalize(self.entries[item[0]][0])),
+        )
+        return [self.entries[entry_id][0] for entry_id, _ in ranked]
+
+
+class SearchIndexRegistry:
+    """Lazily built per-user indexes, LRU-evicted beyond a total term budget
+
+    Each lookup reads the version stamp of the user's entries from the
+    database, and the index is rebuilt when it changed, so entries written
+    by other processes are found too. Indexes are never modified once
+    built, so they are searched without any lock, and a rebuild only holds
+    a lock of its user: the registry lock just guards the LRU bookkeeping.
+    """
+
+    def __init__(self, max_users=256, max_terms=500000):
+        self.max_users = max_users
+        self.max_terms = max_terms
+        self._indexes = OrderedDict()
+        self._build_locks = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, user_id, version):
+        """The index of a user if it is for this version; call with the registry lock held"""
+        index = self._indexes.get(user_id)
+        if index is None or index.version != version:
+            return None
+        self._indexes.move_to_end(user_id)
+        return index
+
+    def get(self, user_id):
+        version = PasswordEntry.objects.filter(user_id=user_id).version()
+        with self._lock:
+            index = self._cached(user_id, version)
+            if index is not None:
+                return index
+            build_lock = self._build_locks.setdefault(user_id, threading.Lock())
+
+        # One build per user at a time; other users' searches go on meanwhile
+        with build_lock:
+            with self._lock:
+                index = self._cached(user_id, version)
+            if index is None:
+                index = self._build(user_id, version)
+                with self._lock:
+                    self._indexes[user_id] = index
+                    self._indexes.move_to_end(user_id)
+                    self._evict()
+            with self._lock:
+                self._build_locks.pop(user_id, None)
+        return index
+
+    def search(self, user_id, query, limit=6):
+        return self.get(user_id).search(query, limit=limit)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+    def _build(self, user_id, version):
+        index = SearchIndex(version)
+        rows = PasswordEntry.objects.filter(user_id=user_id).values_list('pk', *SEARCH_FIELDS)
+        for entry_id, service_name, *values in rows.iterator(chunk_size=2000):
+            index.add(entry_id, service_name, values)
+        return index
+
+    def _evict(self):
+        total = sum(index.term_count for index in self._indexes.values())
+        # Always keep the most recently used index
+        while len(self._indexes) > 1 and (len(self._indexes) > self.max_users or total > self.max_terms):
+            _, index = self._indexes.popitem(last=False)
+            total -= index.term_count
+
+
+search_indexes = SearchIndexRegistry(
+    max_users=getattr(settings, 'PASSWORD_MANAGER_SEARCH_INDEX_USERS', 256),
+    max_terms=getattr(settings, 'PASSWORD_MANAGER_SEARCH_INDEX_TERMS', 500000),
+)
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.cache import cache
+import hashlib
+import json
+
+from .models import PasswordEntry
+
+CACHE_KEY = 'passwords:service-index:{}:{}'
+
+
+def service_index_etag(user_id):
+    """The ETag of a user's service list, from a version stamp read from the database
+
+    Changes made by any process, including management commands, change it
+    at once; there is nothing to invalidate.
+    """
+    version = PasswordEntry.objects.filter(user_id=user_id).version()
+    return hashlib.sha256(json.dumps([user_id, *version]).encode()).hexdigest()[:32]
+
+
+def get_service_index(user_id, etag=None):
+    """Return (service_names, etag) for a user, the names cached for as long as the ETag holds"""
+    if etag is None:
+        etag = service_index_etag(user_id)
+    cache_key = CACHE_KEY.format(user_id, etag)
+    service_names = cache.get(cache_key)
+    if service_names is None:
+        service_names = list(
+            PasswordEntry.objects.filter(user_id=user_id)
+            .order_by('service_name')
+            .values_list('service_name', flat=True)
+        )
+        cache.set(cache_key, service_names, getattr(settings, 'PASSWORD_MANAGER_SERVICE_INDEX_TTL', 3600))
+    return service_names, etag
@@ -0,0 +1,29 @@
+from django.contrib.auth.signals import user_logged_out
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from .agent import AgentError, get_agent
+from .keycache import key_cache
+from .metrics import time_query
+
+
+@receiver(user_logged_out)
+def forget_session_key(sender, request, user, **kwargs):
+    """Drop the cached encryption key when the session ends"""
+    session_key = None
+    if request is not None and hasattr(request, 'session'):
+        session_key = request.session.session_key
+        key_cache.invalidate(session_key)
+    agent = get_agent()
+    if agent is not None and user is not None and session_key is not None:
+        try:
+            agent.lock(user.pk, session_key)  # Other sessions of the user keep the key
+        except AgentError:
+            pass  # The agent forgets the key on its own once it expires
+
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    """Count each query towards the request's metrics (a no-op outside instrumented requests)"""
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
@@ -0,0 +1,63 @@
+// Admin change form: loads the current password of an entry only when needed
+
+// Posts to the reveal endpoint; returns the JSON response, or null on error
+async function requestPassword(url, reveal) {
+    const body = new FormData();
+    body.append("csrfmiddlewaretoken", document.querySelector("[name=csrfmiddlewaretoken]").value);
+    if (reveal)
+        body.append("reveal", "1");
+    try {
+        const response = await fetch(url, {method: "POST", body: body, credentials: "same-origin"});
+        const data = await response.json();
+        return response.ok ? data : {error: data.error};
+    } catch (error) {
+        return {error: "Unable to load current password"};
+    }
+}
+
+function addButton(input, label, onClick) {
+    const button = document.createElement("button");
+    button.type = "button";
+    button.className = "button";
+    button.textContent = label;
+    button.addEventListener("click", onClick);
+    input.parentNode.insertBefore(button, input.nextSibling);
+    return button;
+}
+
+function setupReveal(input) {
+    const url = input.dataset.revealUrl;
+    const shown = document.createElement("code");
+
+    // Masked preview, once the page is displayed
+    requestPassword(url, false).then(function(data) {
+        input.placeholder = data.error || "Current: " + data.masked;
+    });
+
+    const copy = addButton(input, "Copy", async function() {
+        const data = await requestPassword(url, true);
+        if (data.error) {
+            input.placeholder = data.error;
+            return;
+        }
+        await navigator.clipboard.writeText(data.password);
+        copy.textContent = "Copied";
+        setTimeout(function() { copy.textContent = "Copy"; }, 2000);
+    });
+
+    const reveal = addButton(input, "Reveal", async function() {
+        if (shown.textContent) {
+            shown.textContent = "";
+            reveal.textContent = "Reveal";
+            return;
+        }
+        const data = await requestPassword(url, true);
+        shown.textContent = data.error || data.password;
+        reveal.textContent = "Hide";
+    });
+    copy.parentNode.insertBefore(shown, copy.nextSibling);
+}
+
+document.addEventListener("DOMContentLoaded", function() {
+    document.querySelectorAll("input[data-reveal-url]").forEach(setupReveal);
+});
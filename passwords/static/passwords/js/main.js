@@ -1,5 +1,23 @@
 // Password manager JavaScript - converted from original main.js
 
+// Service names, loaded lazily from the server
+var list = [];
+
+// Loads the service list; the browser revalidates it with If-None-Match
+async function loadServiceList() {
+    try {
+        const response = await fetch(serviceNamesUrl, {credentials: "same-origin"});
+        if (response.ok) {
+            const jsonData = await response.json();
+            list = jsonData.services;
+        }
+    } catch (error) {
+        list = [];
+    }
+}
+
+document.addEventListener("DOMContentLoaded", loadServiceList);
+
 // Empties an element
 function emptyElement(elt) {
     while(elt.lastChild)
@@ -39,7 +57,11 @@ function selectService(serviceName) {
     sendRequest(serviceName);
 }
 
-// Main search function - simplified and modernized
+// Pending search request, aborted when the user keeps typing
+var searchController = null;
+var searchTimer = null;
+
+// Main search function - exact matches are resolved locally, suggestions come from the server
 function handleSearch() {
     const input = document.querySelector('input[name="input"]').value.trim();
     const suggestionsEl = document.getElementById("suggestions");
@@ -50,6 +72,9 @@ function handleSearch() {
     suggestionsEl.style.display = 'none';
     outputEl.innerHTML = '';
 
+    clearTimeout(searchTimer);
+    if (searchController) searchController.abort();
+
     if (!input) return;
 
     // Find exact match first
@@ -62,13 +87,25 @@ function handleSearch() {
         return;
     }
 
-    // Show suggestions for partial matches
-    const suggestions = list
-        .filter(service =>
-            normalizeString(service).startsWith(normalizeString(input))
-        )
-        .sort((a, b) => a.localeCompare(b))
-        .slice(0, 6); // Limit to 6 suggestions
+    // Debounce suggestion requests while the user is typing
+    searchTimer = setTimeout(() => fetchSuggestions(input), 150);
+}
+
+async function fetchSuggestions(input) {
+    const suggestionsEl = document.getElementById("suggestions");
+
+    searchController = new AbortController();
+    let suggestions = [];
+    try {
+        const response = await fetch(searchUrl + "?limit=6&q=" + encodeURIComponent(input), {
+            credentials: "same-origin",
+            signal: searchController.signal
+        });
+        if (!response.ok) return;
+        suggestions = (await response.json()).results;
+    } catch (error) {
+        return;
+    }
 
     if (suggestions.length > 0) {
         suggestions.forEach(service => {
@@ -1,3 +1,1279 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import iscoroutinefunction
+from cryptography.fernet import Fernet, InvalidToken
+from django.contrib.auth.models import AnonymousUser, Permission, User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F
+from django.test import AsyncRequestFactory, Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import backup, benchmarks, fulltext, kdf, metrics, parsers, ratelimit, views
+from .agent import AgentError, AgentServer, KeyAgent, get_agent
+from .keycache import COOKIE_NAME, KeyCache, key_cache
+from .management.commands.import_passwords import Command as ImportCommand
+from .throttle import LoginThrottle, login_throttle
+from .crypto import (
+    decrypt_value, decrypt_values, encrypt_value, encrypt_values, fingerprints, to_binary, to_legacy_text,
+)
+from .queryplans import hot_queries, plan_problems
+from .models import PasswordCategory, PasswordEntry, RateLimitCounter, UserEncryptionProfile, VaultKeyRotation
+from .rotation import RotationError, _reencrypt_chunk, change_password, rotate_data_key
+from .search import SearchIndex, SearchIndexRegistry, search_indexes
+from .workers import BACKENDS, CryptoPool
+
+
+class VaultTestMixin:
+    """A user whose vault is cheap to unlock, and who is not rate limited"""
+
+    USERNAME = 'vault'
+    PASSWORD = 'vault-password'
+
+    def setUp(self):
+        super().setUp()
+        self.enterContext(override_settings(
+            PASSWORD_MANAGER_KDF={'algorithm': 'pbkdf2_sha256', 'params': {'iterations': 1000}},
+            PASSWORD_MANAGER_RATE_LIMITS={},
+        ))
+        self.addCleanup(ratelimit.get_backend('local').clear)
+
+    def create_vault(self, count):
+        """Create the user with ``count`` encrypted entries; return the user"""
+        user = User.objects.create_user(self.USERNAME, password=self.PASSWORD)
+        category = PasswordCategory.objects.create(user=user, name='personal')
+        key = UserEncryptionProfile.get_or_create_for_user(user).unlock(self.PASSWORD)
+        entries = [
+            PasswordEntry(
+                category=category,
+                user=user,
+                service_name=f'service-{i:06d}',
+                service_url=f'https://service-{i}.example.com',
+                username=f'user-{i}',
+            )
+            for i in range(count)
+        ]
+        for i, entry in enumerate(entries):
+            entry.encrypt_password(f'password-{i}', key)
+        PasswordEntry.objects.bulk_create(entries)
+        return user
+
+    def login(self, client=None):
+        return (client or self.client).post('/check_login/', {'login': self.USERNAME, 'password': self.PASSWORD})
+
+    def start_agent(self):
+        """Run a key agent in a thread on a temporary socket, and use it"""
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'agent.sock')
+        server = AgentServer(path, KeyAgent())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.enterContext(override_settings(PASSWORD_MANAGER_KEY_AGENT_SOCKET=path))
+        return server
+
+
+class AdminQueryCountTests(TestCase):
+    """Admin pages must issue the same number of queries whatever the data size"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'admin-password')
+        cls.other_user = User.objects.create_user('other', password='other-password')
+        UserEncryptionProfile.get_or_create_for_user(cls.admin_user)
+        UserEncryptionProfile.get_or_create_for_user(cls.other_user)
+        cls.category = cls.add_data(1)
+
+    @classmethod
+    def add_data(cls, count):
+        """Create categories for both users, each with a couple of entries"""
+        first_category = None
+        offset = PasswordCategory.objects.count()
+        for i in range(offset, offset + count):
+            for user in (cls.admin_user, cls.other_user):
+                category = PasswordCategory.objects.create(user=user, name=f'category-{i}')
+                first_category = first_category or category
+                for j in range(2):
+                    PasswordEntry.objects.create(
+                        category=category,
+                        user=user,
+                        service_name=f'service-{i}-{j}',
+                        username=f'user-{i}-{j}',
+                        encrypted_password='',
+                    )
+        return first_category
+
+    def setUp(self):
+        self.client.force_login(self.admin_user)
+
+    def count_queries(self, url):
+        # Warm up per-process caches (content types, permissions) first
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def assertConstantQueries(self, url):
+        small = self.count_queries(url)
+        self.add_data(20)
+        self.assertEqual(self.count_queries(url), small)
+
+    def test_category_changelist(self):
+        self.assertConstantQueries(reverse('admin:passwords_passwordcategory_changelist'))
+
+    def test_entry_changelist(self):
+        self.assertConstantQueries(reverse('admin:passwords_passwordentry_changelist'))
+
+    def test_profile_changelist(self):
+        self.assertConstantQueries(reverse('admin:passwords_userencryptionprofile_changelist'))
+
+    def test_category_change_page(self):
+        url = reverse('admin:passwords_passwordcategory_change', args=[self.category.pk])
+        small = self.count_queries(url)
+        for j in range(2, 20):
+            PasswordEntry.objects.create(
+                category=self.category,
+                user=self.admin_user,
+                service_name=f'extra-{j}',
+                username='extra',
+                encrypted_password='',
+            )
+        self.assertEqual(self.count_queries(url), small)
+
+    def test_entry_change_page(self):
+        entry = self.category.entries.first()
+        self.assertConstantQueries(reverse('admin:passwords_passwordentry_change', args=[entry.pk]))
+
+    def test_profile_keys_are_read_only(self):
+        profile = UserEncryptionProfile.objects.get(user=self.admin_user)
+        response = self.client.get(reverse('admin:passwords_userencryptionprofile_change', args=[profile.pk]))
+        self.assertNotContains(response, 'name="wrapped_key"')
+        self.assertNotContains(response, 'name="salt"')
+
+    def test_entry_count_column(self):
+        response = self.client.get(reverse('admin:passwords_passwordcategory_changelist'))
+        counts = {category.pk: category.entry_count for category in response.context['cl'].result_list}
+        self.assertEqual(counts[self.category.pk], 2)
+
+
+
+class ChangeListPaginationTests(TestCase):
+    """The entry changelist pages by sort key and counts at most a limit of rows"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'admin-password')
+        category = PasswordCategory.objects.create(user=cls.admin_user, name='Bulk')
+        PasswordEntry.objects.bulk_create(
+            PasswordEntry(category=category, user=cls.admin_user, service_name=f'service-{i:03d}', username='me')
+            for i in range(250)
+        )
+        cls.url = reverse('admin:passwords_passwordentry_changelist')
+
+    def setUp(self):
+        self.client.force_login(self.admin_user)
+
+    def get_page(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.context['cl']
+
+    def names(self, cl):
+        return [entry.service_name for entry in cl.result_list]
+
+    def test_walk_forward_and_back(self):
+        pages = [self.get_page(self.url)]
+        while pages[-1].paginator.next_url:
+            pages.append(self.get_page(self.url + pages[-1].paginator.next_url))
+        names = [name for cl in pages for name in self.names(cl)]
+        self.assertEqual(names, [f'service-{i:03d}' for i in range(250)])
+        self.assertFalse(pages[0].paginator.previous_url)
+
+        previous = self.get_page(self.url + pages[-1].paginator.previous_url)
+        self.assertEqual(self.names(previous), self.names(pages[1]))
+        first = self.get_page(self.url + previous.paginator.previous_url)
+        self.assertEqual(self.names(first), self.names(pages[0]))
+        self.assertFalse(first.paginator.previous_url)
+
+    def test_deep_pages_skip_no_rows(self):
+        second = self.get_page(self.url).paginator.next_url
+        with CaptureQueriesContext(connection) as context:
+            self.get_page(self.url + second)
+        self.assertFalse([query['sql'] for query in context if 'OFFSET' in query['sql']])
+
+    def test_bounded_count(self):
+        with override_settings(PASSWORD_MANAGER_ADMIN_COUNT_LIMIT=200):
+            response = self.client.get(self.url)
+        self.assertEqual(response.context['cl'].result_count, 200)
+        self.assertContains(response, 'More than')
+        self.assertEqual(self.get_page(self.url).result_count, 250)
+
+    def test_invalid_cursor(self):
+        cl = self.get_page(self.url + '?cursor=garbage')
+        self.assertEqual(self.names(cl)[0], 'service-000')
+
+    def test_search_pages_by_offset(self):
+        if not fulltext.is_available():
+            self.skipTest('No full-text index on this database')
+        cl = self.get_page(self.url + '?q=service')
+        self.assertIn('p=2', cl.paginator.next_url)
+        self.assertEqual(len(self.get_page(self.url + cl.paginator.next_url).result_list), 100)
+
+
+class FullTextSearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'admin-password')
+        cls.category = PasswordCategory.objects.create(user=cls.admin_user, name='Banking')
+        for service_name, comments in (('Credit Union', ''), ('Archive', 'backup codes for credit card'), ('Forum', '')):
+            PasswordEntry.objects.create(
+                category=cls.category,
+                user=cls.admin_user,
+                service_name=service_name,
+                username='me',
+                comments=comments,
+                encrypted_password='',
+            )
+
+    def setUp(self):
+        if not fulltext.is_available():
+            self.skipTest('No full-text index on this database')
+        self.client.force_login(self.admin_user)
+
+    def search(self, term):
+        response = self.client.get(reverse('admin:passwords_passwordentry_changelist'), {'q': term})
+        return [entry.service_name for entry in response.context['cl'].result_list]
+
+    def test_ranked_by_field(self):
+        self.assertEqual(self.search('credit'), ['Credit Union', 'Archive'])
+
+    def test_prefix_and_all_words(self):
+        self.assertEqual(self.search('back cred'), ['Archive'])
+
+    def test_follows_category_renames(self):
+        self.category.name = 'Crédit'
+        self.category.save()
+        self.assertEqual(self.search('credit forum'), ['Forum'])
+
+    def test_column_ordering(self):
+        response = self.client.get(reverse('admin:passwords_passwordentry_changelist'), {'q': 'credit', 'o': '1'})
+        self.assertEqual([entry.service_name for entry in response.context['cl'].result_list], ['Archive', 'Credit Union'])
+
+
+class ServiceIndexTests(VaultTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_vault(3)
+        self.client.force_login(self.user)
+
+    def get(self, etag=None):
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.client.get('/services/', headers=headers)
+
+    def test_etag(self):
+        response = self.get()
+        self.assertEqual(response.json()['services'], ['service-000000', 'service-000001', 'service-000002'])
+        etag = response['ETag']
+        self.assertEqual(self.get(etag).status_code, 304)
+
+        # Written without signals, as by import_passwords in another process
+        entry = PasswordEntry.objects.get(service_name='service-000001')
+        PasswordEntry.objects.bulk_create([PasswordEntry(category=entry.category, user=self.user, service_name='new')])
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('new', response.json()['services'])
+
+        PasswordEntry.objects.filter(service_name='new')._raw_delete('default')
+        response = self.get(response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_version_uses_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Plans are only checked on SQLite')
+        entries = PasswordEntry.objects.filter(user=self.user)
+        with CaptureQueriesContext(connection) as context:
+            entries.version()
+        plan = connection.cursor().execute('EXPLAIN QUERY PLAN ' + context[0]['sql']).fetchall()
+        self.assertIn('USING COVERING INDEX passwords_entry_user_upd_idx', str(plan))
+
+
+class SearchIndexTests(TestCase):
+
+    def setUp(self):
+        self.index = SearchIndex()
+        self.index.add(1, 'GitHub', ['octocat', 'https://github.com'])
+        self.index.add(2, 'Gitlab', ['tanuki', ''])
+        self.index.add(3, 'Crédit Agricole', ['client42', 'https://www.credit-agricole.fr'])
+
+    def test_prefix_exact_first(self):
+        self.assertEqual(self.index.search('git'), ['GitHub', 'Gitlab'])
+        self.index.add(4, 'Git', ['me', ''])
+        self.assertEqual(self.index.search('git')[0], 'Git')
+
+    def test_matches_username_url_and_accents(self):
+        self.assertEqual(self.index.search('octo'), ['GitHub'])
+        self.assertEqual(self.index.search('agricole'), ['Crédit Agricole'])
+        self.assertEqual(self.index.search('credit'), ['Crédit Agricole'])
+
+    def test_url_host(self):
+        self.index.add(4, 'Jobs', ['me', 'https://www.j1.com/login'])
+        self.assertEqual(self.index.search('j1.com'), ['Jobs'])
+        self.assertEqual(self.index.search('github.com'), ['GitHub'])
+
+    def test_fuzzy(self):
+        self.assertEqual(self.index.search('gthub'), ['GitHub'])
+        self.assertEqual(self.index.search('tanuky'), ['Gitlab'])
+
+    def test_remove(self):
+        self.index.add(1, 'Bitbucket', ['octocat', ''])
+        self.assertNotIn('GitHub', self.index.search('github'))
+        self.index.remove(1)
+        self.assertEqual(self.index.search('octo'), [])
+        # Branches left without terms are pruned
+        self.assertNotIn('o', self.index.root.children)
+
+    def test_rebuild_does_not_block_other_users(self):
+        registry = SearchIndexRegistry()
+        building, release = threading.Event(), threading.Event()
+        released = []
+
+        def build(user_id, version):
+            if user_id == 1:
+                building.set()
+                released.append(release.wait(5))
+            index = SearchIndex(version)
+            index.add(user_id, f'user{user_id}', [])
+            return index
+
+        with mock.patch.object(registry, '_build', side_effect=build), \
+                mock.patch('passwords.search.PasswordEntry.objects.filter') as entries:
+            entries.return_value.version.return_value = (1, None, 1)
+            thread = threading.Thread(target=registry.get, args=(1,))
+            thread.start()
+            self.assertTrue(building.wait(5))
+            self.assertEqual(registry.search(2, 'user'), ['user2'])
+            release.set()
+            thread.join()
+            self.assertEqual(released, [True])  # Not timed out waiting for user 2's search
+            self.assertEqual(registry.search(1, 'user'), ['user1'])
+
+
+class SearchViewTests(VaultTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_vault(3)
+        self.client.force_login(self.user)
+        self.addCleanup(search_indexes.clear)
+
+    def search(self, query, **params):
+        return self.client.get('/search/', {'q': query, **params})
+
+    def test_search(self):
+        self.assertEqual(self.search('service-1.example').json()['results'][0], 'service-000001')
+        self.assertEqual(len(self.search('user', limit=2).json()['results']), 2)
+        self.assertEqual(self.search('user', limit='x').status_code, 400)
+        self.assertEqual(self.search('x' * 65).status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.search('user').status_code, 302)
+
+    def test_sees_writes_of_other_processes(self):
+        self.assertEqual(self.search('bank').json()['results'], [])
+        # Written without signals, as by import_passwords in another process
+        category = PasswordCategory.objects.get(user=self.user)
+        PasswordEntry.objects.bulk_create([PasswordEntry(category=category, user=self.user, service_name='Bank')])
+        self.assertEqual(self.search('bank').json()['results'], ['Bank'])
+        PasswordEntry.objects.filter(service_name='Bank').delete()
+        self.assertEqual(self.search('bank').json()['results'], [])
+
+
+@override_settings(PASSWORD_MANAGER_KDF={'algorithm': 'pbkdf2_sha256', 'params': {'iterations': 1000}})
+class EnvelopeEncryptionTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='old')
+        self.category = PasswordCategory.objects.create(name='Web', user=self.user)
+        self.profile = UserEncryptionProfile.get_or_create_for_user(self.user)
+
+    def add_entries(self, key, count):
+        for i in range(count):
+            PasswordEntry.objects.create(
+                user=self.user, category=self.category, service_name=f'service{i}',
+                username='alice', ciphertext=encrypt_value(key, f'secret{i}'),
+            )
+
+    def passwords(self, key):
+        return [entry.decrypt_password(key) for entry in PasswordEntry.objects.order_by('pk')]
+
+    def test_legacy_profile_adopts_derived_key(self):
+        derived_key = self.profile.derive_key_from_password('old')
+        self.add_entries(derived_key, 2)
+        self.assertEqual(self.profile.unlock('old'), derived_key)
+        self.assertTrue(self.profile.wrapped_key)
+        self.assertEqual(self.passwords(self.profile.unlock('old')), ['secret0', 'secret1'])
+
+    def test_change_password_rewraps_only(self):
+        key = self.profile.unlock('old')
+        self.add_entries(key, 2)
+        stored = list(PasswordEntry.objects.values_list('ciphertext', flat=True))
+
+        change_password(self.user, 'old', 'new')
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.unlock('new'), key)
+        self.assertEqual(list(PasswordEntry.objects.values_list('ciphertext', flat=True)), stored)
+        with self.assertRaises(RotationError):
+            change_password(self.user, 'old', 'other')
+
+    def test_change_password_refuses_a_rotated_key(self):
+        unlock = UserEncryptionProfile.unlock
+
+        def unlock_then_rotate(profile, password):
+            key = unlock(profile, password)
+            UserEncryptionProfile.objects.filter(pk=profile.pk).update(key_generation=F('key_generation') + 1)
+            return key
+
+        with mock.patch.object(UserEncryptionProfile, 'unlock', unlock_then_rotate):
+            with self.assertRaisesMessage(RotationError, 'rotated meanwhile'):
+                change_password(self.user, 'old', 'new')
+
+    def test_legacy_text_format(self):
+        key = self.profile.unlock('old')
+        binary = encrypt_value(key, 'secret')
+        legacy = to_legacy_text(binary)
+        self.assertLess(len(binary), len(legacy) * 0.6)
+        self.assertEqual(decrypt_value(key, legacy), 'secret')
+        self.assertEqual(to_binary(legacy), binary)
+
+        # Rows still in the legacy column are read and moved on rotation
+        PasswordEntry.objects.create(
+            user=self.user, category=self.category, service_name='legacy',
+            username='alice', encrypted_password=legacy,
+        )
+        self.assertEqual(PasswordEntry.objects.with_password().count(), 1)
+        rotate_data_key(self.user, 'old')
+        self.profile.refresh_from_db()
+        entry = PasswordEntry.objects.get()
+        self.assertEqual(entry.encrypted_password, '')
+        self.assertEqual(entry.decrypt_password(self.profile.unlock('old')), 'secret')
+
+    def test_rotate_data_key_resumes(self):
+        old_key = self.profile.unlock('old')
+        self.add_entries(old_key, 5)
+
+        def interrupt(rotated, last_entry_id):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            rotate_data_key(self.user, 'old', chunk_size=2, progress=interrupt)
+        self.assertEqual(VaultKeyRotation.objects.get(user=self.user).last_entry_id,
+                         PasswordEntry.objects.order_by('pk')[1].pk)
+
+        self.assertEqual(rotate_data_key(self.user, 'old', chunk_size=2), 3)
+        self.profile.refresh_from_db()
+        new_key = self.profile.unlock('old')
+        self.assertNotEqual(new_key, old_key)
+        self.assertEqual(self.passwords(new_key), [f'secret{i}' for i in range(5)])
+        self.assertFalse(VaultKeyRotation.objects.exists())
+
+
+    def test_rotation_resumes_from_checkpoint(self):
+        key = self.profile.unlock('old')
+        self.add_entries(key, 5)
+        interrupted = mock.Mock(side_effect=[None, KeyboardInterrupt])
+        with self.assertRaises(KeyboardInterrupt):
+            rotate_data_key(self.user, 'old', chunk_size=2, progress=interrupted)
+        rotation = VaultKeyRotation.objects.get()
+        self.assertEqual(rotation.last_entry_id, PasswordEntry.objects.order_by('pk')[3].pk)
+
+        out = io.StringIO()
+        with mock.patch('passwords.rotation._reencrypt_chunk', wraps=_reencrypt_chunk) as reencrypt:
+            call_command(
+                'rotate_vault_key', username='alice', old_password='old', rotate_data_key=True, chunk_size=2, stdout=out,
+            )
+        self.assertIn('Resuming interrupted rotation', out.getvalue())
+        self.assertIn('Rotated data key for alice (1 entries re-encrypted)', out.getvalue())
+        self.assertEqual([len(call.args[0]) for call in reencrypt.call_args_list], [1])
+
+        self.assertFalse(VaultKeyRotation.objects.exists())
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.key_generation, 1)
+        self.assertEqual(self.passwords(self.profile.unlock('old')), [f'secret{i}' for i in range(5)])
+
+
+CHEAP_KDFS = {
+    kdf.SCRYPT: {'n': 2 ** 4, 'r': 8, 'p': 1},
+    kdf.ARGON2ID: {'iterations': 1, 'lanes': 1, 'memory_cost': 64},
+}
+
+
+class KdfTests(VaultTestMixin, TestCase):
+
+    def kdf_settings(self, algorithm):
+        if not kdf.is_available(algorithm):
+            self.skipTest(f'{algorithm} is not supported here')
+        return override_settings(PASSWORD_MANAGER_KDF={'algorithm': algorithm, 'params': CHEAP_KDFS[algorithm]})
+
+    def test_round_trip(self):
+        for algorithm in CHEAP_KDFS:
+            with self.subTest(algorithm), self.kdf_settings(algorithm):
+                user = User.objects.create_user(algorithm, password='pw')
+                profile = UserEncryptionProfile.get_or_create_for_user(user)
+                key = profile.unlock('pw')
+                profile.refresh_from_db()
+                self.assertEqual((profile.kdf_algorithm, profile.kdf_params), (algorithm, CHEAP_KDFS[algorithm]))
+                self.assertEqual(decrypt_value(profile.unlock('pw'), encrypt_value(key, 'secret')), 'secret')
+                with self.assertRaises(InvalidToken):
+                    profile.unlock('wrong')
+
+    def test_upgrade_on_login(self):
+        user = self.create_vault(1)
+        with self.kdf_settings(kdf.SCRYPT):
+            profile = UserEncryptionProfile.objects.get(user=user)
+            self.assertTrue(profile.needs_kdf_upgrade())
+            with override_settings(PASSWORD_MANAGER_KDF_UPGRADE_ON_LOGIN=False):
+                self.login()
+            profile.refresh_from_db()
+            self.assertEqual(profile.kdf_algorithm, kdf.PBKDF2_SHA256)
+
+            self.login()
+            profile.refresh_from_db()
+            self.assertEqual(profile.kdf_algorithm, kdf.SCRYPT)
+            self.assertFalse(profile.needs_kdf_upgrade())
+            response = self.client.post('/fetch_data/', {'item': 'service-000000'})
+            self.assertEqual(response.json()['password'], 'password-0')
+
+    def test_calibrate(self):
+        for name, iterations in (('alice', 1000), ('bob', 500)):
+            profile = UserEncryptionProfile.get_or_create_for_user(User.objects.create_user(name, password='pw'))
+            profile.unlock('pw')
+            UserEncryptionProfile.objects.filter(pk=profile.pk).update(kdf_params={'iterations': iterations})
+        out = io.StringIO()
+        call_command('calibrate_kdf', algorithm='pbkdf2_sha256', target_ms=1, stdout=out)
+        self.assertIn("PASSWORD_MANAGER_KDF = {'algorithm': 'pbkdf2_sha256', 'params': {\"iterations\": 100000}}", out.getvalue())
+        self.assertIn('1 profile(s) do not use the currently configured KDF', out.getvalue())
+
+        if kdf.is_available(kdf.ARGON2ID):
+            out = io.StringIO()
+            call_command('calibrate_kdf', algorithm='argon2id', target_ms=0, memory_kib=64, lanes=1, stdout=out)
+            self.assertIn('"iterations": 1, "lanes": 1, "memory_cost": 64', out.getvalue())
+
+
+class BackupTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw')
+        self.key = UserEncryptionProfile.get_or_create_for_user(self.user).unlock('pw')
+        for name in ('web', 'bank'):
+            category = PasswordCategory.objects.create(name=name, user=self.user)
+            for i in range(3):
+                entry = PasswordEntry(user=self.user, category=category, service_name=f'{name}{i}', username='alice')
+                entry.encrypt_password(f'{name}-secret{i}', self.key)
+                entry.save()
+
+    def export(self, chunk_size=2):
+        archive = io.BytesIO()
+        backup.export_vaults(User.objects.all(), backup.ArchiveWriter(archive, chunk_size=chunk_size))
+        archive.seek(0)
+        return archive
+
+    def test_round_trip(self):
+        archive = self.export()
+        with self.assertRaises(backup.ArchiveError):
+            backup.restore_vaults(archive)
+
+        archive.seek(0)
+        self.assertEqual(backup.restore_vaults(archive, replace=True), ['alice'])
+        self.assertEqual(PasswordEntry.objects.count(), 6)
+        key = UserEncryptionProfile.objects.get(user=self.user).unlock('pw')
+        entry = PasswordEntry.objects.get(service_name='bank2')
+        self.assertEqual(entry.category.name, 'bank')
+        self.assertEqual(entry.decrypt_password(key), 'bank-secret2')
+
+    def test_corrupt_chunk(self):
+        data = bytearray(self.export().getvalue())
+        data[-60] ^= 1
+        with self.assertRaisesMessage(backup.ArchiveError, 'Checksum mismatch'):
+            backup.restore_vaults(io.BytesIO(bytes(data)), replace=True)
+        self.assertEqual(PasswordEntry.objects.count(), 6)
+
+
+@override_settings(PASSWORD_MANAGER_KDF={'algorithm': 'pbkdf2_sha256', 'params': {'iterations': 1000}})
+class UpsertImportTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw')
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'passwords.txt')
+
+    def run_import(self, entries, **options):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            for name, password in entries:
+                f.write(f'{name}:\nlogin\n{password}\n\n')
+        out = io.StringIO()
+        options.setdefault('password', 'pw')
+        call_command('import_passwords', file=self.path, username='alice', stdout=out, **options)
+        return out.getvalue()
+
+    def test_upsert_touches_changed_rows_only(self):
+        self.run_import([('a', 'one'), ('b', 'two')])
+        self.assertIn('Password cannot unlock', self.run_import([('a', 'one')], password='wrong'))
+        untouched = PasswordEntry.objects.get(service_name='a').updated_at
+
+        output = self.run_import([('a', 'one'), ('b', 'changed'), ('c', 'three')], upsert=True)
+        self.assertIn('1 new and 1 changed entries (1 unchanged)', output)
+        self.assertEqual(PasswordEntry.objects.get(service_name='a').updated_at, untouched)
+
+        key = UserEncryptionProfile.objects.get(user=self.user).unlock('pw')
+        self.assertEqual(PasswordEntry.objects.get(service_name='b').decrypt_password(key), 'changed')
+        self.assertEqual(PasswordEntry.objects.count(), 3)
+
+    def test_dry_run_profile(self):
+        output = self.run_import([('a', 'one')], dry_run=True, profile=True)
+        self.assertIn('Dry run: 1 entries rolled back', output)
+        self.assertIn('encrypt:', output)
+        self.assertFalse(PasswordEntry.objects.exists())
+
+    def test_streams_in_batches(self):
+        parsed = []
+        parse_legacy = parsers.PARSERS['legacy']
+
+        def counting_parser(f, warn):
+            for record in parse_legacy(f, warn=warn):
+                parsed.append(record)
+                yield record
+
+        written = []
+        write_batch = ImportCommand.write_batch
+
+        def recording_write(command, batch, batch_size):
+            written.append((len(batch), len(parsed)))
+            return write_batch(command, batch, batch_size)
+
+        with mock.patch.dict(parsers.PARSERS, legacy=counting_parser), \
+                mock.patch.object(ImportCommand, 'write_batch', recording_write), \
+                CaptureQueriesContext(connection) as queries:
+            self.run_import([(f's{i}', 'pw') for i in range(10)], batch_size=4)
+        # Each batch is written before the next records are parsed, in one INSERT
+        self.assertEqual(written, [(4, 4), (4, 8), (2, 10)])
+        inserts = [q for q in queries if q['sql'].startswith('INSERT INTO "passwords_passwordentry"')]
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(PasswordEntry.objects.count(), 10)
+
+    def test_workers(self):
+        entries = [(f's{i:02}', f'secret{i}') for i in range(25)]
+        for backend in BACKENDS:
+            with self.subTest(backend=backend):
+                PasswordEntry.objects.all().delete()
+                self.run_import(entries, workers=2, backend=backend, batch_size=4)
+                key = UserEncryptionProfile.objects.get(user=self.user).unlock('pw')
+                imported = PasswordEntry.objects.order_by('service_name')
+                self.assertEqual([(e.service_name, e.decrypt_password(key)) for e in imported], entries)
+
+
+class CryptoPoolTests(TestCase):
+
+    def test_imap_keeps_order_and_bounds_work_in_flight(self):
+        consumed = []
+
+        def inputs():
+            for i in range(20):
+                consumed.append(i)
+                yield i
+
+        def slow_for_early(i):
+            time.sleep((20 - i) / 2000)  # Later items finish first
+            return i * 2
+
+        with CryptoPool(workers=3, backend='thread') as pool:
+            results = pool.imap(slow_for_early, inputs())
+            self.assertEqual(next(results), 0)
+            self.assertLessEqual(len(consumed), 6)
+            self.assertEqual(list(results), [i * 2 for i in range(1, 20)])
+
+    def test_encrypt_batches(self):
+        key = Fernet.generate_key()
+        batches = [[(f'item{b}-{i}', f'secret{b}-{i}' if i else '') for i in range(3)] for b in range(5)]
+        for workers, backend in ((1, 'thread'), (2, 'thread'), (2, 'process')):
+            with self.subTest(workers=workers, backend=backend), CryptoPool(workers, backend) as pool:
+                results = list(pool.encrypt_batches(key, iter(batches)))
+                self.assertEqual([items for items, _ in results], [[item for item, _ in b] for b in batches])
+                for (_, encrypted), batch in zip(results, batches):
+                    self.assertEqual(encrypted[0], b'')
+                    self.assertEqual([decrypt_value(key, value) for value in encrypted[1:]], [v for _, v in batch[1:]])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            CryptoPool(2, 'fiber')
+
+
+class ImportParserTests(TestCase):
+
+    def parse(self, name, text):
+        warnings = []
+        return list(parsers.PARSERS[name](io.StringIO(text), warn=warnings.append)), warnings
+
+    def test_legacy(self):
+        records, warnings = self.parse('legacy', 'GitHub:\ngithub.com\nocto\npw\nnote\nEmpty:\nonly-one-line\n')
+        self.assertEqual(records, [parsers.ImportRecord('GitHub', 'github.com', 'octo', 'pw', 'note')])
+        self.assertEqual(len(warnings), 1)
+
+    def test_csv_aliases(self):
+        records, _ = self.parse('csv', 'url,username,password,extra\nhttps://example.org/a,me,pw,\n')
+        self.assertEqual(records, [parsers.ImportRecord('example.org', 'https://example.org/a', 'me', 'pw', '')])
+
+    def test_json_streams_items(self):
+        text = json.dumps({'folders': [], 'items': [
+            {'type': 2, 'name': 'Note'},
+            {'type': 1, 'name': 'Bank', 'login': {'username': 'u', 'password': 'p', 'uris': [{'uri': 'https://b.fr'}]}},
+        ]})
+        stream = parsers._JSONStream(io.StringIO(text), chunk_size=7)
+        self.assertEqual(len(list(parsers._iter_json_items(stream))), 2)
+        self.assertEqual(
+            list(parsers.parse_json(io.StringIO(text))),
+            [parsers.ImportRecord('Bank', 'https://b.fr', 'u', 'p', '')],
+        )
+
+    def test_guess_format(self):
+        self.assertEqual(parsers.guess_format('export.CSV'), 'csv')
+        self.assertEqual(parsers.guess_format('passwords'), 'legacy')
+
+
+class RequestCounterTests(VaultTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.create_vault(1)
+        self.login()
+
+    def fetch_statuses(self, count):
+        return [self.client.post('/fetch_data/', {'item': 'service-000000'}).status_code for _ in range(count)]
+
+    @override_settings(PASSWORD_MANAGER_REQUEST_LIMIT=3)
+    def test_limit_shared_by_workers(self):
+        self.assertEqual(self.fetch_statuses(2), [200, 200])
+        # Another worker process has none of this one's memory, but reads the same counter
+        caches['default'].clear()
+        self.assertEqual(self.fetch_statuses(2), [200, 429])
+        self.assertNotIn('nb_req', self.client.session)
+        self.assertEqual(RateLimitCounter.objects.get().count, 3)
+
+        self.client.get('/logout/')
+        self.assertFalse(RateLimitCounter.objects.exists())
+
+    @override_settings(PASSWORD_MANAGER_REQUEST_LIMIT=3, PASSWORD_MANAGER_REQUEST_COUNTER='cache')
+    def test_limit_in_cache(self):
+        self.assertEqual(self.fetch_statuses(4), [200, 200, 200, 429])
+        self.assertNotIn('nb_req', self.client.session)
+
+    @override_settings(PASSWORD_MANAGER_REQUEST_LIMIT=3, PASSWORD_MANAGER_REQUEST_COUNTER='session')
+    def test_limit_in_session(self):
+        self.assertEqual(self.fetch_statuses(4), [200, 200, 200, 429])
+        self.assertEqual(self.client.session['nb_req'], 3)
+
+
+class FetchBatchTests(VaultTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.create_vault(3)
+        self.login()
+
+    def fetch(self, *items):
+        return self.client.post('/fetch_batch/', {'items': items})
+
+    def charged(self):
+        counter = RateLimitCounter.objects.first()
+        return counter.count if counter else 0
+
+    def test_batch(self):
+        response = self.fetch('service-000001', 'service-000000', 'service-000001', 'unknown')
+        data = response.json()
+        self.assertEqual(list(data['entries']), ['service-000000', 'service-000001'])
+        self.assertEqual(data['entries']['service-000001']['password'], 'password-1')
+        self.assertEqual(data['missing'], ['unknown'])
+        self.assertEqual(self.charged(), 2)  # Entries returned, each once
+
+    @override_settings(PASSWORD_MANAGER_REQUEST_LIMIT=3)
+    def test_whole_batch_refused_over_limit(self):
+        self.assertEqual(self.fetch('service-000000', 'service-000001').status_code, 200)
+        self.assertEqual(self.fetch('service-000000', 'service-000002').status_code, 429)
+        self.assertEqual(self.charged(), 2)
+        self.assertEqual(self.fetch('service-000002').status_code, 200)
+
+    @override_settings(PASSWORD_MANAGER_BATCH_LIMIT=2)
+    def test_invalid(self):
+        self.assertEqual(self.fetch().status_code, 400)
+        self.assertEqual(self.fetch('').status_code, 400)
+        self.assertEqual(self.fetch('service-000000', 'service-000001', 'service-000002').status_code, 400)
+        self.assertEqual(self.fetch('service-000000', 'service-000001', 'service-000000').status_code, 200)
+
+    @override_settings(PASSWORD_MANAGER_RATE_LIMITS={
+        'fetch_data': {'algorithm': 'sliding_window', 'limit': 2, 'window': 60, 'keys': ['user']},
+    })
+    def test_rate_limit_charges_distinct_valid_names(self):
+        for _ in range(3):
+            self.assertEqual(self.fetch().status_code, 400)
+        self.assertEqual(self.fetch('service-000000', 'service-000000', 'service-000001').status_code, 200)
+        response = self.fetch('service-000002')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+
+    def test_session_without_key(self):
+        key_cache.clear()
+        del self.client.cookies[COOKIE_NAME]
+        self.assertEqual(self.fetch('service-000000').status_code, 401)
+        self.assertEqual(self.charged(), 0)
+
+
+class AsyncViewTests(VaultTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_vault(2)
+        self.addCleanup(key_cache.clear)
+
+    async def alogin(self):
+        await self.async_client.post('/check_login/', {'login': self.USERNAME, 'password': self.PASSWORD})
+
+    async def fetch(self, item):
+        return await self.async_client.post('/async/fetch_data/', {'item': item})
+
+    async def test_fetch(self):
+        self.assertTrue(iscoroutinefunction(views.afetch_data))
+        self.assertEqual((await self.fetch('service-000000')).status_code, 302)
+        await self.alogin()
+        self.assertEqual((await self.fetch('service-000001')).json()['password'], 'password-1')
+        self.assertEqual((await self.fetch('unknown')).status_code, 404)
+        self.assertEqual((await self.fetch('')).status_code, 400)
+
+    async def test_session_without_key(self):
+        await self.alogin()
+        key_cache.clear()
+        del self.async_client.cookies[COOKIE_NAME]
+        self.assertEqual((await self.fetch('service-000000')).status_code, 401)
+
+    @override_settings(PASSWORD_MANAGER_REQUEST_LIMIT=2)
+    async def test_request_limit(self):
+        await self.alogin()
+        statuses = [(await self.fetch('service-000000')).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+
+    @override_settings(PASSWORD_MANAGER_RATE_LIMITS={
+        'fetch_data': {'algorithm': 'sliding_window', 'limit': 1, 'window': 60, 'keys': ['user']},
+    })
+    async def test_rate_limited_coroutine_view(self):
+        await self.alogin()
+        self.assertEqual((await self.fetch('service-000000')).status_code, 200)
+        response = await self.fetch('service-000000')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+
+    async def test_index(self):
+        request = AsyncRequestFactory().get('/')
+        request.user = AnonymousUser()
+        request.auser = mock.AsyncMock(return_value=request.user)
+        self.assertEqual((await views.aindex_view(request)).status_code, 302)
+
+        request.user = self.user
+        request.auser = mock.AsyncMock(return_value=self.user)
+        response = await views.aindex_view(request)
+        self.assertContains(response, 'var serviceNamesUrl = "/services/"')
+
+
+class PasswordRevealTests(VaultTestMixin, TestCase):
+    """The admin change form decrypts nothing until the page asks for the password"""
+
+    def setUp(self):
+        super().setUp()
+        user = self.create_vault(1)
+        User.objects.filter(pk=user.pk).update(is_staff=True, is_superuser=True)
+        self.entry = PasswordEntry.objects.get(user=user)
+        self.login()
+        self.reveal_url = reverse('admin:passwords_passwordentry_reveal', args=[self.entry.pk])
+
+    def test_change_form_does_not_decrypt(self):
+        with mock.patch.object(PasswordEntry, 'decrypt_password') as decrypt:
+            response = self.client.get(reverse('admin:passwords_passwordentry_change', args=[self.entry.pk]))
+        self.assertContains(response, f'data-reveal-url="{self.reveal_url}"')
+        self.assertContains(response, 'admin_reveal.js')
+        decrypt.assert_not_called()
+
+    def test_reveal(self):
+        self.assertEqual(self.client.post(self.reveal_url).json(), {'masked': 'pas***'})
+        self.assertEqual(self.client.post(self.reveal_url, {'reveal': '1'}).json(), {'password': 'password-0'})
+        self.assertEqual(self.client.get(self.reveal_url).status_code, 405)
+
+    def test_entry_without_password(self):
+        PasswordEntry.objects.filter(pk=self.entry.pk).update(ciphertext=b'', encrypted_password='')
+        self.assertEqual(self.client.post(self.reveal_url).json(), {'masked': ''})
+        self.assertEqual(self.client.post(self.reveal_url, {'reveal': '1'}).json(), {'password': ''})
+
+    @override_settings(PASSWORD_MANAGER_RATE_LIMITS={
+        'fetch_data': {'algorithm': 'sliding_window', 'limit': 1, 'window': 60, 'keys': ['user']},
+    })
+    def test_previews_are_not_rate_limited(self):
+        for _ in range(3):
+            self.assertEqual(self.client.post(self.reveal_url).status_code, 200)
+        self.assertEqual(self.client.post(self.reveal_url, {'reveal': '1'}).status_code, 200)
+        self.assertEqual(self.client.post(self.reveal_url, {'reveal': '1'}).status_code, 429)
+
+    @override_settings(PASSWORD_MANAGER_REQUEST_LIMIT=2, PASSWORD_MANAGER_RATE_LIMITS={})
+    def test_reveal_counts_against_request_limit(self):
+        statuses = [self.client.post(self.reveal_url, {'reveal': '1'}).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(self.client.post(self.reveal_url).status_code, 200)  # Masked
+        self.assertEqual(self.client.post('/fetch_data/', {'item': self.entry.service_name}).status_code, 429)
+
+    def test_other_users_entries(self):
+        user = User.objects.get(username=self.USERNAME)
+        user.is_superuser = False
+        user.save()
+        user.user_permissions.add(Permission.objects.get(codename='change_passwordentry'))
+        self.assertEqual(self.client.post(self.reveal_url).status_code, 200)
+        other = User.objects.create_user('other', password='other-password')
+        category = PasswordCategory.objects.create(user=other, name='other')
+        entry = PasswordEntry.objects.create(category=category, user=other, service_name='theirs', username='them')
+        response = self.client.post(reverse('admin:passwords_passwordentry_reveal', args=[entry.pk]))
+        self.assertEqual(response.status_code, 404)
+
+    def save_password(self, password):
+        return self.client.post(reverse('admin:passwords_passwordentry_change', args=[self.entry.pk]), {
+            'category': self.entry.category_id, 'service_name': self.entry.service_name,
+            'service_url': '', 'username': self.entry.username, 'password': password, 'comments': '',
+        })
+
+    def test_save_after_rotation(self):
+        user = User.objects.get(username=self.USERNAME)
+        rotate_data_key(user, self.PASSWORD)
+        self.assertContains(self.save_password('new-secret'), 'Session expired')
+        self.assertEqual(self.client.post(self.reveal_url).status_code, 401)
+
+        key = UserEncryptionProfile.objects.get(user=user).unlock(self.PASSWORD)
+        self.assertEqual(PasswordEntry.objects.get(pk=self.entry.pk).decrypt_password(key), 'password-0')
+
+    def test_save_during_rotation(self):
+        VaultKeyRotation.objects.create(user=self.entry.user, new_wrapped_key='')
+        self.assertContains(self.save_password('new-secret'), 'being rotated')
+        VaultKeyRotation.objects.all().delete()
+        self.assertEqual(self.save_password('new-secret').status_code, 302)
+        self.assertEqual(self.client.post(self.reveal_url, {'reveal': '1'}).json(), {'password': 'new-secret'})
+
+
+class RateLimitTests(TestCase):
+
+    def setUp(self):
+        ratelimit.get_backend('local').clear()
+        self.addCleanup(login_throttle.clear)
+
+    def assertHits(self, algorithm, backend, expected):
+        hits = [algorithm.hit(ratelimit.get_backend(backend), 'test-key')[0] for _ in expected]
+        self.assertEqual(hits, expected)
+
+    def test_sliding_window(self):
+        for backend in ('local', 'cache', 'db'):
+            with self.subTest(backend=backend):
+                self.assertHits(ratelimit.SlidingWindow(limit=2, window=60), backend, [True, True, False, False])
+
+    def test_token_bucket(self):
+        for backend in ('local', 'db'):
+            with self.subTest(backend=backend):
+                self.assertHits(ratelimit.TokenBucket(rate=0.001, burst=2), backend, [True, True, False])
+
+    @override_settings(PASSWORD_MANAGER_RATE_LIMITS={
+        'check_login': {'algorithm': 'sliding_window', 'limit': 2, 'window': 60, 'keys': ['ip']},
+    })
+    def test_check_login(self):
+        statuses = [
+            self.client.post('/check_login/', {'login': 'nobody', 'password': 'x'}).status_code
+            for _ in range(3)
+        ]
+        self.assertEqual(statuses, [200, 200, 429])
+
+
+class LoginThrottleTests(TestCase):
+
+    def test_backoff(self):
+        throttle = LoginThrottle(free_failures=1, base_delay=10, max_delay=15)
+        throttle.record_failure('alice', '10.0.0.1')
+        self.assertEqual(throttle.check('alice', '10.0.0.1'), 0)
+
+        throttle.record_failure('alice', '10.0.0.1')
+        self.assertAlmostEqual(throttle.check('Alice', '10.0.0.2'), 10, delta=1)
+        throttle.record_failure('bob', '10.0.0.1')
+        self.assertAlmostEqual(throttle.check('carol', '10.0.0.1'), 15, delta=1)
+
+        throttle.record_success('alice', '10.0.0.2')
+        self.assertEqual(throttle.check('alice', '10.0.0.2'), 0)
+        self.assertEqual(throttle.stats()['shed'], 2)
+
+    def test_bounded(self):
+        throttle = LoginThrottle(max_keys=3)
+        for i in range(5):
+            throttle.record_failure(f'user{i}', '')
+        self.assertEqual(throttle.stats()['tracked_keys'], 3)
+
+    @override_settings(PASSWORD_MANAGER_RATE_LIMITS={})
+    def test_check_login_sheds_before_hashing(self):
+        self.addCleanup(login_throttle.clear)
+        User.objects.create_user('alice', password='pw')
+        for _ in range(login_throttle.free_failures + 1):
+            self.client.post('/check_login/', {'login': 'alice', 'password': 'wrong'})
+
+        shed = login_throttle.stats()['shed']
+        with mock.patch('passwords.views.authenticate') as authenticate:
+            response = self.client.post('/check_login/', {'login': 'alice', 'password': 'pw'})
+        self.assertEqual(response.status_code, 429)
+        authenticate.assert_not_called()
+        self.assertEqual(login_throttle.stats()['shed'], shed + 1)
+
+
+class QueryPlanTests(VaultTestMixin, TestCase):
+    """The hot queries must use an index and need no sort"""
+
+    def test_hot_queries_use_indexes(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Plans are only checked on SQLite')
+        for name, queryset in hot_queries(self.create_vault(50)).items():
+            with self.subTest(name):
+                self.assertEqual(plan_problems(queryset.explain()), [])
+
+
+class KeyCacheTests(VaultTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_vault(1)
+        key_cache.clear()  # Of the sessions of other tests
+        self.addCleanup(key_cache.clear)
+        self.login()
+
+    def fetch(self):
+        return self.client.post('/fetch_data/', {'item': 'service-000000'})
+
+    def test_key_derived_once_and_dropped_at_logout(self):
+        session_key = self.client.session.session_key
+        self.assertIsNotNone(key_cache.get(session_key, self.user.pk, 0))
+        with mock.patch('passwords.models.derive_key') as derive:
+            self.assertEqual(self.fetch().json()['password'], 'password-0')
+        derive.assert_not_called()
+
+        self.client.get('/logout/')
+        self.assertIsNone(key_cache.get(session_key, self.user.pk, 0))
+        self.assertEqual(len(key_cache), 0)
+
+    def test_lru_and_ttl(self):
+        cache = KeyCache(max_size=2, ttl=60)
+        with mock.patch('passwords.keycache.time.monotonic', return_value=0):
+            cache.set('a', 1, b'key-a', 0)
+            cache.set('b', 2, b'key-b', 0)
+            self.assertEqual(cache.get('a', 1, 0), b'key-a')
+            cache.set('c', 3, b'key-c', 0)  # Evicts b, the least recently used
+            self.assertIsNone(cache.get('b', 2, 0))
+            self.assertIsNone(cache.get('a', 2, 0))  # Another user's session
+        with mock.patch('passwords.keycache.time.monotonic', return_value=61):
+            self.assertIsNone(cache.get('c', 3, 0))
+
+    def test_other_worker_unwraps_from_session(self):
+        self.assertNotIn(self.client.cookies[COOKIE_NAME].value, str(dict(self.client.session)))
+        key_cache.clear()  # As in a worker that did not serve the login
+        self.assertEqual(self.fetch().json()['password'], 'password-0')
+        self.assertEqual(len(key_cache), 1)
+
+        key_cache.clear()
+        del self.client.cookies[COOKIE_NAME]
+        self.assertEqual(self.fetch().status_code, 401)
+
+    def test_vault_password_out_of_step(self):
+        self.client.get('/logout/')
+        self.user.set_password('changed-in-admin')
+        self.user.save()
+        with self.assertLogs('passwords', 'WARNING') as logs:
+            response = self.client.post('/check_login/', {'login': self.user.username, 'password': 'changed-in-admin'})
+        self.assertContains(response, 'rotate_vault_key')
+        self.assertIn('cannot unlock their vault', '\n'.join(logs.output))
+        self.assertNotIn('_auth_user_id', self.client.session)
+
+    def test_reads_refused_during_rotation(self):
+        with self.assertRaises(KeyboardInterrupt):
+            rotate_data_key(self.user, self.PASSWORD, progress=mock.Mock(side_effect=KeyboardInterrupt))
+        # The entry is under the new data key, which no session holds yet
+        self.assertEqual(self.fetch().status_code, 409)
+        self.login()
+        self.assertEqual(self.fetch().status_code, 409)
+        response = self.client.post('/fetch_batch/', {'items': ['service-000000']})
+        self.assertEqual(response.status_code, 409)
+
+        rotate_data_key(self.user, self.PASSWORD)
+        self.login()
+        self.assertEqual(self.fetch().json()['password'], 'password-0')
+
+    def test_rotation_retires_session_key(self):
+        rotate_data_key(self.user, self.PASSWORD)
+        key_cache.clear()
+        self.assertEqual(self.fetch().status_code, 401)
+
+
+class KeyAgentTests(VaultTestMixin, TestCase):
+    """Keys are unlocked once, held by the agent, and never put in the session"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_vault(2)
+        self.agent_server = self.start_agent()
+        self.login()
+
+    def test_login_unlocks_in_agent(self):
+        self.assertNotIn('user_password', self.client.session)
+        self.assertIsNone(key_cache.get(self.client.session.session_key, self.user.pk, 0))
+        response = self.client.post('/fetch_data/', {'item': 'service-000001'})
+        self.assertEqual(response.json()['password'], 'password-1')
+
+    def test_key_derived_once_per_user(self):
+        other = Client()
+        with mock.patch('passwords.agent.derive_key') as derive:
+            self.login(other)
+        derive.assert_not_called()
+        self.assertEqual(other.post('/fetch_data/', {'item': 'service-000000'}).status_code, 200)
+
+    def test_wrong_password(self):
+        self.agent_server.agent.lock(self.user.pk, None)
+        profile = UserEncryptionProfile.objects.get(user=self.user)
+        with self.assertRaisesMessage(AgentError, 'cannot unlock'):
+            get_agent().unlock(profile, 'wrong-password')
+
+    def test_logout_locks(self):
+        other = Client()
+        self.login(other)
+        session_key = self.client.session.session_key
+        self.client.get('/logout/')
+        self.assertIsNone(get_agent().key_for(self.user.pk, 0, session_key))
+        # The user's other session keeps the key until it logs out too
+        self.assertEqual(other.post('/fetch_data/', {'item': 'service-000000'}).status_code, 200)
+        other.get('/logout/')
+        self.assertIsNone(get_agent().key_for(self.user.pk, 0))
+
+    def test_rotation_locks(self):
+        rotate_data_key(self.user, self.PASSWORD)
+        self.assertIsNone(get_agent().key_for(self.user.pk, 1))
+        self.assertEqual(self.client.post('/fetch_data/', {'item': 'service-000000'}).status_code, 401)
+
+    def agent_ops(self):
+        """Patch the agent client to record the operations it sends"""
+        client = get_agent()
+        return mock.patch.object(client, 'call', wraps=client.call)
+
+    def test_batches_take_one_call(self):
+        with self.agent_ops() as call:
+            response = self.client.post('/fetch_batch/', {'items': ['service-000000', 'service-000001']})
+        self.assertEqual(response.json()['entries']['service-000001']['password'], 'password-1')
+        self.assertEqual([c.args[0] for c in call.call_args_list], ['status', 'decrypt'])
+
+        key = get_agent().key_for(self.user.pk, 0)
+        raw_key = UserEncryptionProfile.objects.get(user=self.user).unlock(self.PASSWORD)
+        stored = [encrypt_value(raw_key, 'one'), b'\x01garbage', encrypt_value(Fernet.generate_key(), 'x'), 'not base64']
+        self.assertEqual(decrypt_values(key, stored), ['one', None, None, None])
+        self.assertEqual(decrypt_values(raw_key, stored), ['one', None, None, None])
+        self.assertEqual(decrypt_values(raw_key, encrypt_values(key, ['a', 'b'])), ['a', 'b'])
+        self.assertEqual(fingerprints(key, [['a'], ['b']]), fingerprints(raw_key, [['a'], ['b']]))
+
+    def test_import_without_password(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('name,username,password\nimported,me,secret\nother,me,pw\nthird,me,pw\n')
+        self.addCleanup(os.unlink, f.name)
+        with mock.patch('getpass.getpass') as prompt, self.agent_ops() as call:
+            call_command('import_passwords', file=f.name, username=self.USERNAME, stdout=io.StringIO())
+        prompt.assert_not_called()
+        self.assertEqual([c.args[0] for c in call.call_args_list], ['status', 'status', 'fingerprint', 'encrypt'])
+        response = self.client.post('/fetch_data/', {'item': 'imported'})
+        self.assertEqual(response.json()['password'], 'secret')
+
+    def test_socket_is_private(self):
+        self.assertEqual(os.stat(self.agent_server.server_address).st_mode & 0o777, 0o600)
+
+
+class MetricsTests(VaultTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_vault(1)
+
+    def test_histogram_text_format(self):
+        histogram = metrics.Histogram('test_seconds', 'Test', labels=('view',), buckets=(0.1, 1))
+        metrics.registry.metrics.remove(histogram)
+        histogram.observe(0.5, view='a"b')
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{view="a\\"b",le="0.1"} 0\n'
+            'test_seconds_bucket{view="a\\"b",le="1"} 1\n'
+            'test_seconds_bucket{view="a\\"b",le="+Inf"} 1\n'
+            'test_seconds_sum{view="a\\"b"} 0.5\n'
+            'test_seconds_count{view="a\\"b"} 1',
+        ])
+
+    def test_batch_observed_per_entry(self):
+        histogram = metrics.Histogram('test_seconds', 'Test', buckets=(0.1, 1))
+        metrics.registry.metrics.remove(histogram)
+        timed = metrics.timed(histogram, 'test', items=lambda values: len(values))(lambda values: values)
+        with mock.patch.object(metrics.registry, 'enabled', True), \
+                mock.patch('passwords.metrics.time.perf_counter', side_effect=[0, 0.8]):
+            timed([1, 2, 3, 4])
+        self.assertIn('test_seconds_bucket{le="0.1"} 0\ntest_seconds_bucket{le="1"} 4', histogram.render()[2])
+        self.assertIn('test_seconds_count 4', histogram.render()[2])
+
+    @override_settings(PASSWORD_MANAGER_METRICS=True, PASSWORD_MANAGER_SERVER_TIMING=True)
+    def test_instrumented_requests(self):
+        self.login()
+        response = self.client.post('/fetch_data/', {'item': 'service-000000'})
+        self.assertRegex(response['Server-Timing'], r'db;dur=[0-9.]+;desc="\d+ calls", crypto;dur=.*total;dur=')
+
+        self.client.logout()
+        self.assertEqual(self.client.get('/metrics/').status_code, 302)
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+        self.login()
+        text = self.client.get('/metrics/').content.decode()
+        self.assertIn('passwords_view_seconds_count{view="fetch_data"}', text)
+        self.assertIn('passwords_view_queries_bucket{view="check_login",le="+Inf"}', text)
+        self.assertIn('passwords_crypto_seconds_count{operation="decrypt"}', text)
+        self.assertRegex(text, r'passwords_kdf_seconds_count [1-9]')
+        self.assertIn('passwords_login_throttle_attempts_total', text)
+
+    def test_disabled(self):
+        self.login()
+        response = self.client.post('/fetch_data/', {'item': 'service-000000'})
+        self.assertNotIn('Server-Timing', response)
+
+
+class BenchmarkSuiteTests(TestCase):
+    """Run the benchmark suite at tiny sizes so it keeps working"""
+
+    def test_key_derivation(self):
+        results = benchmarks.bench_key_derivation(iteration_counts=(1000,), repeat=1)
+        self.assertIn('1000', results)
+        self.assertIn('profile', results)
+        for algorithm in (kdf.SCRYPT, kdf.ARGON2ID):
+            self.assertEqual(algorithm in results, kdf.is_available(algorithm))
+
+    def test_entry_crypto(self):
+        self.assertEqual(benchmarks.bench_entry_crypto(count=10)['count'], 10)
+
+    def test_import(self):
+        results = benchmarks.bench_import(sizes=(5,))
+        self.assertEqual(results['5']['imported'], 5)
+
+    def test_requests(self):
+        results = benchmarks.bench_requests(entries=5, repeat=2)
+        self.assertEqual(results['fetch_data']['calls'], 2)
+        self.assertGreater(results['index_view']['queries'], 0)
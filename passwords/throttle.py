@@ -0,0 +1,102 @@
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LoginThrottle:
+    """Exponential backoff after failed logins, per username and per client IP
+
+    The first ``free_failures`` failures of a key cost nothing; each one
+    after that blocks the key for twice as long as the previous, from
+    ``base_delay`` up to ``max_delay`` seconds. A key's failures are
+    forgotten after ``reset_after`` seconds without one, or when the
+    username logs in. At most ``max_keys`` keys are tracked, least
+    recently failed first out, and checking a blocked key is a dictionary
+    lookup, so rejected attempts never reach the password hasher.
+    """
+
+    def __init__(self, free_failures=3, base_delay=1, max_delay=300, reset_after=3600, max_keys=10000,
+                 log_interval=60):
+        self.free_failures = free_failures
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.reset_after = reset_after
+        self.max_keys = max_keys
+        self.log_interval = log_interval
+        self._entries = OrderedDict()  # key -> (failures, blocked_until, last_failure)
+        self._lock = threading.Lock()
+        self._counters = {'attempts': 0, 'shed': 0, 'failures': 0, 'successes': 0}
+        self._shed_since_log = 0
+        self._logged_at = time.monotonic()
+
+    @staticmethod
+    def _keys(username, ip):
+        return [key for key in (('user', username.lower()), ('ip', ip)) if key[1]]
+
+    def check(self, username, ip):
+        """Return the seconds left before this login may be attempted, 0 if allowed"""
+        now = time.monotonic()
+        with self._lock:
+            self._counters['attempts'] += 1
+            wait = 0
+            for key in self._keys(username, ip):
+                entry = self._entries.get(key)
+                if entry is not None:
+                    wait = max(wait, entry[1] - now)
+            if wait <= 0:
+                return 0
+            self._counters['shed'] += 1
+            self._shed_since_log += 1
+            self._log_shed(now)
+        return wait
+
+    def record_failure(self, username, ip):
+        now = time.monotonic()
+        with self._lock:
+            self._counters['failures'] += 1
+            for key in self._keys(username, ip):
+                failures, _, last_failure = self._entries.get(key, (0, 0, now))
+                if now - last_failure > self.reset_after:
+                    failures = 0
+                failures += 1
+                blocked_until = now
+                if failures > self.free_failures:
+                    blocked_until += min(self.max_delay, self.base_delay * 2 ** (failures - self.free_failures - 1))
+                self._entries[key] = (failures, blocked_until, now)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+
+    def record_success(self, username, ip):
+        """Forget the username's failures; the IP's expire on their own"""
+        with self._lock:
+            self._counters['successes'] += 1
+            self._entries.pop(('user', username.lower()), None)
+
+    def _log_shed(self, now):
+        if now - self._logged_at >= self.log_interval:
+            logger.warning(
+                'Login throttle shed %d attempts in the last %ds (%d keys tracked)',
+                self._shed_since_log, now - self._logged_at, len(self._entries),
+            )
+            self._shed_since_log = 0
+            self._logged_at = now
+
+    def stats(self):
+        """Counters since startup, plus the number of keys currently blocked"""
+        now = time.monotonic()
+        with self._lock:
+            blocked = sum(1 for _, blocked_until, _ in self._entries.values() if blocked_until > now)
+            return {**self._counters, 'tracked_keys': len(self._entries), 'blocked_keys': blocked}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+login_throttle = LoginThrottle(**getattr(settings, 'PASSWORD_MANAGER_LOGIN_THROTTLE', {}))
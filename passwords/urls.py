@@ -1,11 +1,22 @@
 from django.urls import path
-from django.contrib import admin
+from django.conf import settings
 from . import views
 
+# Serve the async views at the main URLs when running under ASGI
+if getattr(settings, 'PASSWORD_MANAGER_ASYNC_VIEWS', False):
+    index_view, fetch_data = views.aindex_view, views.afetch_data
+else:
+    index_view, fetch_data = views.index_view, views.fetch_data
+
 urlpatterns = [
-    path('', views.index_view, name='index'),
+    path('', index_view, name='index'),
     path('login/', views.login_view, name='login'),
     path('check_login/', views.check_login, name='check_login'),
-    path('fetch_data/', views.fetch_data, name='fetch_data'),
+    path('fetch_data/', fetch_data, name='fetch_data'),
+    path('async/fetch_data/', views.afetch_data, name='afetch_data'),
+    path('fetch_batch/', views.fetch_batch, name='fetch_batch'),
+    path('services/', views.service_names, name='service_names'),
+    path('search/', views.search, name='search'),
     path('logout/', views.logout_view, name='logout'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
@@ -1,11 +1,26 @@
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_GET, require_POST
 from django.contrib.auth import authenticate, login, logout
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
-from .models import PasswordEntry
+import logging
+import math
+from . import metrics
+from .counters import aconsume_requests, clear_requests, consume_requests, reset_requests
+from .keycache import COOKIE_NAME, aget_session_key, get_session_key, set_key_cookie, unlock_session
+from .models import KeyRotationInProgress, PasswordEntry
+from .ratelimit import rate_limited
+from .rotation import RotationError, upgrade_kdf
+from .search import MAX_QUERY_LENGTH, search_indexes
+from .service_index import get_service_index, service_index_etag
+from .throttle import login_throttle
+from .workers import run_crypto
+
+logger = logging.getLogger(__name__)
 
 
 def login_view(request):
@@ -16,47 +31,141 @@ def login_view(request):
     return render(request, 'passwords/login.html')
 
 
+def _login_rate_limited(request, retry_after):
+    response = render(
+        request, 'passwords/login.html', {'error': 'Too many login attempts - please try again later'}, status=429
+    )
+    response['Retry-After'] = str(math.ceil(retry_after))
+    return response
+
+
 @csrf_exempt
 @require_POST
+@rate_limited('check_login', limited_response=_login_rate_limited)
 def check_login(request):
     """Check login credentials using Django authentication"""
     username = request.POST.get('login', '')
     password = request.POST.get('password', '')
+    client_ip = request.META.get('REMOTE_ADDR', '')
+
+    # Refuse throttled attempts before paying for the password hash
+    retry_after = login_throttle.check(username, client_ip)
+    if retry_after:
+        return _login_rate_limited(request, retry_after)
 
     user = authenticate(request, username=username, password=password)
 
     if user is not None:
+        login_throttle.record_success(username, client_ip)
+
+        # Move the vault to the configured KDF while the password is at hand
+        if getattr(settings, 'PASSWORD_MANAGER_KDF_UPGRADE_ON_LOGIN', True):
+            try:
+                upgrade_kdf(user, password)
+            except RotationError as e:
+                logger.warning('KDF upgrade failed for %s: %s', user.username, e)
+
         login(request, user)
-        request.session['nb_req'] = 0  # Reset request counter
-        # Store encrypted password for decryption (security note: this is still a session-based approach)
-        # In production, consider using a more secure method like requiring password re-entry for sensitive operations
-        request.session['user_password'] = password
-        return redirect('index')
+        reset_requests(request)  # Reset request counter
+        # Derive the encryption key once per login; the password itself is not kept
+        if unlock_session(request, user, password) is None:
+            # Typically a login password changed outside rotate_vault_key, which keeps both in step
+            logger.warning('Login of %s refused: the vault could not be unlocked', user.username)
+            logout(request)
+            return render(request, 'passwords/login.html', {
+                'error': 'Your vault could not be unlocked with this password. If it was changed recently, '
+                         'ask an administrator to run manage.py rotate_vault_key for your account.',
+            })
+        return set_key_cookie(request, redirect('index'))
     else:
+        login_throttle.record_failure(username, client_ip)
         return render(request, 'passwords/login.html', {'error': 'Invalid credentials'})
 
 
 @login_required
 def index_view(request):
     """Main password manager page"""
-    # Get all password entries for the current user to build service list
-    entries = PasswordEntry.objects.filter(user=request.user).order_by('service_name')
-    service_list = [entry.service_name for entry in entries]
+    # The service list is loaded lazily by main.js from service_names
+    return render(request, 'passwords/index.html')
+
+
+def _service_index_etag(request):
+    if not request.user.is_authenticated:
+        return None
+    # Kept for service_names(), so the version is read once per request
+    request.service_index_etag = service_index_etag(request.user.pk)
+    return request.service_index_etag
+
+
+@login_required
+async def aindex_view(request):
+    """Async index_view(), for ASGI deployments"""
+    return render(request, 'passwords/index.html')
+
+
+@require_GET
+@login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_service_index_etag)
+def service_names(request):
+    """List the user's service names, answering 304 when unchanged"""
+    service_list, _ = get_service_index(request.user.pk, request.service_index_etag)
+    return JsonResponse({'services': service_list})
+
+
+@require_GET
+@login_required
+def search(request):
+    """Prefix and fuzzy search over the user's service names, usernames and URLs"""
+    query = request.GET.get('q', '')
+    if len(query) > MAX_QUERY_LENGTH:
+        return JsonResponse({'error': 'Query too long'}, status=400)
+    try:
+        limit = min(max(int(request.GET.get('limit', 6)), 1), 50)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid request format'}, status=400)
+
+    results = search_indexes.search(request.user.pk, query, limit=limit)
+    return JsonResponse({'results': results})
+
+
+def _consume_requests(request, cost=1):
+    """Charge ``cost`` fetches against the session's request limit
+
+    Returns True if the request is within the limit (0 means unlimited).
+    """
+    request_limit = getattr(settings, 'PASSWORD_MANAGER_REQUEST_LIMIT', 5)
+    return consume_requests(request, cost, request_limit)
 
-    context = {
-        'categories': service_list,  # Keep same template variable name for compatibility
-        'nb_categories': len(service_list)
-    }
 
-    # Set session data
-    request.session['nb_group'] = len(service_list)
+async def _aconsume_requests(request, cost=1):
+    """Async _consume_requests()"""
+    request_limit = getattr(settings, 'PASSWORD_MANAGER_REQUEST_LIMIT', 5)
+    return await aconsume_requests(request, cost, request_limit)
 
-    return render(request, 'passwords/index.html', context)
+
+def _rotation_in_progress():
+    return JsonResponse({'error': 'The vault key is being rotated - please try again once it is done'}, status=409)
+
+
+def _entry_data(entry, password):
+    """Build the JSON payload for one entry and its decrypted password"""
+    data = {
+        'service_name': entry.service_name,
+        'username': entry.username,
+        'password': password,
+    }
+    if entry.service_url:
+        data['service_url'] = entry.service_url
+    if entry.comments:
+        data['comments'] = entry.comments
+    return data
 
 
 @csrf_exempt
 @require_POST
 @login_required
+@rate_limited('fetch_data')
 def fetch_data(request):
     """Fetch password data for a specific entry"""
     # Validate request parameters
@@ -66,48 +175,122 @@ def fetch_data(request):
         return JsonResponse({'error': 'Invalid request format'}, status=400)
 
     # Check request limit (configurable via settings)
-    request_limit = getattr(settings, 'PASSWORD_MANAGER_REQUEST_LIMIT', 5)
-    nb_req = request.session.get('nb_req', 0)
-    if nb_req >= request_limit:
+    if not _consume_requests(request):
         return JsonResponse({'error': 'You have exceeded the allowed number of requests'}, status=429)
 
-    # Increment request counter
-    request.session['nb_req'] = nb_req + 1
-
     try:
         # Get the specific entry by service name, ensuring it belongs to the current user
         entry = PasswordEntry.objects.get(service_name=service_name, user=request.user)
 
         # Build response data for the specific entry
-        user_password = request.session.get('user_password')
+        key = get_session_key(request)
 
-        if not user_password:
+        if not key:
             return JsonResponse({'error': 'Session expired - please log in again'}, status=401)
 
         # Generate response
-        decrypted_password = entry.decrypt_password(user_password)
-        data = {
-            'service_name': entry.service_name,
-            'username': entry.username,
-            'password': decrypted_password,
-        }
-        if entry.service_url:
-            data['service_url'] = entry.service_url
-        if entry.comments:
-            data['comments'] = entry.comments
-
-        return JsonResponse(data)
+        return JsonResponse(_entry_data(entry, entry.decrypt_password(key)))
 
     except PasswordEntry.DoesNotExist:
         return JsonResponse({'error': 'Entry not found'}, status=404)
+    except KeyRotationInProgress:
+        return _rotation_in_progress()
+    except Exception:
+        return JsonResponse({'error': 'Internal server error'}, status=500)
+
+
+@csrf_exempt
+@require_POST
+@login_required
+@rate_limited('fetch_data')
+async def afetch_data(request):
+    """Async fetch_data(): ORM calls are awaited and crypto runs in a bounded executor"""
+    service_name = request.POST.get('item')
+
+    if not service_name:
+        return JsonResponse({'error': 'Invalid request format'}, status=400)
+
+    if not await _aconsume_requests(request):
+        return JsonResponse({'error': 'You have exceeded the allowed number of requests'}, status=429)
+
+    try:
+        user = await request.auser()
+        entry = await PasswordEntry.objects.aget(service_name=service_name, user=user)
+
+        key = await aget_session_key(request)
+
+        if not key:
+            return JsonResponse({'error': 'Session expired - please log in again'}, status=401)
+
+        return JsonResponse(_entry_data(entry, await run_crypto(entry.decrypt_password, key)))
+
+    except PasswordEntry.DoesNotExist:
+        return JsonResponse({'error': 'Entry not found'}, status=404)
+    except KeyRotationInProgress:
+        return _rotation_in_progress()
+    except Exception:
+        return JsonResponse({'error': 'Internal server error'}, status=500)
+
+
+def _batch_service_names(request):
+    """The distinct service names a batch asks for, in order, or None if the batch is invalid"""
+    service_names = list(dict.fromkeys(name for name in request.POST.getlist('items') if name))
+    batch_limit = getattr(settings, 'PASSWORD_MANAGER_BATCH_LIMIT', 20)
+    if not service_names or len(service_names) > batch_limit:
+        return None
+    return service_names
+
+
+@csrf_exempt
+@require_POST
+@login_required
+# Charged per distinct name, and not at all for a batch refused as invalid
+@rate_limited('fetch_data', cost=lambda request: len(_batch_service_names(request) or ()))
+def fetch_batch(request):
+    """Fetch password data for several entries with one query and one key lookup
+
+    Each entry returned counts as one request against the session limit; the
+    whole batch is refused if it does not fit in what remains.
+    """
+    service_names = _batch_service_names(request)
+    if service_names is None:
+        return JsonResponse({'error': 'Invalid request format'}, status=400)
+
+    try:
+        key = get_session_key(request)
+    except KeyRotationInProgress:
+        return _rotation_in_progress()
+    if not key:
+        return JsonResponse({'error': 'Session expired - please log in again'}, status=401)
+
+    try:
+        entries = list(PasswordEntry.objects.filter(user=request.user, service_name__in=service_names))
+
+        if not _consume_requests(request, cost=len(entries)):
+            return JsonResponse({'error': 'You have exceeded the allowed number of requests'}, status=429)
+
+        passwords = PasswordEntry.decrypt_passwords(entries, key)
+        data = {entry.service_name: _entry_data(entry, password) for entry, password in zip(entries, passwords)}
+        return JsonResponse({
+            'entries': data,
+            'missing': [name for name in service_names if name not in data],
+        })
+
     except Exception:
         return JsonResponse({'error': 'Internal server error'}, status=500)
 
 
 def logout_view(request):
     """Logout functionality"""
-    # Clear sensitive session data
-    if 'user_password' in request.session:
-        del request.session['user_password']
+    clear_requests(request)
     logout(request)
-    return redirect('login')
+    response = redirect('login')
+    response.delete_cookie(COOKIE_NAME, path=settings.SESSION_COOKIE_PATH, domain=settings.SESSION_COOKIE_DOMAIN)
+    return response
+
+
+@require_GET
+@staff_member_required
+def metrics_view(request):
+    """Metrics in the Prometheus text format, for staff only"""
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,100 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import repeat
+import asyncio
+import threading
+
+from .crypto import encrypt_values
+
+BACKENDS = ('thread', 'process')
+
+
+def encrypt_chunk(key, values):
+    """Encrypt a list of plaintexts; empty values stay empty
+
+    Module level so that it can be pickled for the process backend.
+    """
+    encrypted = iter(encrypt_values(key, [value for value in values if value]))
+    return [next(encrypted) if value else b'' for value in values]
+
+
+class CryptoPool:
+    """Worker pool for bulk encryption jobs
+
+    Work is submitted in chunks and results are yielded in input order, with
+    at most ``workers * 2`` chunks in flight so memory stays bounded however
+    large the input is. With a single worker everything runs inline.
+    """
+
+    def __init__(self, workers=1, backend='thread'):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown worker backend: {backend}")
+        self.workers = max(1, workers)
+        self.backend = backend
+        self._executor = None
+
+    def __enter__(self):
+        if self.workers > 1:
+            executor_class = ProcessPoolExecutor if self.backend == 'process' else ThreadPoolExecutor
+            self._executor = executor_class(max_workers=self.workers)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def imap(self, func, *iterables):
+        """Like map(), but run in the pool and yield results in input order"""
+        if self._executor is None:
+            yield from map(func, *iterables)
+            return
+
+        pending = deque()
+        for args in zip(*iterables):
+            pending.append(self._executor.submit(func, *args))
+            if len(pending) >= self.workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def encrypt_batches(self, key, batches):
+        """Encrypt batches of (item, plaintext) pairs
+
+        Yields (items, encrypted_values) for each batch, in input order, so
+        that a batched writer can consume them directly.
+        """
+        pending_items = deque()
+
+        def plaintexts():
+            for batch in batches:
+                pending_items.append([item for item, _ in batch])
+                yield [value for _, value in batch]
+
+        for encrypted in self.imap(encrypt_chunk, repeat(key), plaintexts()):
+            yield pending_items.popleft(), encrypted
+
+
+_crypto_executor = None
+_crypto_executor_lock = threading.Lock()
+
+
+def crypto_executor():
+    """Shared, bounded thread pool for key derivation and decryption in async views"""
+    global _crypto_executor
+    if _crypto_executor is None:
+        with _crypto_executor_lock:
+            if _crypto_executor is None:
+                from django.conf import settings
+                _crypto_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'PASSWORD_MANAGER_CRYPTO_THREADS', 4),
+                    thread_name_prefix='crypto',
+                )
+    return _crypto_executor
+
+
+async def run_crypto(func, *args):
+    """Run CPU-bound crypto work off the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(crypto_executor(), partial(func, *args))